@@ -0,0 +1,207 @@
+# ASGI entry point serving the /api/route and /api/search contracts of
+# full_api.py without blocking on slow requests:
+#
+#   uvicorn asgi_api:app --host 0.0.0.0 --port 4225 --workers 4
+#
+# Importing full_api keeps its snapshot lifecycle (leader election, the
+# shared segment, the 30s reload thread) and its route cache. Router queries
+# run on a bounded thread pool, OSRM walks are fetched on one aiohttp session
+# per worker, and identical queries arriving while one is being answered
+# wait for that answer instead of routing again.
+import asyncio
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable
+from urllib.parse import parse_qs
+
+import aiohttp
+
+import snapshot
+from full_api import (GEOMETRY_BUDGET, INVALID_JOURNEY_ID, MAX_DEPARTURE_OFFSET, MAX_WINDOW, OSRM, ROUTE_CACHE,
+                      STOP_SEARCH, add_geometries, decode_journey_id, get_linestring_for_segment, get_stop_coords,
+                      get_straight_segment, parse_departure_time, parse_window, plan_route, route_cache_key,
+                      route_departure)
+
+ENGINE_WORKERS = int(os.environ.get("ENGINE_WORKERS", 4))
+ENGINE_POOL = ThreadPoolExecutor(max_workers=ENGINE_WORKERS, thread_name_prefix="engine")
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'content-type'),
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+]
+
+# route cache key -> future of (payload, status, cacheable)
+_inflight: Dict[Hashable, asyncio.Future] = {}
+_session = None
+
+
+def _client_session() -> aiohttp.ClientSession:
+    # created on first use, inside the running event loop
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=64))
+    return _session
+
+
+async def _leg_geometry(segment, segstops, rail_routes):
+    if segment['type'] != 'walk':
+        # linestring cuts are in-memory lookups
+        return get_linestring_for_segment(segment, segstops, rail_routes)
+    origin_coord = get_stop_coords(segment['from'])
+    dest_coord = get_stop_coords(segment['to'])
+    if not origin_coord or not dest_coord:
+        return {'coordinates': [], 'duration': 0, 'distance': 0}
+    walk = await OSRM.walk_async(_client_session(), segment['from'], segment['to'], origin_coord, dest_coord)
+    return walk if walk is not None else get_straight_segment(segment)
+
+
+async def get_segment_geometries(path, segstops, rail_routes):
+    # full_api.get_segment_geometries on the event loop: legs still pending
+    # after GEOMETRY_BUDGET become straight lines and finish in the background
+    tasks = [asyncio.ensure_future(_leg_geometry(segment, stops, rail_routes))
+             for segment, stops in zip(path, segstops)]
+    done, _ = await asyncio.wait(tasks, timeout=GEOMETRY_BUDGET)
+    geometries = []
+    complete = True
+    for segment, task in zip(path, tasks):
+        if task in done and task.exception() is None:
+            geometries.append(task.result())
+        else:
+            print(f"Geometry for {segment['from']}->{segment['to']} missed the budget: {task.exception() if task in done else 'timed out'}")
+            geometries.append(get_straight_segment(segment))
+            complete = False
+    return geometries, complete
+
+
+async def _answer_route(live, data, origin, destination, departure_time, window):
+    loop = asyncio.get_running_loop()
+    payload, status, path = await loop.run_in_executor(
+        ENGINE_POOL, plan_route, live, data, origin, destination, departure_time, window)
+    cacheable = True
+    if path is not None:
+        geometries, cacheable = await get_segment_geometries(
+            path, [seg_data.get('stops', []) for seg_data in payload['segments']], live.rail_routes)
+        add_geometries(payload, geometries)
+    return payload, status, cacheable
+
+
+async def route(data):
+    origin = data.get('origin')
+    destination = data.get('destination')
+
+    if not origin or not destination:
+        return {'error': 'Missing origin or destination'}, 400
+
+    try:
+        departure_time = route_departure(parse_departure_time(data.get('departure_time')))
+    except ValueError:
+        return {'error': f'departure_time must be a unix time within {MAX_DEPARTURE_OFFSET}s of now'}, 400
+    try:
+        window = parse_window(data.get('window'))
+    except ValueError:
+        return {'error': f'window must be a number of minutes up to {MAX_WINDOW}'}, 400
+    live = snapshot.current()
+
+    key = route_cache_key(data, origin, destination, departure_time, window, live)
+    cached = ROUTE_CACHE.get(key)
+    if cached is not None:
+        payload, status = cached
+        if 'snapshot' in payload:
+            payload = dict(payload, snapshot=live.info())
+        return payload, status
+
+    future = _inflight.get(key)
+    if future is None:
+        future = _inflight[key] = asyncio.ensure_future(
+            _answer_route(live, data, origin, destination, departure_time, window))
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    try:
+        payload, status, cacheable = await asyncio.shield(future)
+    except Exception as e:
+        print(f"Routing error: {e}")
+        traceback.print_exc()
+        return {'error': str(e)}, 500
+
+    if cacheable and status == 200:
+        ROUTE_CACHE.put(key, (payload, status))
+    return payload, status
+
+
+async def route_geometry(journey_id):
+    try:
+        path = decode_journey_id(journey_id)
+    except INVALID_JOURNEY_ID:
+        return {'error': 'Invalid journey id'}, 400, []
+
+    geometries, complete = await get_segment_geometries(path, [[] for _ in path], snapshot.current().rail_routes)
+    cache_control = b'public, max-age=3600' if complete else b'no-store'
+    return {'segments': geometries}, 200, [(b'cache-control', cache_control)]
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def _send(send, payload, status=200, headers=()):
+    # JSON the way Flask's jsonify writes it
+    body = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                    *CORS_HEADERS, *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _session is not None:
+                await _session.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    path = scope['path']
+    if method == 'OPTIONS':
+        return await _send(send, {}, 200)
+
+    if path == '/api/search' and method == 'GET':
+        query = parse_qs(scope['query_string'].decode()).get('q', [''])[0]
+        return await _send(send, STOP_SEARCH.search(query))
+
+    if path == '/api/route' and method == 'POST':
+        try:
+            data = json.loads(await _read_body(receive))
+        except ValueError:
+            return await _send(send, {'error': 'Invalid JSON body'}, 400)
+        if not isinstance(data, dict):
+            return await _send(send, {'error': 'Invalid JSON body'}, 400)
+        payload, status = await route(data)
+        return await _send(send, payload, status)
+
+    parts = path.split('/')
+    if len(parts) == 5 and parts[1:3] == ['api', 'route'] and parts[4] == 'geometry' and method == 'GET':
+        payload, status, headers = await route_geometry(parts[3])
+        return await _send(send, payload, status, headers)
+
+    await _send(send, {'error': 'Not found'}, 404)
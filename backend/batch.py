@@ -0,0 +1,101 @@
+# Batch routing for accessibility studies: one McRAPTOR round loop per origin,
+# serving every destination, with origins spread across a process pool.
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mcraptor import McRAPTOR
+from shared_snapshot import LIVE_SEGMENT, segment_path, segment_version
+
+_engine: Optional[McRAPTOR] = None
+_destinations: List[str] = []
+
+
+def _init_worker(segment: str, destinations: List[str]):
+    # Every worker maps the same published segment, so the compiled
+    # timetable and footpaths exist once in memory however many run.
+    global _engine, _destinations
+    _engine = McRAPTOR.from_segment(segment)
+    _destinations = destinations
+
+
+def _route_origin(job: Tuple[str, int, int]) -> Tuple[str, Dict[str, List[Tuple[int, int]]]]:
+    origin, departure_time, max_rounds = job
+    arrivals = _engine.route_one_to_many(origin, departure_time, max_rounds=max_rounds)
+    return origin, {destination: arrivals[destination] for destination in _destinations if destination in arrivals}
+
+
+def route_many_to_many(engine: McRAPTOR, origins: Iterable[str], destinations: Iterable[str], departure_time: int,
+                       max_rounds: int = 5, processes: Optional[int] = None,
+                       segment: Optional[str] = None) -> Dict[str, Dict[str, List[Tuple[int, int]]]]:
+    # origin -> destination -> Pareto set of (arrival_time, num_legs);
+    # unreachable destinations are left out. Pass the path of an already
+    # published segment to reuse it, otherwise the engine is published to a
+    # temporary one for the pool.
+    global _engine, _destinations
+    destinations = list(destinations)
+    jobs = [(origin, departure_time, max_rounds) for origin in origins]
+    if processes == 1:
+        _engine, _destinations = engine, destinations
+        return dict(map(_route_origin, jobs))
+
+    temporary = segment is None
+    if temporary:
+        segment = segment_path(f"raptor-batch-{os.getpid()}")
+        engine.publish(segment)
+    try:
+        results = {}
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(segment, destinations)) as executor:
+            for origin, arrivals in executor.map(_route_origin, jobs, chunksize=16):
+                results[origin] = arrivals
+        return results
+    finally:
+        if temporary:
+            os.unlink(segment)
+
+
+def travel_times(results: Dict[str, Dict[str, List[Tuple[int, int]]]], departure_time: int) -> Dict[str, Dict[str, int]]:
+    # Earliest-arrival travel time in seconds for every reachable pair.
+    return {
+        origin: {destination: min(t for t, _ in labels) - departure_time for destination, labels in arrivals.items()}
+        for origin, arrivals in results.items()
+    }
+
+
+if __name__ == '__main__':
+    # python batch.py hubs.json output.json [origins.json]
+    from update_times import getArrivalsAndPlatforms
+
+    with open(sys.argv[1], 'r') as f:
+        hubs = json.load(f)
+
+    # attach to the API's live snapshot when one is published, otherwise build one
+    segment = segment_path(LIVE_SEGMENT)
+    if segment_version(segment) is not None:
+        raptor = McRAPTOR.from_segment(segment)
+    else:
+        segment = None
+        data = getArrivalsAndPlatforms()
+        raptor = McRAPTOR(
+            arrivaltimes=data["arrivaltimes"],
+            walking_distances_file='walking_distances.bin',
+            max_walking_distance=1800
+        )
+
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'r') as f:
+            origins = json.load(f)
+    else:
+        origins = raptor.timetable.stop_ids
+
+    departure_time = int(time.time())
+    start = time.time()
+    results = route_many_to_many(raptor, origins, hubs, departure_time, segment=segment)
+    print(f"Routed {len(origins)} origins to {len(hubs)} hubs in {time.time() - start:.1f}s")
+
+    with open(sys.argv[2], 'w') as f:
+        json.dump(travel_times(results, departure_time), f)
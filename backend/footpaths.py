@@ -0,0 +1,95 @@
+import json
+import sys
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from shared_snapshot import map_segment, write_segment
+
+
+class FootpathGraph:
+    # Walking transfers in CSR form over interned stop ids: the footpaths
+    # leaving stop s are neighbors[offsets[s]:offsets[s + 1]] with the walk
+    # time in seconds at the same positions of durations, sorted by duration
+    # so a walk limit is a bisect rather than a filter.
+    #
+    # A graph built from walking_distances.json carries its own `stop_ids`;
+    # the timetable interns those first, so ids 0..len(stop_ids)-1 mean the
+    # same stops in both and the graph is used as is.
+
+    def __init__(self, offsets: np.ndarray, neighbors: np.ndarray, durations: np.ndarray,
+                 stop_ids: Optional[List[str]] = None):
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.durations = durations
+        self.stop_ids = stop_ids or []
+        self._offsets = memoryview(offsets)
+        self._neighbors = memoryview(neighbors)
+        self._durations = memoryview(durations)
+
+    @classmethod
+    def from_dict(cls, walking: Dict[str, Dict[str, float]]) -> 'FootpathGraph':
+        # `walking` is the walking_distances.json layout written by walkingdist.py
+        stop_ids = []
+        stop_index = {}
+
+        def intern(stop_id):
+            if stop_id not in stop_index:
+                stop_index[stop_id] = len(stop_ids)
+                stop_ids.append(stop_id)
+            return stop_index[stop_id]
+
+        sources, targets, durations = [], [], []
+        for stop_id, neighbors in walking.items():
+            stop = intern(stop_id)
+            for neighbor_id, walk_seconds in neighbors.items():
+                sources.append(stop)
+                targets.append(intern(neighbor_id))
+                durations.append(walk_seconds)
+
+        sources = np.array(sources, dtype=np.int32)
+        durations = np.array(durations, dtype=np.float64)
+        order = np.lexsort((durations, sources))
+        offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(stop_ids)), out=offsets[1:])
+        return cls(offsets, np.array(targets, dtype=np.int32)[order], durations[order], stop_ids)
+
+    def save(self, path: str):
+        write_segment(path, self.to_arrays(), {'stop_ids': self.stop_ids})
+
+    @classmethod
+    def load(cls, path: str) -> 'FootpathGraph':
+        # The arrays stay backed by the read-only mapping of the file.
+        arrays, strings, _ = map_segment(path)
+        return cls.from_arrays(arrays, strings['stop_ids'])
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {'offsets': self.offsets, 'neighbors': self.neighbors, 'durations': self.durations}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], stop_ids: Optional[List[str]] = None) -> 'FootpathGraph':
+        return cls(arrays['offsets'], arrays['neighbors'], arrays['durations'], stop_ids)
+
+    def resized(self, num_stops: int) -> 'FootpathGraph':
+        # Same edges over a stop table that has grown to num_stops; the new
+        # stops have no footpaths.
+        if num_stops == len(self.offsets) - 1:
+            return self
+        padding = np.full(num_stops + 1 - len(self.offsets), self.offsets[-1], dtype=self.offsets.dtype)
+        return FootpathGraph(np.concatenate([self.offsets, padding]), self.neighbors, self.durations, self.stop_ids)
+
+    def walks_from(self, stop: int, max_duration: float) -> List[Tuple[int, float]]:
+        if stop >= len(self._offsets) - 1:
+            return []
+        start = self._offsets[stop]
+        end = bisect_right(self._durations, max_duration, start, self._offsets[stop + 1])
+        return list(zip(self._neighbors[start:end].tolist(), self._durations[start:end].tolist()))
+
+
+if __name__ == '__main__':
+    # python footpaths.py walking_distances.json walking_distances.bin
+    with open(sys.argv[1], 'r') as f:
+        graph = FootpathGraph.from_dict(json.load(f))
+    graph.save(sys.argv[2])
+    print(f"Wrote {len(graph.neighbors)} footpaths between {len(graph.stop_ids)} stops to {sys.argv[2]}")
@@ -1,256 +1,169 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+import base64
+import binascii
 import json
-import math
+import os
 import time
-import requests
-from collections import deque
+import zlib
 from mcraptor import McRAPTOR
-from data import Point, connect_db
-from update_times import getArrivalsAndPlatforms
+from shared_snapshot import LIVE_SEGMENT, segment_path, segment_version, try_acquire_leader
+import snapshot
+from search import StopSearch
+from lines import LineTable, TUBE_COLORS
+from linestrings import load_linestrings
+from geometry import distance
+from osrm import OSRMClient, load_walk_geometry
+from route_cache import RouteCache
+from route_params import MAX_DEPARTURE_OFFSET, MAX_WINDOW, parse_departure_time, parse_window
+from data import connect_db
+from update_times import RELOAD_INTERVAL, getArrivalsAndPlatforms, write_client
+from influxdb_client import Point as InfluxPoint
+from influxdb_client.client.write_api import SYNCHRONOUS
 import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 app = Flask(__name__)
 CORS(app)
-TUBE_COLORS = {
-    'bakerloo': '#B36305',
-    'central': '#E32017',
-    'circle': '#FFD300',
-    'district': '#00782A',
-    'hammersmith-city': '#F3A9BB',
-    'jubilee': '#A0A5A9',
-    'metropolitan': '#9B0056',
-    'northern': '#000000',
-    'piccadilly': '#003688',
-    'victoria': '#0098D4',
-    'waterloo-city': '#95CDBA',
-}
-
-RAIL_COLORS = {
-    'Southeastern': '#1E1E50',
-    'Southern': '#003F2E',
-    'Thameslink': '#E9418B',
-    'London Overground': '#EE7C0E',
-    'Elizabeth Line': '#6E4C9F',
-}
-
 connect_db()
 
-try:
-    with open("linestrings.json", "r") as f:
-        LINESTRINGS = json.load(f)
-except FileNotFoundError:
-    LINESTRINGS = {}
-
-def reloadLiveData():
-    global arrivaltimes_data, PLATFORMS, raptor
-    data = getArrivalsAndPlatforms()
-    arrivaltimes_data = data["arrivaltimes"]
-    PLATFORMS = data["platforms"]
-    raptor = McRAPTOR(
-        arrivaltimes=arrivaltimes_data,
-        walking_distances_file='walking_distances.json',
-        max_walking_distance=1800
-    )
-
-reloadLiveData()
-
-RAIL_ROUTES = set()
-for route in arrivaltimes_data.keys():
-    if isinstance(arrivaltimes_data[route], dict):
-        RAIL_ROUTES.add(route)
+# per-leg geometry for /api/route responses; every one of these threads may
+# be waiting on OSRM at once, so its connection pool is sized to match
+GEOMETRY_WORKERS = 16
+GEOMETRY_POOL = ThreadPoolExecutor(max_workers=GEOMETRY_WORKERS, thread_name_prefix="geometry")
+LINESTRINGS = load_linestrings("linestrings.bin")
+OSRM = OSRMClient(store=load_walk_geometry("walking_geometry.bin"), workers=GEOMETRY_WORKERS)
+ROUTE_CACHE = RouteCache()
+# router counters summed over the queries between two reloads
+ROUTE_STATS_KEYS = ("labels_created", "pruned_local", "pruned_target")
+route_stats = dict.fromkeys(ROUTE_STATS_KEYS, 0)
+route_stats_lock = threading.Lock()
+GEOMETRY_BUDGET = 1.0
+# limits on what a /api/route/<journey_id>/geometry id may unpack to
+MAX_JOURNEY_LEGS = 16
+MAX_JOURNEY_BYTES = 8192
+
+SNAPSHOT_SEGMENT = segment_path(LIVE_SEGMENT)
+leader_lock = None
+segment_seen = None
+# the leader's last in-process build, patched on the next reload
+last_build = None
+
+# platforms.json, when present, replaces the live platform assignments
 try:
     with open("platforms.json", "r") as f:
-        PLATFORMS = json.load(f)
+        PLATFORMS_OVERRIDE = json.load(f)
 except FileNotFoundError:
-    PLATFORMS = {}
+    PLATFORMS_OVERRIDE = None
 
-stop_names = {}
-def get_stop_name(stop_id):
-    if stop_id in stop_names:
-        return stop_names[stop_id]
-    else:
-        try:
-            name = Point.get(Point.point_id == stop_id).name
-            stop_names[stop_id] = name
-            return name
-        except Point.DoesNotExist:
-            return stop_id
-def get_tube_line_info(route_id):
-    route_lower = route_id.lower()
-    if route_lower in TUBE_COLORS:
-        line_name = route_lower.replace('-', ' ').title()
-        return line_name, TUBE_COLORS[route_lower]
-
-    return None, None
-
-def get_rail_line_info(route_id):
-    if(len(route_id.split("/")) > 1):
-        if route_id.split("/")[0] in RAIL_COLORS:
-            return route_id.split("/")[0] + "/" + get_stop_name(route_id.split("/")[1]), RAIL_COLORS[route_id.split("/")[0]]
+def reloadLiveData():
+    # One worker (whoever holds the leader lock) fetches the feeds and
+    # publishes the engine as a shared segment. Every worker, the leader
+    # included, then maps that segment, so the timetable and footpaths are
+    # held once in memory however many workers gunicorn runs. The new
+    # snapshot is only swapped in once it is complete.
+    global leader_lock, segment_seen, last_build
+    live = snapshot.current()
+    if leader_lock is None:
+        leader_lock = try_acquire_leader(SNAPSHOT_SEGMENT + ".lock")
+    if leader_lock is not None:
+        data = getArrivalsAndPlatforms()
+        rail_routes = [route for route, trips in data["arrivaltimes"].items() if isinstance(trips, dict)]
+        if live is not None:
+            version = live.version + 1
+        elif segment_version(SNAPSHOT_SEGMENT) is not None:
+            # taking over from a previous leader; keep its numbering going
+            version = McRAPTOR.from_segment(SNAPSHOT_SEGMENT).meta["version"] + 1
         else:
-            return route_id.split("/")[0] + "/" + get_stop_name(route_id.split("/")[1]), '#3b82f6'
+            version = 1
+        # the build patches the previous one in place, so a reload that fails
+        # partway leaves nothing to patch and the next one starts afresh
+        previous, last_build = last_build, None
+        last_build = McRAPTOR(
+            arrivaltimes=data["arrivaltimes"],
+            walking_distances_file='walking_distances.bin',
+            max_walking_distance=1800,
+            previous=previous
+        )
+        lines = LineTable.build(last_build.stops, last_build.timetable.route_names, set(rail_routes))
+        last_build.publish(SNAPSHOT_SEGMENT, {
+            "version": version,
+            "created_at": time.time(),
+            "platforms": PLATFORMS_OVERRIDE if PLATFORMS_OVERRIDE is not None else data["platforms"],
+            "rail_routes": rail_routes,
+        }, extra={"lines.": lines.to_arrays()})
     else:
-        return route_id, '#3b82f6'
-
-def get_stop_coords(naptan_id):
+        while segment_version(SNAPSHOT_SEGMENT) is None:
+            print("Waiting for the leader worker to publish a snapshot")
+            time.sleep(1)
+
+    seen = segment_version(SNAPSHOT_SEGMENT)
+    if seen != segment_seen:
+        engine = McRAPTOR.from_segment(SNAPSHOT_SEGMENT)
+        snapshot.publish(snapshot.Snapshot.from_engine(engine))
+        ROUTE_CACHE.clear()
+        segment_seen = seen
+        print(f"Using snapshot version {engine.meta['version']}")
+
+    hits, misses = ROUTE_CACHE.take_counts()
+    with route_stats_lock:
+        counts = dict(route_stats)
+        route_stats.update(dict.fromkeys(ROUTE_STATS_KEYS, 0))
     try:
-        stop = Point.get(Point.point_id == naptan_id)
-        return (stop.longitude, stop.latitude)
-    except:
-        return None
-
-def distance(coord1, coord2):
-    lon1, lat1 = coord1
-    lon2, lat2 = coord2
-    
-    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
-    
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    
-    return c * 6371000
-
-def point_to_segment_distance(point, seg_start, seg_end):
-    px, py = point
-    x1, y1 = seg_start
-    x2, y2 = seg_end
-    
-    seg_len_sq = (x2 - x1)**2 + (y2 - y1)**2
-    
-    if seg_len_sq == 0:
-        return distance(point, seg_start), seg_start
-    
-    t = max(0, min(1, ((px - x1) * (x2 - x1) + (py - y1) * (y2 - y1)) / seg_len_sq))
-    
-    closest_x = x1 + t * (x2 - x1)
-    closest_y = y1 + t * (y2 - y1)
-    
-    return distance(point, (closest_x, closest_y)), (closest_x, closest_y)
-
-def find_closest_point_on_route(coords, target_coord):
-    min_dist = float('inf')
-    best_segment_idx = 0
-    best_projection = None
-    
-    for i in range(len(coords) - 1):
-        dist, projection = point_to_segment_distance(target_coord, coords[i], coords[i + 1])
-        if dist < min_dist:
-            min_dist = dist
-            best_segment_idx = i
-            best_projection = projection
-    
-    return best_segment_idx, best_projection
-
-def extract_partial_linestring(linestring, origin_coord, dest_coord):
-    if isinstance(linestring, str):
-        coords = json.loads(linestring)[0]
-    else:
-        coords = linestring[0]
-    
-    print(f"Total route points: {len(coords)}")
-    print(f"Origin coord: {origin_coord}")
-    print(f"Dest coord: {dest_coord}")
-    
-    origin_seg_idx, origin_projection = find_closest_point_on_route(coords, origin_coord)
-    dest_seg_idx, dest_projection = find_closest_point_on_route(coords, dest_coord)
-    
-    print(f"Origin segment index: {origin_seg_idx}, projection: {origin_projection}")
-    print(f"Dest segment index: {dest_seg_idx}, projection: {dest_projection}")
-    
-    origin_idx = None
-    dest_idx = None
-
-    for i, coord in enumerate(coords):
-        if distance(coord, origin_projection) < 0.001:
-            origin_idx = i
-        if distance(coord, dest_projection) < 0.001:
-            dest_idx = i
-
-    if origin_idx is None or dest_idx is None:
-        origin_idx = origin_seg_idx + 1 if origin_seg_idx + 1 < len(coords) else origin_seg_idx
-        dest_idx = dest_seg_idx + 1 if dest_seg_idx + 1 < len(coords) else dest_seg_idx
-
-    print(f"Using coordinate indices: origin={origin_idx}, dest={dest_idx}")
-
-    queue = deque([(origin_idx, [origin_idx])])
-    visited = {origin_idx}
-
-    found_path = None
-
-    while queue:
-        current_idx, path = queue.popleft()
+        write_api = write_client.write_api(write_options=SYNCHRONOUS)
+        point = (InfluxPoint("route_cache").tag("worker", os.getpid())
+                 .field("hits", hits).field("misses", misses).field("entries", len(ROUTE_CACHE)))
+        stats_point = InfluxPoint("route_stats").tag("worker", os.getpid())
+        for name, count in counts.items():
+            stats_point = stats_point.field(name, count)
+        write_api.write(bucket="metrics", org="local-org", record=[point, stats_point])
+    except Exception as e:
+        print(f"Writing route metrics failed: {e}")
 
-        if current_idx == dest_idx:
-            found_path = path
-            break
+def run_periodic():
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        print(f"Reloading live data")
+        try:
+            reloadLiveData()
+        except Exception as e:
+            # keep serving the previous snapshot until a reload succeeds
+            print(f"Reload failed: {e}")
 
-        neighbors = []
-        if current_idx > 0:
-            neighbors.append(current_idx - 1)
-        if current_idx < len(coords) - 1:
-            neighbors.append(current_idx + 1)
+def start_background_thread():
+    def run():
+        thread = threading.Thread(target=run_periodic, daemon=True)
+        thread.start()
+        print("Background thread started.")
+    threading.Thread(target=run, daemon=True).start()
 
-        for neighbor in neighbors:
-            if neighbor not in visited:
-                visited.add(neighbor)
-                queue.append((neighbor, path + [neighbor]))
+reloadLiveData()
+start_background_thread()
 
-    if found_path:
-        partial_coords = [coords[i] for i in found_path]
-        partial_coords[0] = origin_projection
-        partial_coords[-1] = dest_projection
-        partial = partial_coords
-    else:
-        print("BFS failed, using simple approach")
-        partial = [origin_projection, dest_projection]
-    
-    print(f"Partial route has {len(partial)} points")
-    
-    result = [[coord[1], coord[0]] for coord in partial]
-    print(f"Returning {len(result)} points")
-    return result
+# Stop lookups go through the snapshot's stop table; the Point table is
+# static, so which snapshot answers does not matter.
+def get_stop_mode(stop_id):
+    return snapshot.current().stops.mode(stop_id)
+def get_stop_coords(naptan_id):
+    return snapshot.current().stops.coords(naptan_id)
 
 def create_straight_line(origin_coord, dest_coord):
     lon1, lat1 = origin_coord
     lon2, lat2 = dest_coord
     return [[lat1, lon1], [lat2, lon2]]
 
-def get_walking_route_from_osrm(origin_coord, dest_coord):
-    lon1, lat1 = origin_coord
-    lon2, lat2 = dest_coord
-    
-    try:
-        url = f"http://osrm:5000/route/v1/walking/{lon1},{lat1};{lon2},{lat2}?overview=full&geometries=geojson"
-        response = requests.get(url, timeout=2)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('code') == 'Ok' and data.get('routes'):
-                route = data['routes'][0]
-                duration = route.get('duration', 0)
-                distance = route.get('distance', 0)
-                
-                coords = route['geometry']['coordinates']
-                leaflet_coords = [[coord[1], coord[0]] for coord in coords]
-                
-                return {
-                    'coordinates': leaflet_coords,
-                    'duration': int(duration),
-                    'distance': distance
-                }
-    except Exception as e:
-        print(f"OSRM walking route failed: {e}")
+def get_walking_route_from_osrm(origin_id, dest_id, origin_coord, dest_coord, leg_distance):
+    walk = OSRM.walk(origin_id, dest_id, origin_coord, dest_coord)
+    if walk is not None:
+        return walk
     
     return {
         'coordinates': create_straight_line(origin_coord, dest_coord),
-        'duration': int(distance(origin_coord, dest_coord) / 1.4),
-        'distance': distance(origin_coord, dest_coord)
+        'duration': int(leg_distance / 1.4),
+        'distance': leg_distance
     }
 
-def get_linestring_for_segment(segment, segstops):
+def get_linestring_for_segment(segment, segstops, rail_routes):
     origin_id = segment['from']
     dest_id = segment['to']
     origin_coord = get_stop_coords(origin_id)
@@ -258,9 +171,10 @@ def get_linestring_for_segment(segment, segstops):
 
     if not origin_coord or not dest_coord:
         return {'coordinates': [], 'duration': 0, 'distance': 0}
+    leg_distance = distance(origin_coord, dest_coord)
     
     if segment['type'] == 'walk':
-        return get_walking_route_from_osrm(origin_coord, dest_coord)
+        return get_walking_route_from_osrm(origin_id, dest_id, origin_coord, dest_coord, leg_distance)
     
     route_id = segment['route']
     ride_time = segment.get('ride_time', 0)
@@ -269,44 +183,27 @@ def get_linestring_for_segment(segment, segstops):
         return {
             'coordinates': create_straight_line(origin_coord, dest_coord),
             'duration': ride_time,
-            'distance': distance(origin_coord, dest_coord)
+            'distance': leg_distance
         }
 
-    if route_id in RAIL_ROUTES:
-        origin_mode = None
-        dest_mode = None
-        try:
-            origin_stop = Point.get(Point.point_id == origin_id)
-            origin_mode = origin_stop.mode
-        except:
-            pass
-        try:
-            dest_stop = Point.get(Point.point_id == dest_id)
-            dest_mode = dest_stop.mode
-        except:
-            pass
+    if route_id in rail_routes:
+        origin_mode = get_stop_mode(origin_id)
+        dest_mode = get_stop_mode(dest_id)
 
         if origin_mode == 'rail' or dest_mode == 'rail':
-            stops_crs = list(map(lambda x: x["id"], segstops))
-            origin_crs = origin_id.split("/")[0]
-            dest_crs = dest_id.split("/")[0]
             return {
                 'coordinates': create_straight_line(origin_coord, dest_coord),
                 'duration': ride_time,
-                'distance': distance(origin_coord, dest_coord)
+                'distance': leg_distance
             }
     
-    if route_id in LINESTRINGS and LINESTRINGS[route_id]:
+    if route_id in LINESTRINGS:
         try:
-            coords = extract_partial_linestring(
-                LINESTRINGS[route_id],
-                origin_coord,
-                dest_coord
-            )
+            coords = LINESTRINGS.extract(route_id, origin_id, dest_id, origin_coord, dest_coord)
             return {
                 'coordinates': coords,
                 'duration': ride_time,
-                'distance': distance(origin_coord, dest_coord)
+                'distance': leg_distance
             }
         except Exception as e:
             print(f"Error extracting linestring for {route_id}: {e}")
@@ -314,155 +211,205 @@ def get_linestring_for_segment(segment, segstops):
     return {
         'coordinates': create_straight_line(origin_coord, dest_coord),
         'duration': ride_time,
-        'distance': distance(origin_coord, dest_coord)
+        'distance': leg_distance
     }
 
-@app.route('/api/search', methods=['GET'])
-def search_stops():
-    from data import Connection
-    query = request.args.get('q', '').strip().lower()
-    
-    if len(query) < 2:
-        return jsonify([])
-    
-    all_results = []
-    for stop in Point.select():
-        if query in stop.name.lower():
-            lines_info = []
-            connections = Connection.select().where(
-                (Connection.origin_point_id == stop.point_id)
-            ).limit(50)
-            
-            line_ids = set()
-            for conn in connections:
-                line_ids.add(conn.line_id)
-            
-            for line_id in sorted(line_ids):
-                connection_modes = set()
-                try:
-                    for conn in Connection.select().where(
-                        (Connection.origin_point_id == stop.point_id) & (Connection.line_id == line_id)
-                    ).limit(10):
-                        try:
-                            dest_stop = Point.get(Point.point_id == conn.destination_point_id)
-                            connection_modes.add(dest_stop.mode)
-                        except:
-                            continue
-                except:
-                    pass
-
-                if connection_modes:
-                    if 'bus' in connection_modes:
-                        lines_info.append({
-                            'id': line_id.upper(),
-                            'name': line_id.upper(),
-                            'color': '#ef4444',
-                            'type': 'bus'
-                        })
-                    elif 'rail' in connection_modes:
-                        rail_name, rail_color = get_rail_line_info(line_id)
-                        lines_info.append({
-                            'id': line_id,
-                            'name': rail_name or line_id,
-                            'color': rail_color,
-                            'type': 'rail'
-                        })
-                    elif 'tube' in connection_modes or 'underground' in connection_modes:
-                        line_name, line_color = get_tube_line_info(line_id)
-                        if line_name:
-                            lines_info.append({
-                                'id': line_id,
-                                'name': line_name,
-                                'color': line_color,
-                                'type': 'tube'
-                            })
-                        else:
-                            lines_info.append({
-                                'id': line_id.upper(),
-                                'name': line_id.upper(),
-                                'color': '#ef4444',
-                                'type': 'bus'
-                            })
-                    else:
-                        lines_info.append({
-                            'id': line_id.upper(),
-                            'name': line_id.upper(),
-                            'color': '#ef4444',
-                            'type': 'bus'
-                        })
-                else:
-                    line_name, line_color = get_tube_line_info(line_id)
-                    if line_name:
-                        lines_info.append({
-                            'id': line_id,
-                            'name': line_name,
-                            'color': line_color,
-                            'type': 'tube'
-                        })
-                    else:
-                        rail_name, rail_color = get_rail_line_info(line_id)
-                        if rail_name:
-                            lines_info.append({
-                                'id': line_id,
-                                'name': rail_name,
-                                'color': rail_color,
-                                'type': 'rail'
-                            })
-                        else:
-                            if stop.mode == "bus":
-                                lines_info.append({
-                                    'id': line_id.upper(),
-                                    'name': line_id.upper(),
-                                    'color': '#ef4444',
-                                    'type': 'bus'
-                                })
-                            elif stop.mode == "rail":
-                                lines_info.append({
-                                    'id': line_id.upper(),
-                                    'name': line_id.upper(),
-                                    'color': '#3b82f6',
-                                    'type': 'rail'
-                                })
-            
-            all_results.append({
-                'id': stop.point_id,
-                'name': stop.name,
-                'lat': stop.latitude,
-                'lng': stop.longitude,
-                'mode': stop.mode,
-                'lines': lines_info[:10],
-                'line_count': len(line_ids)
-            })
-    
-    name_to_best = {}
-    for result in all_results:
-        name = result['name']
-        is_rail = result['mode'] == 'rail'
+def get_straight_segment(segment):
+    # What a leg degrades to when its geometry misses the budget
+    origin_coord = get_stop_coords(segment['from'])
+    dest_coord = get_stop_coords(segment['to'])
+    if not origin_coord or not dest_coord:
+        return {'coordinates': [], 'duration': 0, 'distance': 0}
+    leg_distance = distance(origin_coord, dest_coord)
+    return {
+        'coordinates': create_straight_line(origin_coord, dest_coord),
+        'duration': int(leg_distance / 1.4) if segment['type'] == 'walk' else segment.get('ride_time', 0),
+        'distance': leg_distance
+    }
 
-        if name not in name_to_best:
-            name_to_best[name] = result
+def get_segment_geometries(path, segstops, rail_routes):
+    # All legs' geometry in parallel; whatever is not ready within
+    # GEOMETRY_BUDGET seconds is drawn as a straight line. Late OSRM walks
+    # still finish in the background and land in its cache. Also returns
+    # whether every leg got its real geometry.
+    futures = [GEOMETRY_POOL.submit(get_linestring_for_segment, segment, stops, rail_routes)
+               for segment, stops in zip(path, segstops)]
+    done, _ = wait(futures, timeout=GEOMETRY_BUDGET)
+    geometries = []
+    complete = True
+    for segment, future in zip(path, futures):
+        if future in done and future.exception() is None:
+            geometries.append(future.result())
         else:
-            existing = name_to_best[name]
-            existing_is_rail = existing['mode'] == 'rail'
-
-            if is_rail and not existing_is_rail:
-                name_to_best[name] = result
-            elif not is_rail and existing_is_rail:
-                continue
-            elif result['line_count'] > existing['line_count']:
-                name_to_best[name] = result
-
-    results = list(name_to_best.values())
+            print(f"Geometry for {segment['from']}->{segment['to']} missed the budget: {future.exception() if future in done else 'timed out'}")
+            geometries.append(get_straight_segment(segment))
+            complete = False
+    return geometries, complete
+
+def describe_segments(live, path):
+    # Segment fields without geometry or times: names, line styling,
+    # platform and intermediate stops
+    segments = []
+    for segment in path:
+        seg_data = {
+            'type': segment['type'],
+            'from': segment['from_name'],
+            'to': segment['to_name'],
+            'from_id': segment['from'],
+            'to_id': segment['to'],
+        }
+        
+        if segment['type'] != 'walk':
+            seg_data['route'] = segment['route']
+            seg_data['vehicle'] = segment.get('vehicle', '')
+            
+            route_id = segment['route']
+            origin_stop_id = segment['from']
+            dest_stop_id = segment['to']
+
+            origin_mode = live.stops.mode(origin_stop_id)
+            dest_mode = live.stops.mode(dest_stop_id)
+
+            style, shows_platform = live.lines.segment_style(route_id, origin_mode, dest_mode)
+            seg_data.update(style)
+            if shows_platform:
+                vehicleId = segment.get('vehicle', '')
+                platformId = f"{vehicleId}/{origin_stop_id}"
+                if platformId in live.platforms:
+                    seg_data['platform'] = live.platforms[platformId]
+                else:
+                    seg_data['platform'] = '?'
+
+            try:
+                stops_list = live.leg_stops(segment['route'], segment['vehicle'], segment['from'], segment['to'])
+                if stops_list is not None:
+                    seg_data['stops'] = stops_list
+            except Exception as e:
+                print(f"Error getting intermediate stops: {e}")
+
+        segments.append(seg_data)
+    return segments
+
+# A journey id carries the legs its geometry depends on, so any worker can
+# answer /api/route/<journey_id>/geometry without shared state
+def encode_journey_id(path):
+    legs = [[segment['type'], segment['from'], segment['to'], segment.get('route', ''),
+             segment.get('ride_time', 0)] for segment in path]
+    packed = zlib.compress(json.dumps(legs, separators=(',', ':')).encode())
+    return base64.urlsafe_b64encode(packed).decode().rstrip('=')
+
+# Errors a malformed or tampered journey id raises from decode_journey_id
+INVALID_JOURNEY_ID = (binascii.Error, zlib.error, ValueError)
+
+def decode_journey_id(journey_id):
+    packed = base64.urlsafe_b64decode(journey_id + '=' * (-len(journey_id) % 4))
+    decompressor = zlib.decompressobj()
+    unpacked = decompressor.decompress(packed, MAX_JOURNEY_BYTES)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("journey id is truncated or unpacks too large")
+    legs = json.loads(unpacked)
+    if not isinstance(legs, list) or not 0 < len(legs) <= MAX_JOURNEY_LEGS:
+        raise ValueError("journey id has the wrong number of legs")
+    path = []
+    for leg in legs:
+        if (not isinstance(leg, list) or len(leg) != 5 or leg[0] not in ('walk', 'trip')
+                or not all(isinstance(field, str) for field in leg[1:4])
+                or isinstance(leg[4], bool) or not isinstance(leg[4], int)):
+            raise ValueError("journey id has a malformed leg")
+        leg_type, origin_id, dest_id, route_id, ride_time = leg
+        path.append({'type': leg_type, 'from': origin_id, 'to': dest_id, 'route': route_id, 'ride_time': ride_time})
+    return path
+
+def get_journey_summary(live, journey):
+    # Leg times come from the router: walk time for walks, ride time for trips
+    segments = describe_segments(live, journey['path'])
+    current_time = journey['departure_time']
+    for segment, seg_data in zip(journey['path'], segments):
+        duration = int(segment['walk_time']) if segment['type'] == 'walk' else segment['ride_time']
+        seg_data['start_time'] = current_time
+        seg_data['duration'] = duration
+        current_time += duration
+        seg_data['end_time'] = current_time
+    return {
+        'journey_id': encode_journey_id(journey['path']),
+        'journey_time': journey['journey_time'],
+        'journey_minutes': journey['journey_time'] // 60,
+        'num_legs': journey['num_legs'],
+        'arrival_time': journey['arrival_time'],
+        'departure_time': journey['departure_time'],
+        'segments': segments,
+    }
 
-    results.sort(key=lambda x: (
-        0 if 'underground' in x['mode'].lower() or 'tube' in x['mode'].lower() or x['mode'] == 'rail' else 1,
-        -x['line_count']
-    ))
+# Points and their lines are static, so the first snapshot's tables serve
+STOP_SEARCH = StopSearch(snapshot.current().stops, snapshot.current().lines)
 
-    for r in results:
-        r.pop('line_count', None)
+@app.route('/api/search', methods=['GET'])
+def search_stops():
+    return jsonify(STOP_SEARCH.search(request.args.get('q', '')))
+
+def plan_route(live, data, origin, destination, departure_time, window):
+    # (payload, status, path): path is the journey whose segments still need
+    # add_geometries(), or None once the payload is final. window is the
+    # parse_window() minutes
+    raptor = live.engine
+    stats = {}
+    if window:
+        results = raptor.route_range(origin, destination, departure_time, window * 60, max_rounds=5, stats=stats)
+    else:
+        results = raptor.route(origin, destination, departure_time, max_rounds=5, stats=stats)
+    with route_stats_lock:
+        for name in ROUTE_STATS_KEYS:
+            route_stats[name] += stats[name]
+    
+    if not results:
+        return {'error': 'No route found'}, 404, None
+    
+    if data.get('summary'):
+        # every Pareto option without coordinates; the frontend fetches
+        # /api/route/<journey_id>/geometry for the one it draws
+        return {
+            'journeys': [get_journey_summary(live, journey) for journey in results],
+            'snapshot': live.info(),
+        }, 200, None
     
-    return jsonify(results[:20])
+    best = min(results, key=lambda x: (x['num_legs'], x['arrival_time']))
+    return {
+        'journey_time': best['journey_time'],
+        'journey_minutes': best['journey_time'] // 60,
+        'num_legs': best['num_legs'],
+        'arrival_time': best['arrival_time'],
+        'departure_time': best['departure_time'],
+        'segments': describe_segments(live, best['path']),
+        'snapshot': live.info(),
+        'departures': [{
+            'departure_time': journey['departure_time'],
+            'arrival_time': journey['arrival_time'],
+            'journey_time': journey['journey_time'],
+            'num_legs': journey['num_legs'],
+            'routes': [segment['route'] for segment in journey['path'] if segment['type'] == 'trip']
+        } for journey in results] if window else []
+    }, 200, best['path']
+
+def add_geometries(payload, geometries):
+    # Leg times follow the geometry's durations from the journey's departure
+    current_time = payload['departure_time']
+    for seg_data, linestring_data in zip(payload['segments'], geometries):
+        seg_data['start_time'] = current_time
+        seg_data['end_time'] = current_time
+        current_time += linestring_data['duration']
+        seg_data['coordinates'] = linestring_data['coordinates']
+        seg_data['duration'] = linestring_data['duration']
+        seg_data['distance'] = linestring_data['distance']
+
+def route_departure(departure_time):
+    # Requests are routed from the end of their minute, so the answer shared
+    # by everyone asking within that minute never boards a vehicle that left
+    # before one of them asked
+    return -(-departure_time // 60) * 60
+
+def route_cache_key(data, origin, destination, departure_time, window, live):
+    # departure_time is a route_departure() minute
+    return (origin, destination, departure_time, window, bool(data.get('summary')), live.version)
 
 @app.route('/api/route', methods=['POST'])
 def route():
@@ -473,163 +420,57 @@ def route():
     if not origin or not destination:
         return jsonify({'error': 'Missing origin or destination'}), 400
     
-    departure_time = int(time.time())
+    try:
+        departure_time = route_departure(parse_departure_time(data.get('departure_time')))
+    except ValueError:
+        return jsonify({'error': f'departure_time must be a unix time within {MAX_DEPARTURE_OFFSET}s of now'}), 400
+    try:
+        window = parse_window(data.get('window'))
+    except ValueError:
+        return jsonify({'error': f'window must be a number of minutes up to {MAX_WINDOW}'}), 400
+    # hold one snapshot for the whole request; reloads swap in a new one
+    live = snapshot.current()
+    
+    key = route_cache_key(data, origin, destination, departure_time, window, live)
+    cached = ROUTE_CACHE.get(key)
+    if cached is not None:
+        payload, status = cached
+        if 'snapshot' in payload:
+            payload = dict(payload, snapshot=live.info())
+        return jsonify(payload), status
     
     try:
-        results = raptor.route(origin, destination, departure_time, max_rounds=5)
-        
-        if not results:
-            return jsonify({'error': 'No route found'}), 404
-        
-        best = results[0]
-        current_time = departure_time
-        segments = []
-        
-        for segment in best['path']:
-            seg_data = {
-                'type': segment['type'],
-                'from': segment['from_name'],
-                'to': segment['to_name'],
-                'from_id': segment['from'],
-                'to_id': segment['to'],
-                'start_time': current_time
-            }
-            
-            if segment['type'] != 'walk':
-                seg_data['route'] = segment['route']
-                seg_data['vehicle'] = segment.get('vehicle', '')
-                
-                route_id = segment['route']
-                origin_stop_id = segment['from']
-                dest_stop_id = segment['to']
-
-                origin_mode = None
-                dest_mode = None
-                try:
-                    origin_stop = Point.get(Point.point_id == origin_stop_id)
-                    origin_mode = origin_stop.mode
-                except:
-                    pass
-                try:
-                    dest_stop = Point.get(Point.point_id == dest_stop_id)
-                    dest_mode = dest_stop.mode
-                except:
-                    pass
-
-                if origin_mode == 'bus' or dest_mode == 'bus':
-                    seg_data['mode'] = 'bus'
-                    seg_data['line_color'] = '#ef4444'
-                    print(f"Route: {route_id}, Set mode to: {seg_data['mode']} (bus stops)")
-                elif origin_mode in ['tube', 'underground'] or dest_mode in ['tube', 'underground']:
-                    tube_name, tube_color = get_tube_line_info(route_id)
-                    if tube_name:
-                        seg_data['mode'] = 'tube'
-                        seg_data['tube_line'] = tube_name
-                        seg_data['line_color'] = tube_color
-                        print(f"Route: {route_id}, Set mode to: {seg_data['mode']} (tube stops)")
-                    else:
-                        seg_data['mode'] = 'bus'
-                        seg_data['line_color'] = '#ef4444'
-                        print(f"Route: {route_id}, Set mode to: {seg_data['mode']} (bus fallback)")
-                elif (origin_mode == 'rail' or dest_mode == 'rail') and route_id in RAIL_ROUTES:
-                    rail_name, rail_color = get_rail_line_info(route_id)
-                    seg_data['mode'] = 'rail'
-                    seg_data['rail_line'] = rail_name or route_id
-                    seg_data['line_color'] = rail_color
-                    vehicleId = segment.get('vehicle', '')
-                    platformId = f"{vehicleId}/{origin_stop_id}"
-                    print(f"Platform ID: {platformId}")
-                    if platformId in PLATFORMS:
-                        seg_data['platform'] = PLATFORMS[platformId]
-                    else:
-                        seg_data['platform'] = '?'
-                    print(f"Route: {route_id}, Set mode to: {seg_data['mode']} (rail stops)")
-                else:
-                    tube_name, tube_color = get_tube_line_info(route_id)
-                    if tube_name:
-                        seg_data['mode'] = 'tube'
-                        seg_data['tube_line'] = tube_name
-                        seg_data['line_color'] = tube_color
-                    else:
-                        rail_name, rail_color = get_rail_line_info(route_id)
-                        if rail_name:
-                            seg_data['mode'] = 'rail'
-                            seg_data['rail_line'] = rail_name
-                            seg_data['line_color'] = rail_color
-                        else:
-                            seg_data['mode'] = 'bus'
-                            seg_data['line_color'] = '#ef4444'
-
-                print(f"Route: {route_id}, Final mode: {seg_data['mode']}, Color: {seg_data['line_color']}")
-                
-                try:
-                    trip_stops = raptor.get_trip_stops(segment['route'], segment['vehicle'])
-                    
-                    board_idx = None
-                    alight_idx = None
-                    for idx, (stop_id, arrival_time) in enumerate(trip_stops):
-                        if stop_id == segment['from']:
-                            board_idx = idx
-                        if stop_id == segment['to']:
-                            alight_idx = idx
-                    
-                    if board_idx is not None and alight_idx is not None:
-                        if board_idx < alight_idx:
-                            stops_segment = trip_stops[board_idx:alight_idx + 1]
-                        else:
-                            stops_segment = trip_stops[alight_idx:board_idx + 1]
-                            stops_segment.reverse()
-                        
-                        stops_list = []
-                        for stop_id, arrival_time in stops_segment:
-                            stops_list.append({
-                                'id': stop_id,
-                                'name': raptor.get_stop_name(stop_id),
-                                'time': arrival_time
-                            })
-                        
-                        seg_data['stops'] = stops_list
-                except Exception as e:
-                    print(f"Error getting intermediate stops: {e}")
-            
-            seg_data['end_time'] = current_time
-            if "stops" in seg_data:
-                linestring_data = get_linestring_for_segment(segment, seg_data['stops'])
-            else:
-                print(f"STOPS NOT IN DATA")
-                linestring_data = get_linestring_for_segment(segment, [])
-            current_time += linestring_data['duration']
-            seg_data['coordinates'] = linestring_data['coordinates']
-            seg_data['duration'] = linestring_data['duration']
-            seg_data['distance'] = linestring_data['distance']
-            segments.append(seg_data)
-
-        return jsonify({
-            'journey_time': best['journey_time'],
-            'journey_minutes': best['journey_time'] // 60,
-            'num_legs': best['num_legs'],
-            'arrival_time': best['arrival_time'],
-            'departure_time': departure_time,
-            'segments': segments
-        })
-        
+        payload, status, path = plan_route(live, data, origin, destination, departure_time, window)
+        cacheable = True
+        if path is not None:
+            geometries, cacheable = get_segment_geometries(
+                path, [seg_data.get('stops', []) for seg_data in payload['segments']], live.rail_routes)
+            add_geometries(payload, geometries)
     except Exception as e:
         print(f"Routing error: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
-def run_periodic():
-    while True:
-        print(f"Reloading live data")
-        reloadLiveData()
-        time.sleep(30)
+    
+    # only complete answers are stored, not degraded geometry or "No route found"
+    if cacheable and status == 200:
+        ROUTE_CACHE.put(key, (payload, status))
+    return jsonify(payload), status
 
-def start_background_thread():
-    def run():
-        thread = threading.Thread(target=run_periodic, daemon=True)
-        thread.start()
-        print("Background thread started.")
-    threading.Thread(target=run, daemon=True).start()
+@app.route('/api/route/<journey_id>/geometry', methods=['GET'])
+def route_geometry(journey_id):
+    try:
+        path = decode_journey_id(journey_id)
+    except INVALID_JOURNEY_ID:
+        return jsonify({'error': 'Invalid journey id'}), 400
+    
+    live = snapshot.current()
+    geometries, complete = get_segment_geometries(path, [[] for _ in path], live.rail_routes)
+    response = jsonify({'segments': geometries})
+    # the same legs always have the same geometry, unless some of it was
+    # replaced by straight lines this time
+    response.headers['Cache-Control'] = 'public, max-age=3600' if complete else 'no-store'
+    return response
 
 if __name__ == '__main__':
     print("Full Routing API")
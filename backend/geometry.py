@@ -0,0 +1,60 @@
+# NumPy geometry kernels over [lon, lat] coordinates.
+#
+# Every function accepts scalars or arrays and broadcasts, so callers
+# measure or filter whole coordinate arrays in one call instead of looping
+# in Python.
+from typing import Tuple
+
+import numpy as np
+
+EARTH_RADIUS = 6371000
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    # Great-circle distance in metres.
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def distance(coord1: Tuple[float, float], coord2: Tuple[float, float]) -> float:
+    return float(haversine(coord1[0], coord1[1], coord2[0], coord2[1]))
+
+
+def project_onto_polyline(coords: np.ndarray, point: Tuple[float, float]) -> Tuple[int, np.ndarray, float]:
+    # Closest point of an (n, 2) polyline to `point`: (segment index,
+    # projected [lon, lat], distance in metres). Each segment is projected in
+    # lon/lat space and the projections are compared by haversine distance;
+    # the first of equally close segments wins.
+    start = coords[:-1]
+    delta = coords[1:] - start
+    length_sq = (delta ** 2).sum(axis=1)
+    offset = np.asarray(point) - start
+    t = np.divide((offset * delta).sum(axis=1), length_sq, out=np.zeros_like(length_sq), where=length_sq != 0)
+    projections = start + np.clip(t, 0, 1)[:, None] * delta
+    distances = haversine(point[0], point[1], projections[:, 0], projections[:, 1])
+    segment = int(np.argmin(distances))
+    return segment, projections[segment], float(distances[segment])
+
+
+def in_bbox(lons, lats, min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+    # Mask of the coordinates strictly inside the box.
+    return (lons > min_lon) & (lons < max_lon) & (lats > min_lat) & (lats < max_lat)
+
+
+class BoxIndex:
+    # Coordinates sorted by latitude, so a box query bisects to the latitude
+    # band and masks longitudes only inside it.
+
+    def __init__(self, lons: np.ndarray, lats: np.ndarray):
+        self.order = np.argsort(lats, kind='stable')
+        self.lats = lats[self.order]
+        self.lons = lons[self.order]
+
+    def query(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> np.ndarray:
+        # Indices (into the original arrays) strictly inside the box, in
+        # original order.
+        lo = np.searchsorted(self.lats, min_lat, side='right')
+        hi = np.searchsorted(self.lats, max_lat, side='left')
+        mask = in_bbox(self.lons[lo:hi], self.lats[lo:hi], min_lon, min_lat, max_lon, max_lat)
+        return np.sort(self.order[lo:hi][mask])
@@ -0,0 +1,135 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterator, List, Tuple
+
+ORIGIN = -2
+WALK = -1
+
+
+class LabelStore:
+    # Append-only McRAPTOR labels with stable integer ids.
+    #
+    # Every label is one slot across the parallel arrays below, and `parent`
+    # is the back-pointer table used to rebuild journeys. Labels are never
+    # moved or deleted, only dropped from their stop's bag, so ids held by
+    # other labels stay valid. A bag is the Pareto set at one stop kept sorted
+    # by legs; in a Pareto set of (arrival time, legs) times then strictly
+    # decrease, so dominance is decided by the single neighbour found with a
+    # bisect on legs.
+    #
+    # Each stop has two bags, as in RAPTOR: labels that arrived by vehicle
+    # (or the origin) and labels that arrived on foot. Footpaths are
+    # transitively closed, so only the first kind may walk on. A walk label
+    # therefore never drops a vehicle label, while a vehicle label at least as
+    # good drops walk labels too.
+    __slots__ = ('stop', 'time', 'legs', 'parent', 'route', 'trip', 'board_time', 'distance',
+                 '_bag_legs', '_bag_ids', '_walk_legs', '_walk_ids')
+
+    def __init__(self):
+        self.stop = array('i')
+        self.time = array('q')
+        self.legs = array('i')
+        self.parent = array('i')
+        self.route = array('i')       # route index, WALK or ORIGIN
+        self.trip = array('q')        # global trip index, -1 for walks
+        self.board_time = array('q')  # boarding time for trips, walk seconds for walks
+        self.distance = array('d')    # estimated walk distance in metres
+        self._bag_legs: Dict[int, List[int]] = {}
+        self._bag_ids: Dict[int, List[int]] = {}
+        self._walk_legs: Dict[int, List[int]] = {}
+        self._walk_ids: Dict[int, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def _best_in(self, bags_legs: Dict[int, List[int]], bags_ids: Dict[int, List[int]], stop: int,
+                 max_legs: int) -> int:
+        bag_legs = bags_legs.get(stop)
+        if not bag_legs:
+            return -1
+        i = bisect_right(bag_legs, max_legs)
+        return bags_ids[stop][i - 1] if i > 0 else -1
+
+    def _drop_dominated(self, bag_legs: List[int], bag_ids: List[int], time: int, legs: int) -> Tuple[int, int]:
+        # labels with at least as many legs and no earlier arrival form a
+        # contiguous run starting at the insert point; returns that run
+        start = bisect_left(bag_legs, legs)
+        end = start
+        while end < len(bag_ids) and self.time[bag_ids[end]] >= time:
+            end += 1
+        return start, end
+
+    def is_dominated(self, stop: int, time: int, legs: int, walk: bool = False) -> bool:
+        label_id = self._best_in(self._bag_legs, self._bag_ids, stop, legs)
+        if label_id >= 0 and self.time[label_id] <= time:
+            return True
+        if walk:
+            label_id = self._best_in(self._walk_legs, self._walk_ids, stop, legs)
+            return label_id >= 0 and self.time[label_id] <= time
+        return False
+
+    def add(self, stop: int, time: int, legs: int, parent: int = -1, route: int = ORIGIN,
+            trip: int = -1, board_time: int = 0, distance: float = 0.0) -> int:
+        # Returns the new label id, or -1 if an existing label at the stop is
+        # at least as good on both criteria.
+        walk = route == WALK
+        if self.is_dominated(stop, time, legs, walk):
+            return -1
+
+        label_id = len(self.time)
+        self.stop.append(stop)
+        self.time.append(time)
+        self.legs.append(legs)
+        self.parent.append(parent)
+        self.route.append(route)
+        self.trip.append(trip)
+        self.board_time.append(board_time)
+        self.distance.append(distance)
+
+        if not walk and stop in self._walk_legs:
+            walk_legs, walk_ids = self._walk_legs[stop], self._walk_ids[stop]
+            start, end = self._drop_dominated(walk_legs, walk_ids, time, legs)
+            del walk_legs[start:end], walk_ids[start:end]
+        bags_legs, bags_ids = (self._walk_legs, self._walk_ids) if walk else (self._bag_legs, self._bag_ids)
+        bag_legs = bags_legs.setdefault(stop, [])
+        bag_ids = bags_ids.setdefault(stop, [])
+        start, end = self._drop_dominated(bag_legs, bag_ids, time, legs)
+        bag_legs[start:end] = [legs]
+        bag_ids[start:end] = [label_id]
+        return label_id
+
+    def best(self, stop: int, max_legs: int, walks: bool = True) -> int:
+        # Earliest-arriving label at the stop using at most max_legs, or -1;
+        # with walks=False only labels that arrived by vehicle or the origin.
+        label_id = self._best_in(self._bag_legs, self._bag_ids, stop, max_legs)
+        if walks:
+            walk_id = self._best_in(self._walk_legs, self._walk_ids, stop, max_legs)
+            if walk_id >= 0 and (label_id < 0 or self.time[walk_id] < self.time[label_id]):
+                return walk_id
+        return label_id
+
+    def bag(self, stop: int) -> List[int]:
+        # The Pareto set over both bags, by legs; a vehicle label wins a tie.
+        labels = sorted(self._bag_ids.get(stop, []) + self._walk_ids.get(stop, []),
+                        key=lambda label_id: (self.legs[label_id], self.time[label_id],
+                                              self.route[label_id] == WALK))
+        pareto = []
+        for label_id in labels:
+            if not pareto or self.time[label_id] < self.time[pareto[-1]]:
+                pareto.append(label_id)
+        return pareto
+
+    def bags(self) -> Iterator[Tuple[int, List[int]]]:
+        for stop in [*self._bag_ids, *(stop for stop in self._walk_ids if stop not in self._bag_ids)]:
+            bag = self.bag(stop)
+            if bag:
+                yield stop, bag
+
+    def chain(self, label_id: int) -> List[int]:
+        # Label ids from the journey's root to label_id, following back-pointers.
+        ids = []
+        while label_id >= 0:
+            ids.append(label_id)
+            label_id = self.parent[label_id]
+        ids.reverse()
+        return ids
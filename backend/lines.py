@@ -0,0 +1,202 @@
+# Line badges and display metadata, materialised once per snapshot.
+#
+# Per stop: the badges /api/search shows, derived from the Connection table
+# and the modes of the stops each line runs to. Per live route: the tube and
+# rail display names and colours the /api/route segments use. Both are stored
+# as flat arrays and string tables in the snapshot segment, so every worker
+# answers with dict lookups instead of recomputing names and colours per
+# request.
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from data import Connection
+from stops import StopTable
+
+TUBE_COLORS = {
+    'bakerloo': '#B36305',
+    'central': '#E32017',
+    'circle': '#FFD300',
+    'district': '#00782A',
+    'hammersmith-city': '#F3A9BB',
+    'jubilee': '#A0A5A9',
+    'metropolitan': '#9B0056',
+    'northern': '#000000',
+    'piccadilly': '#003688',
+    'victoria': '#0098D4',
+    'waterloo-city': '#95CDBA',
+}
+
+RAIL_COLORS = {
+    'Southeastern': '#1E1E50',
+    'Southern': '#003F2E',
+    'Thameslink': '#E9418B',
+    'London Overground': '#EE7C0E',
+    'Elizabeth Line': '#6E4C9F',
+}
+
+BUS_COLOR = '#ef4444'
+RAIL_COLOR = '#3b82f6'
+TUBE_MODES = ('tube', 'underground')
+BUS_STYLE = {'mode': 'bus', 'line_color': BUS_COLOR}
+
+
+def tube_line_info(route_id: str) -> Tuple[Optional[str], Optional[str]]:
+    route_lower = route_id.lower()
+    if route_lower in TUBE_COLORS:
+        return route_lower.replace('-', ' ').title(), TUBE_COLORS[route_lower]
+    return None, None
+
+
+def rail_line_info(route_id: str, stops: StopTable) -> Tuple[str, str]:
+    # Rail routes are "<operator>/<destination CRS>"
+    parts = route_id.split("/")
+    if len(parts) > 1:
+        return parts[0] + "/" + stops.name(parts[1]), RAIL_COLORS.get(parts[0], RAIL_COLOR)
+    return route_id, RAIL_COLOR
+
+
+def line_badge(line_id: str, connection_modes: Set[str], stop_mode: Optional[str], stops: StopTable) -> Optional[dict]:
+    # Badge for one line at a stop, from the modes of the stops it runs to.
+    bus_badge = {'id': line_id.upper(), 'name': line_id.upper(), 'color': BUS_COLOR, 'type': 'bus'}
+    if connection_modes:
+        if 'bus' in connection_modes:
+            return bus_badge
+        elif 'rail' in connection_modes:
+            rail_name, rail_color = rail_line_info(line_id, stops)
+            return {'id': line_id, 'name': rail_name or line_id, 'color': rail_color, 'type': 'rail'}
+        elif 'tube' in connection_modes or 'underground' in connection_modes:
+            line_name, line_color = tube_line_info(line_id)
+            if line_name:
+                return {'id': line_id, 'name': line_name, 'color': line_color, 'type': 'tube'}
+        return bus_badge
+
+    line_name, line_color = tube_line_info(line_id)
+    if line_name:
+        return {'id': line_id, 'name': line_name, 'color': line_color, 'type': 'tube'}
+    rail_name, rail_color = rail_line_info(line_id, stops)
+    if rail_name:
+        return {'id': line_id, 'name': rail_name, 'color': rail_color, 'type': 'rail'}
+    if stop_mode == "bus":
+        return bus_badge
+    if stop_mode == "rail":
+        return {'id': line_id.upper(), 'name': line_id.upper(), 'color': RAIL_COLOR, 'type': 'rail'}
+    return None
+
+
+@lru_cache(maxsize=1)
+def _stop_badges(stops: StopTable) -> Tuple[List[tuple], np.ndarray, np.ndarray, np.ndarray]:
+    # The Connection and Point tables only change offline, so this runs once
+    # per process: distinct badges, then per stop row a CSR list of badge
+    # indices and the number of lines.
+    line_modes: Dict[int, Dict[str, Set[str]]] = {}
+    for conn in Connection.select(Connection.origin_point_id, Connection.destination_point_id, Connection.line_id):
+        stop = stops.index.get(conn.origin_point_id)
+        if stop is None:
+            continue
+        modes = line_modes.setdefault(stop, {}).setdefault(conn.line_id, set())
+        dest_mode = stops.mode(conn.destination_point_id)
+        if dest_mode is not None:
+            modes.add(dest_mode)
+
+    badge_index = {}
+    counts = np.zeros(len(stops), dtype=np.int64)
+    line_counts = np.zeros(len(stops), dtype=np.int32)
+    stop_badges = []
+    for stop in range(len(stops)):
+        lines = line_modes.get(stop, {})
+        line_counts[stop] = len(lines)
+        stop_mode = stops.mode(stops.ids[stop])
+        for line_id in sorted(lines):
+            badge = line_badge(line_id, lines[line_id], stop_mode, stops)
+            if badge is not None:
+                key = (badge['id'], badge['name'], badge['color'], badge['type'])
+                stop_badges.append(badge_index.setdefault(key, len(badge_index)))
+                counts[stop] += 1
+
+    offsets = np.zeros(len(stops) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return list(badge_index), offsets, np.array(stop_badges, dtype=np.int32), line_counts
+
+
+class LineTable:
+    def __init__(self, arrays: Dict[str, np.ndarray], strings: Dict[str, List[str]], stops: StopTable):
+        self.arrays = arrays
+        self.strings = strings
+        self.stops = stops
+        self.badge_table = [
+            {'id': badge_id, 'name': name, 'color': color, 'type': badge_type}
+            for badge_id, name, color, badge_type in zip(strings['badge_ids'], strings['badge_names'],
+                                                        strings['badge_colors'], strings['badge_types'])
+        ]
+        self._badge_offsets = memoryview(arrays['stop_badge_offsets'])
+        self._stop_badges = arrays['stop_badges']
+        self._line_counts = memoryview(arrays['stop_line_counts'])
+
+        # route id -> (tube style or None, rail style, is a live rail route)
+        self._routes = {}
+        for route_id, tube_name, tube_color, rail_name, rail_color, is_rail in zip(
+                strings['route_ids'], strings['route_tube_names'], strings['route_tube_colors'],
+                strings['route_rail_names'], strings['route_rail_colors'], arrays['route_is_rail'].tolist()):
+            tube = {'mode': 'tube', 'tube_line': tube_name, 'line_color': tube_color} if tube_name else None
+            rail = {'mode': 'rail', 'rail_line': rail_name, 'line_color': rail_color}
+            self._routes[route_id] = (tube, rail, bool(is_rail))
+
+    @classmethod
+    def build(cls, stops: StopTable, route_ids: Iterable[str], rail_routes: Set[str]) -> 'LineTable':
+        badges, offsets, stop_badges, line_counts = _stop_badges(stops)
+        route_ids = sorted(set(route_ids))
+        tube = [tube_line_info(route_id) for route_id in route_ids]
+        rail = [rail_line_info(route_id, stops) for route_id in route_ids]
+        arrays = {
+            'stop_badge_offsets': offsets,
+            'stop_badges': stop_badges,
+            'stop_line_counts': line_counts,
+            'route_is_rail': np.array([route_id in rail_routes for route_id in route_ids], dtype=np.uint8),
+        }
+        strings = {
+            'badge_ids': [badge[0] for badge in badges],
+            'badge_names': [badge[1] for badge in badges],
+            'badge_colors': [badge[2] for badge in badges],
+            'badge_types': [badge[3] for badge in badges],
+            'route_ids': route_ids,
+            'route_tube_names': [name or '' for name, _ in tube],
+            'route_tube_colors': [color or '' for _, color in tube],
+            'route_rail_names': [name for name, _ in rail],
+            'route_rail_colors': [color for _, color in rail],
+        }
+        return cls(arrays, strings, stops)
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, List[str]]]:
+        return self.arrays, self.strings
+
+    def badges(self, stop_id: str) -> List[dict]:
+        stop = self.stops.index.get(stop_id)
+        if stop is None:
+            return []
+        start, end = self._badge_offsets[stop], self._badge_offsets[stop + 1]
+        return [self.badge_table[badge] for badge in self._stop_badges[start:end].tolist()]
+
+    def line_count(self, stop_id: str) -> int:
+        stop = self.stops.index.get(stop_id)
+        return self._line_counts[stop] if stop is not None else 0
+
+    def segment_style(self, route_id: str, origin_mode: Optional[str], dest_mode: Optional[str]) -> Tuple[dict, bool]:
+        # Display fields for a trip segment, and whether it shows a platform.
+        # Stop modes decide first; the route's own line decides otherwise.
+        route = self._routes.get(route_id)
+        if route is None:
+            rail_name, rail_color = rail_line_info(route_id, self.stops)
+            tube_name, tube_color = tube_line_info(route_id)
+            tube = {'mode': 'tube', 'tube_line': tube_name, 'line_color': tube_color} if tube_name else None
+            route = (tube, {'mode': 'rail', 'rail_line': rail_name, 'line_color': rail_color}, False)
+        tube, rail, is_rail = route
+
+        if origin_mode == 'bus' or dest_mode == 'bus':
+            return BUS_STYLE, False
+        if origin_mode in TUBE_MODES or dest_mode in TUBE_MODES:
+            return tube or BUS_STYLE, False
+        if (origin_mode == 'rail' or dest_mode == 'rail') and is_rail:
+            return rail, True
+        return tube or rail, False
@@ -0,0 +1,168 @@
+# Route geometry for trip legs.
+#
+# linestrings.json holds one polyline per bus route as a JSON string. The
+# store keeps every polyline in one (n, 2) array of [lon, lat] rows and, per
+# route, where each of its stops projects onto the line: the closest segment,
+# the projected point, and the vertex that point coincides with, if any. The
+# projections are computed offline for every stop Connection lists on the
+# route (and memoised at runtime for any other stop), so cutting a leg out of
+# a route is a lookup and an array slice.
+import json
+import os
+import sys
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from geometry import haversine, project_onto_polyline
+from shared_snapshot import map_segment, write_segment
+
+# a projection within this many metres of a vertex is that vertex
+VERTEX_TOLERANCE = 0.001
+
+
+def project_stop(coords: np.ndarray, point: Tuple[float, float]) -> Tuple[int, int, Tuple[float, float]]:
+    # (closest segment, coinciding vertex or -1, projected [lon, lat]) for a
+    # point against a polyline; the last vertex within VERTEX_TOLERANCE
+    # counts as coinciding.
+    segment, projection, _ = project_onto_polyline(coords, point)
+    close = np.flatnonzero(haversine(coords[:, 0], coords[:, 1], projection[0], projection[1]) < VERTEX_TOLERANCE)
+    vertex = int(close[-1]) if len(close) else -1
+    return segment, vertex, (float(projection[0]), float(projection[1]))
+
+
+class LinestringStore:
+    def __init__(self, arrays: Dict[str, np.ndarray], strings: Dict[str, List[str]]):
+        self.arrays = arrays
+        self.strings = strings
+        self.coords = arrays['coords']
+        offsets = arrays['route_offsets'].tolist()
+        self.routes = {route_id: (offsets[i], offsets[i + 1]) for i, route_id in enumerate(strings['route_ids'])}
+
+        # (route_id, stop_id) -> (segment, vertex, projection)
+        self.projections: Dict[Tuple[str, str], Tuple[int, int, Tuple[float, float]]] = {}
+        stop_offsets = arrays['projection_offsets'].tolist()
+        segments = arrays['projection_segments'].tolist()
+        vertices = arrays['projection_vertices'].tolist()
+        points = arrays['projection_points'].tolist()
+        stop_ids = strings['projection_stop_ids']
+        for i, route_id in enumerate(strings['route_ids']):
+            for row in range(stop_offsets[i], stop_offsets[i + 1]):
+                self.projections[(route_id, stop_ids[row])] = (segments[row], vertices[row], tuple(points[row]))
+
+    @classmethod
+    def build(cls, linestrings: dict, route_stops: Dict[str, Dict[str, Tuple[float, float]]]) -> 'LinestringStore':
+        # `linestrings` is the linestrings.json layout; route_stops gives the
+        # stops (id -> (lon, lat)) to precompute for each route.
+        route_ids, coords, route_offsets = [], [], [0]
+        stop_ids, segments, vertices, points, projection_offsets = [], [], [], [], [0]
+        for route_id, linestring in linestrings.items():
+            if not linestring:
+                continue
+            if isinstance(linestring, str):
+                linestring = json.loads(linestring)
+            line = np.array(linestring[0], dtype=np.float64).reshape(-1, 2)
+            if len(line) < 2:
+                continue
+            route_ids.append(route_id)
+            coords.append(line)
+            route_offsets.append(route_offsets[-1] + len(line))
+            for stop_id, point in route_stops.get(route_id, {}).items():
+                segment, vertex, projection = project_stop(line, point)
+                stop_ids.append(stop_id)
+                segments.append(segment)
+                vertices.append(vertex)
+                points.append(projection)
+            projection_offsets.append(len(stop_ids))
+
+        arrays = {
+            'coords': np.concatenate(coords) if coords else np.zeros((0, 2)),
+            'route_offsets': np.array(route_offsets, dtype=np.int64),
+            'projection_offsets': np.array(projection_offsets, dtype=np.int64),
+            'projection_segments': np.array(segments, dtype=np.int32),
+            'projection_vertices': np.array(vertices, dtype=np.int32),
+            'projection_points': np.array(points, dtype=np.float64).reshape(-1, 2),
+        }
+        return cls(arrays, {'route_ids': route_ids, 'projection_stop_ids': stop_ids})
+
+    def save(self, path: str):
+        write_segment(path, self.arrays, self.strings)
+
+    @classmethod
+    def load(cls, path: str) -> 'LinestringStore':
+        arrays, strings, _ = map_segment(path)
+        return cls(arrays, strings)
+
+    def __contains__(self, route_id: str) -> bool:
+        return route_id in self.routes
+
+    def _projection(self, route_id: str, stop_id: str, point: Tuple[float, float]):
+        projection = self.projections.get((route_id, stop_id))
+        if projection is None:
+            start, end = self.routes[route_id]
+            projection = self.projections[(route_id, stop_id)] = project_stop(self.coords[start:end], point)
+        return projection
+
+    def extract(self, route_id: str, origin_id: str, dest_id: str,
+                origin_coord: Tuple[float, float], dest_coord: Tuple[float, float]) -> List[List[float]]:
+        # The route's geometry between two stops as [lat, lon] points, from
+        # the origin's projection to the destination's.
+        start, end = self.routes[route_id]
+        origin_segment, origin_vertex, origin_point = self._projection(route_id, origin_id, origin_coord)
+        dest_segment, dest_vertex, dest_point = self._projection(route_id, dest_id, dest_coord)
+
+        # cut at the coinciding vertices, or else at the far end of each
+        # projection's segment
+        if origin_vertex < 0 or dest_vertex < 0:
+            last = end - start - 1
+            origin_vertex = min(origin_segment + 1, last)
+            dest_vertex = min(dest_segment + 1, last)
+
+        if origin_vertex <= dest_vertex:
+            partial = self.coords[start + origin_vertex:start + dest_vertex + 1]
+        else:
+            partial = self.coords[start + dest_vertex:start + origin_vertex + 1][::-1]
+        result = partial[:, ::-1].tolist()
+        result[0] = [origin_point[1], origin_point[0]]
+        result[-1] = [dest_point[1], dest_point[0]]
+        return result
+
+
+def route_stops_from_connections(stops) -> Dict[str, Dict[str, Tuple[float, float]]]:
+    # Stops each line serves according to the Connection table.
+    from data import Connection
+    route_stops = {}
+    for conn in Connection.select(Connection.origin_point_id, Connection.destination_point_id, Connection.line_id):
+        for stop_id in (conn.origin_point_id, conn.destination_point_id):
+            coords = stops.coords(stop_id)
+            if coords is not None:
+                route_stops.setdefault(conn.line_id, {})[stop_id] = coords
+    return route_stops
+
+
+def load_linestrings(path: str) -> LinestringStore:
+    # A missing .bin is built from the linestrings.json next to it, and saved
+    # if the directory allows.
+    if not os.path.exists(path):
+        json_path = os.path.splitext(path)[0] + '.json'
+        if not os.path.exists(json_path):
+            return LinestringStore.build({}, {})
+        from stops import load_stop_table
+        print(f"{path} not found, building it from {json_path}")
+        with open(json_path, 'r') as f:
+            store = LinestringStore.build(json.load(f), route_stops_from_connections(load_stop_table()))
+        try:
+            store.save(path)
+        except OSError as e:
+            print(f"Could not write {path} ({e}); using the built copy in memory")
+            return store
+    return LinestringStore.load(path)
+
+
+if __name__ == '__main__':
+    # python linestrings.py linestrings.json linestrings.bin
+    from stops import load_stop_table
+    with open(sys.argv[1], 'r') as f:
+        store = LinestringStore.build(json.load(f), route_stops_from_connections(load_stop_table()))
+    store.save(sys.argv[2])
+    print(f"Wrote {len(store.routes)} routes and {len(store.projections)} stop projections to {sys.argv[2]}")
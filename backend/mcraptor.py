@@ -1,222 +1,478 @@
 import json
 from collections import defaultdict
+from functools import lru_cache
 from typing import Dict, List, Tuple, Set, Optional
 import heapq
+import os
 import time
-from data import connect_db, Point
-from update_times import getArrivalsAndPlatforms
+import numpy as np
+from footpaths import FootpathGraph
+from labels import LabelStore, WALK
+from shared_snapshot import map_segment, write_segment
+from stops import StopTable, load_stop_table
+from timetable import CompiledTimetable
 
+# targets whose pruning bounds an engine keeps (see McRAPTOR._target_bounds)
+MAX_CACHED_BOUNDS = 256
+UNREACHABLE = 1 << 40
+UNREACHABLE_LEGS = 64
 
-class McRAPTOR:
-    def __init__(self, arrivaltimes: dict, walking_distances_file: str, max_walking_distance: float = 600):
-        self.timetable = arrivaltimes
+
+@lru_cache(maxsize=None)
+def _load_footpaths(walking_distances_file: str) -> FootpathGraph:
+    # Static between reloads, so it is mapped once per process. A .json path
+    # is converted in memory; a missing .bin is converted from the
+    # walking_distances.json next to it, and saved if the directory allows.
+    if walking_distances_file.endswith('.json'):
         with open(walking_distances_file, 'r') as f:
-            self.walking = json.load(f)
-        
-        self.max_walking_distance = max_walking_distance
+            return FootpathGraph.from_dict(json.load(f))
+    if not os.path.exists(walking_distances_file):
+        json_file = os.path.splitext(walking_distances_file)[0] + '.json'
+        print(f"{walking_distances_file} not found, converting {json_file} "
+              f"(run transfers.py for closed footpaths with station interchanges)")
+        with open(json_file, 'r') as f:
+            graph = FootpathGraph.from_dict(json.load(f))
         try:
-            db = connect_db()
-        except:
-            from data import db
-        self.stop_names = {}
-        for point in Point.select():
-            self.stop_names[point.point_id] = point.name
-        self.routes_at_stop = defaultdict(set)  # stop_id -> set of (route_id, vehicle_id)
+            graph.save(walking_distances_file)
+        except OSError as e:
+            print(f"Could not write {walking_distances_file} ({e}); using the converted copy in memory")
+            return graph
+    return FootpathGraph.load(walking_distances_file)
+
+
+def _section(values: dict, prefix: str) -> dict:
+    return {name[len(prefix):]: value for name, value in values.items() if name.startswith(prefix)}
+
+
+class McRAPTOR:
+    def __init__(self, arrivaltimes: dict, walking_distances_file: str, max_walking_distance: float = 600,
+                 previous: Optional['McRAPTOR'] = None):
+        # `previous` is the engine built on the last reload; its compiled
+        # timetable is patched in place rather than rebuilt, so `previous` must
+        # not be used afterwards (see CompiledTimetable).
+        footpaths = _load_footpaths(walking_distances_file)
         
-        for route_id, vehicles in self.timetable.items():
-            for vehicle_id, stops in vehicles.items():
-                for stop_id, arrival_time in stops:
-                    self.routes_at_stop[stop_id].add((route_id, vehicle_id))
+        self.max_walking_distance = max_walking_distance
+        self.stops = load_stop_table()
+        self.meta = {}
+        # footpath stops are interned first, so the graph's ids carry over and
+        # it only needs padding for stops that appear in trips alone
+        self.timetable = CompiledTimetable(arrivaltimes, extra_stops=footpaths.stop_ids,
+                                           previous=previous.timetable if previous is not None else None)
+        self.footpaths = footpaths.resized(self.timetable.num_stops)
+        self._bounds = {}
+        self._reverse = None
+
+    def publish(self, path: str, meta: Optional[dict] = None,
+                extra: Optional[Dict[str, Tuple[dict, dict]]] = None):
+        # Write the compiled timetable, footpaths and stop table to a shared
+        # segment that other processes can attach to with from_segment().
+        # `extra` adds more (arrays, strings) sections by prefix; readers get
+        # them back from section().
+        sections = {
+            'timetable.': self.timetable.to_arrays(),
+            'footpaths.': (self.footpaths.to_arrays(), {}),
+            'stops.': self.stops.to_arrays(),
+        }
+        sections.update(extra or {})
+        arrays, strings = {}, {}
+        for prefix, (section_arrays, section_strings) in sections.items():
+            arrays.update((prefix + name, arr) for name, arr in section_arrays.items())
+            strings.update((prefix + name, values) for name, values in section_strings.items())
+        write_segment(path, arrays, strings, dict(meta or {}, max_walking_distance=self.max_walking_distance))
+
+    @classmethod
+    def from_segment(cls, path: str) -> 'McRAPTOR':
+        # Zero-copy engine over a published segment; no JSON or SQLite reads.
+        arrays, strings, meta = map_segment(path)
+        self = cls.__new__(cls)
+        self.max_walking_distance = meta['max_walking_distance']
+        self.meta = meta
+        self.timetable = CompiledTimetable.from_arrays(_section(arrays, 'timetable.'), _section(strings, 'timetable.'))
+        self.footpaths = FootpathGraph.from_arrays(_section(arrays, 'footpaths.'))
+        self.stops = StopTable.from_arrays(_section(arrays, 'stops.'), _section(strings, 'stops.'))
+        self._segment = (arrays, strings)
+        self._bounds = {}
+        self._reverse = None
+        return self
+
+    def section(self, prefix: str) -> Tuple[dict, dict]:
+        # An `extra` section of the segment this engine was attached to.
+        arrays, strings = self._segment
+        return _section(arrays, prefix), _section(strings, prefix)
+
     def get_trip_stops(self, route_id: str, vehicle_id: str) -> List[Tuple[str, int]]:
-        return self.timetable[route_id][vehicle_id]
+        return self.timetable.get_trip_stops(route_id, vehicle_id)
     
     def get_walking_neighbors(self, stop_id: str) -> List[Tuple[str, float]]:
-        if stop_id not in self.walking:
+        if stop_id not in self.timetable.stop_index:
             return []
-        
-        neighbors = []
-        for neighbor_id, walk_seconds in self.walking[stop_id].items():
-            if walk_seconds <= self.max_walking_distance:
-                neighbors.append((neighbor_id, walk_seconds))
-        return neighbors
+        return [
+            (self.timetable.stop_ids[neighbor], walk_seconds)
+            for neighbor, walk_seconds in self.footpaths.walks_from(self.timetable.stop_index[stop_id], self.max_walking_distance)
+        ]
     
     def get_stop_name(self, stop_id: str) -> str:
-        return self.stop_names.get(stop_id, stop_id)
+        return self.stops.name(stop_id)
     
-    def is_pareto_dominated(self, arrival_time: int, legs: int, pareto_set: List[Tuple[int, int]]) -> bool:
-        for existing_time, existing_legs in pareto_set:
-            if existing_time <= arrival_time and existing_legs <= legs:
-                if existing_time < arrival_time or existing_legs < legs:
-                    return True
-        return False
-    
-    def add_to_pareto_set(self, arrival_time: int, legs: int, pareto_set: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
-        new_set = []
-        for existing_time, existing_legs in pareto_set:
-            if not (arrival_time <= existing_time and legs <= existing_legs and 
-                    (arrival_time < existing_time or legs < existing_legs)):
-                new_set.append((existing_time, existing_legs))
-        new_set.append((arrival_time, legs))
-        return new_set
-    
-    def route(self, origin: str, destination: str, departure_time: int, max_rounds: int = 5):
-        pareto_labels = defaultdict(list)
-        pareto_labels[origin] = [(departure_time, 0)]
-        
-        paths = defaultdict(dict)
-        paths[origin][0] = None
-        
-        marked_stops = {origin}
-        for neighbor, walking_time_seconds in self.get_walking_neighbors(origin):
+    def _add_label(self, labels: LabelStore, stop: int, arrival_time: int, legs: int, target: int,
+                   bounds: Optional[tuple], stats: dict, **leg) -> int:
+        # Local pruning: the stop's bag already holds tau_k, the best arrival
+        # using at most k legs, so a dominated label is rejected by a bisect.
+        # Target pruning (when `bounds` from _target_bounds are given): a label
+        # that, even at the bounds, can't beat the destination's best arrival
+        # with as many legs can only lead to dominated journeys.
+        if labels.is_dominated(stop, arrival_time, legs, walk=leg.get('route') == WALK):
+            stats['pruned_local'] += 1
+            return -1
+        if bounds is not None and self._beaten_at_target(labels, target, bounds, stop, arrival_time, legs):
+            stats['pruned_target'] += 1
+            return -1
+        stats['labels_created'] += 1
+        return labels.add(stop, arrival_time, legs, **leg)
+
+    def _beaten_at_target(self, labels: LabelStore, target: int, bounds: tuple, stop: int,
+                          arrival_time: int, legs: int) -> bool:
+        min_times, min_legs, max_rounds = bounds
+        legs += min_legs[stop]
+        if legs > max_rounds:
+            return True
+        target_label = labels.best(target, legs)
+        return target_label >= 0 and arrival_time + min_times[stop] >= labels.time[target_label]
+
+    def _target_bounds(self, target: int, max_rounds: int) -> tuple:
+        # Lower bounds from every stop to the target: the time it takes at
+        # each route's quickest hops plus walking, and the fewest vehicles
+        # needed. Walks are free to chain here, which only loosens the bounds.
+        # Computed once per target for the life of the engine.
+        if target not in self._bounds:
+            if len(self._bounds) >= MAX_CACHED_BOUNDS:
+                self._bounds.pop(next(iter(self._bounds), None), None)
+            self._bounds[target] = (self._min_times_to(target), self._min_legs_to(target))
+        min_times, min_legs = self._bounds[target]
+        return min_times, min_legs, max_rounds
+
+    def _reverse_graph(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Ride hops and footpaths by the stop they lead to, in CSR form:
+        # edges into stop s are sources[offsets[s]:offsets[s + 1]].
+        if self._reverse is None:
+            tt = self.timetable
+            ride_from, ride_to, ride_times = tt.ride_hops()
+            walk_from, walk_to, walk_times = self._walk_edges()
+            sources = np.concatenate([ride_from, walk_from])
+            targets = np.concatenate([ride_to, walk_to])
+            durations = np.concatenate([ride_times, walk_times.astype(np.int64)])
+            order = np.argsort(targets, kind='stable')
+            offsets = np.zeros(tt.num_stops + 1, dtype=np.int64)
+            np.cumsum(np.bincount(targets, minlength=tt.num_stops), out=offsets[1:])
+            self._reverse = (offsets.tolist(), sources[order].tolist(), durations[order].tolist())
+        return self._reverse
+
+    def _walk_edges(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        fp = self.footpaths
+        walk_from = np.repeat(np.arange(len(fp.offsets) - 1, dtype=np.int32), np.diff(fp.offsets))
+        within = fp.durations <= self.max_walking_distance
+        return walk_from[within], fp.neighbors[within], fp.durations[within]
+
+    def _min_times_to(self, target: int) -> List[int]:
+        offsets, sources, durations = self._reverse_graph()
+        min_times = [UNREACHABLE] * self.timetable.num_stops
+        min_times[target] = 0
+        queue = [(0, target)]
+        while queue:
+            time_to, stop = heapq.heappop(queue)
+            if time_to > min_times[stop]:
+                continue
+            for i in range(offsets[stop], offsets[stop + 1]):
+                t = time_to + durations[i]
+                if t < min_times[sources[i]]:
+                    min_times[sources[i]] = t
+                    heapq.heappush(queue, (t, sources[i]))
+        return min_times
+
+    def _min_legs_to(self, target: int) -> List[int]:
+        # Breadth first over whole routes: a stop needs k vehicles if some
+        # route runs from it to a stop needing k - 1, or it walks to one.
+        tt = self.timetable
+        walk_from, walk_to, _ = self._walk_edges()
+        entry_routes = np.repeat(np.arange(tt.num_routes), np.diff(tt.route_stop_offsets))
+        entry_positions = np.arange(len(tt.route_stops)) - tt.route_stop_offsets[entry_routes]
+        min_legs = np.full(tt.num_stops, UNREACHABLE_LEGS, dtype=np.int64)
+        min_legs[target] = 0
+        self._walk_legs(min_legs, walk_from, walk_to, 0)
+        # routes emptied by timetable updates can't be ridden
+        running = np.diff(tt.route_trip_offsets)[entry_routes] > 0
+        for legs in range(1, UNREACHABLE_LEGS):
+            reached = (min_legs[tt.route_stops] < legs) & running
+            last = np.full(tt.num_routes, -1)
+            np.maximum.at(last, entry_routes[reached], entry_positions[reached])
+            boards = tt.route_stops[(entry_positions < last[entry_routes]) & ~reached]
+            if not len(boards):
+                break
+            min_legs[boards] = legs
+            self._walk_legs(min_legs, walk_from, walk_to, legs)
+        return min_legs.tolist()
+
+    @staticmethod
+    def _walk_legs(min_legs: np.ndarray, walk_from: np.ndarray, walk_to: np.ndarray, legs: int):
+        # Stops that walk to a stop needing `legs` vehicles need no more,
+        # repeated until no walk lowers a stop: a stop that only got its
+        # level by walking is still somewhere to walk to.
+        while True:
+            walks = (min_legs[walk_to] == legs) & (min_legs[walk_from] > legs)
+            if not walks.any():
+                return
+            min_legs[walk_from[walks]] = legs
+
+    def _add_origin(self, labels: LabelStore, origin: int, departure_time: int, target: int,
+                    bounds: Optional[tuple], stats: dict) -> Set[int]:
+        marked_stops = set()
+        origin_label = self._add_label(labels, origin, departure_time, 0, target, bounds, stats)
+        if origin_label < 0:
+            return marked_stops
+        marked_stops.add(origin)
+        for neighbor, walking_time_seconds in self.footpaths.walks_from(origin, self.max_walking_distance):
             walking_time = int(walking_time_seconds)
-            estimated_distance = walking_time_seconds * 1.4
-            new_time = departure_time + walking_time
-            
-            pareto_labels[neighbor] = [(new_time, 0)]
-            paths[neighbor][0] = (origin, 0, "WALK", None, estimated_distance, walking_time)
-            marked_stops.add(neighbor)
-        
+            if self._add_label(labels, neighbor, departure_time + walking_time, 0, target, bounds, stats,
+                               parent=origin_label, route=WALK, board_time=walking_time,
+                               distance=walking_time_seconds * 1.4) >= 0:
+                marked_stops.add(neighbor)
+        return marked_stops
+
+    def _scan_rounds(self, labels: LabelStore, marked_stops: Set[int], target: int, max_rounds: int,
+                     bounds: Optional[tuple], stats: dict, leave_by: Optional[int] = None):
+        # With leave_by, a first vehicle may only be boarded if the journey
+        # leaves the origin (the boarding less the walk to it) by then.
+        tt = self.timetable
         for k in range(1, max_rounds + 1):
+            if not marked_stops:
+                break
+            stats['rounds'] = max(stats['rounds'], k)
             marked_stops_next = set()
-            routes_to_scan = set()
+
+            # each route is scanned once per round, from the first marked stop on it
+            routes_to_scan = {}
             for stop in marked_stops:
-                for route_id, vehicle_id in self.routes_at_stop.get(stop, []):
-                    routes_to_scan.add((route_id, vehicle_id))
-            for route_id, vehicle_id in routes_to_scan:
-                trip_stops = self.get_trip_stops(route_id, vehicle_id)
-                earliest_board_idx = None
-                earliest_board_stop = None
-                earliest_board_time = float('inf')
-                board_label_idx = -1
-                for i, (stop_id, arrival_time) in enumerate(trip_stops):
-                    if stop_id in pareto_labels:
-                        for label_idx, (label_time, label_legs) in enumerate(pareto_labels[stop_id]):
-                            if label_time <= arrival_time and label_legs == k - 1:
-                                if earliest_board_idx is None or i < earliest_board_idx:
-                                    earliest_board_time = arrival_time
-                                    earliest_board_stop = stop_id
-                                    earliest_board_idx = i
-                                    board_label_idx = label_idx
-                
-                if earliest_board_idx is not None:
-                    for i in range(earliest_board_idx + 1, len(trip_stops)):
-                        stop_id, arrival_time = trip_stops[i]
-                        if arrival_time < earliest_board_time:
-                            continue
+                for route_idx, pos in tt.routes_at(stop):
+                    if pos < routes_to_scan.get(route_idx, len(tt.stop_ids)):
+                        routes_to_scan[route_idx] = pos
+            stats['routes_scanned'] += len(routes_to_scan)
+
+            for route_idx, start_pos in routes_to_scan.items():
+                route_stops = tt.route_stop_list(route_idx)
+                trip = -1
+                board_label = -1
+                board_time = None
 
-                        if not self.is_pareto_dominated(arrival_time, k, pareto_labels[stop_id]):
-                            old_len = len(pareto_labels[stop_id])
-                            pareto_labels[stop_id] = self.add_to_pareto_set(
-                                arrival_time, k, pareto_labels[stop_id]
-                            )
-                            new_len = len(pareto_labels[stop_id])
-                            label_idx = new_len - 1
-                            board_time = earliest_board_time
-                            alight_time = arrival_time
-                            paths[stop_id][label_idx] = (
-                                earliest_board_stop, board_label_idx, route_id, vehicle_id, board_time, alight_time
-                            )
-                            
+                for pos in range(start_pos, len(route_stops)):
+                    stop_id = route_stops[pos]
+
+                    if trip >= 0:
+                        arrival_time = tt.trip_time(route_idx, pos, trip)
+                        if self._add_label(labels, stop_id, arrival_time, k, target, bounds, stats,
+                                           parent=board_label, route=route_idx, trip=tt.trip_id(route_idx, trip),
+                                           board_time=board_time) >= 0:
                             marked_stops_next.add(stop_id)
-            walking_marked = set()
-            
-            vehicle_stops = set(marked_stops_next)
-            for stop in vehicle_stops:
-                for neighbor, walking_time_seconds in self.get_walking_neighbors(stop):
+
+                    # a label from an earlier round is the only way onto this route here
+                    prev_label = labels.best(stop_id, k - 1)
+                    if prev_label < 0:
+                        continue
+                    prev_time = labels.time[prev_label]
+                    # boarding here costs a vehicle whether or not the bound counts it
+                    if bounds is not None and self._beaten_at_target(labels, target, bounds, stop_id, prev_time,
+                                                                     max(k - 1, k - bounds[1][stop_id])):
+                        continue
+
+                    # only an earlier trip than the one we are already on is worth switching to
+                    earlier_trip = tt.earliest_trip(route_idx, pos, prev_time, trip)
+                    if earlier_trip >= 0 and leave_by is not None and labels.legs[prev_label] == 0:
+                        walked = labels.board_time[prev_label] if labels.route[prev_label] == WALK else 0
+                        if tt.trip_time(route_idx, pos, earlier_trip) - walked > leave_by:
+                            continue
+                    if earlier_trip >= 0:
+                        trip = earlier_trip
+                        board_label = prev_label
+                        board_time = tt.trip_time(route_idx, pos, trip)
+
+            # Walk only from the labels the vehicles produced this round; the
+            # footpaths from transfers.py are transitively closed, so one hop
+            # reaches every stop within the walk limit. Reading labels while
+            # walks are being added would let walks chain depending on set
+            # iteration order, and pruning would change that order.
+            walk_sources = [(stop, labels.best(stop, k, walks=False)) for stop in marked_stops_next]
+            for stop, source_label in walk_sources:
+                source_time = labels.time[source_label]
+                for neighbor, walking_time_seconds in self.footpaths.walks_from(stop, self.max_walking_distance):
                     walking_time = int(walking_time_seconds)
-                    estimated_distance = walking_time_seconds * 1.4
-                    best_label = None
-                    best_time = float('inf')
-                    best_label_idx = -1
-                    
-                    for label_idx, (label_time, label_legs) in enumerate(pareto_labels[stop]):
-                        if label_legs == k and label_time < best_time:
-                            best_time = label_time
-                            best_label_idx = label_idx
-                    
-                    if best_label_idx >= 0:
-                        new_time = best_time + walking_time
-                        
-                        if not self.is_pareto_dominated(new_time, k, pareto_labels[neighbor]):
-                            old_len_neighbor = len(pareto_labels[neighbor])
-                            pareto_labels[neighbor] = self.add_to_pareto_set(
-                                new_time, k, pareto_labels[neighbor]
-                            )
-                            new_len_neighbor = len(pareto_labels[neighbor])
-                            new_label_idx = new_len_neighbor - 1
-                            paths[neighbor][new_label_idx] = (
-                                stop, best_label_idx, "WALK", None, estimated_distance, walking_time
-                            )
-                            
-                            walking_marked.add(neighbor)
-            
-            marked_stops_next.update(walking_marked)
+                    if self._add_label(labels, neighbor, source_time + walking_time, k, target, bounds, stats,
+                                       parent=source_label, route=WALK, board_time=walking_time,
+                                       distance=walking_time_seconds * 1.4) >= 0:
+                        marked_stops_next.add(neighbor)
+
             marked_stops = marked_stops_next
-        
-        if destination not in pareto_labels:
+
+    def _departure(self, chain: List[int], labels: LabelStore) -> int:
+        # When the journey has to leave: its first boarding less the walk to
+        # it, or the root's time if it is walked throughout.
+        walked = 0
+        for label_id in chain[1:]:
+            if labels.route[label_id] != WALK:
+                return labels.board_time[label_id] - walked
+            walked += labels.board_time[label_id]
+        return labels.time[chain[0]]
+
+    def _journey(self, label_id: int, labels: LabelStore, leave_by: bool = False) -> dict:
+        # With leave_by, departure_time is when the journey has to leave
+        # rather than the time it was searched from.
+        chain = labels.chain(label_id)
+        departure_time = self._departure(chain, labels) if leave_by else labels.time[chain[0]]
+        arrival_time = labels.time[label_id]
+        return {
+            'departure_time': departure_time,
+            'arrival_time': arrival_time,
+            'num_legs': labels.legs[label_id],
+            'journey_time': arrival_time - departure_time,
+            'path': self.reconstruct_path(label_id, labels)
+        }
+
+    def _new_stats(self, stats: Optional[dict]) -> dict:
+        if stats is None:
+            stats = {}
+        stats.update(labels_created=0, pruned_local=0, pruned_target=0, routes_scanned=0, rounds=0)
+        return stats
+
+    def route(self, origin: str, destination: str, departure_time: int, max_rounds: int = 5,
+              prune: bool = True, stats: Optional[dict] = None, leave_by: Optional[int] = None):
+        # leave_by limits the journeys to those leaving the origin by then
+        stats = self._new_stats(stats)
+        tt = self.timetable
+        if origin not in tt.stop_index or destination not in tt.stop_index:
             print("\nNo path found!")
             return []
+        origin = tt.stop_index[origin]
+        destination = tt.stop_index[destination]
+
+        labels = LabelStore()
+        bounds = self._target_bounds(destination, max_rounds) if prune else None
+        marked_stops = self._add_origin(labels, origin, departure_time, destination, bounds, stats)
+        self._scan_rounds(labels, marked_stops, destination, max_rounds, bounds, stats, leave_by=leave_by)
         
-        results = []
-        for label_idx, (arrival_time, num_legs) in enumerate(pareto_labels[destination]):
-            path = self.reconstruct_path(destination, label_idx, paths)
-            results.append({
-                'arrival_time': arrival_time,
-                'num_legs': num_legs,
-                'journey_time': arrival_time - departure_time,
-                'path': path
-            })
+        destination_labels = labels.bag(destination)
+        if not destination_labels:
+            print("\nNo path found!")
+            return []
         
+        results = [self._journey(label_id, labels) for label_id in destination_labels]
         results.sort(key=lambda x: (x['num_legs'], x['arrival_time']))
         
         return results
+
+    def route_one_to_many(self, origin: str, departure_time: int, max_rounds: int = 5,
+                          stats: Optional[dict] = None) -> Dict[str, List[Tuple[int, int]]]:
+        # One round loop without a target: the Pareto set of
+        # (arrival_time, num_legs) at every stop reachable from origin.
+        stats = self._new_stats(stats)
+        tt = self.timetable
+        if origin not in tt.stop_index:
+            return {}
+
+        labels = LabelStore()
+        marked_stops = self._add_origin(labels, tt.stop_index[origin], departure_time, -1, None, stats)
+        self._scan_rounds(labels, marked_stops, -1, max_rounds, None, stats)
+
+        arrivals = {}
+        for stop, bag in labels.bags():
+            arrivals[tt.stop_ids[stop]] = [(labels.time[label_id], labels.legs[label_id]) for label_id in bag]
+        return arrivals
+
+    def route_range(self, origin: str, destination: str, departure_time: int, window: int,
+                    max_rounds: int = 5, prune: bool = True, stats: Optional[dict] = None):
+        # rRAPTOR profile query: every Pareto-optimal (departure, arrival, legs)
+        # journey leaving origin within `window` seconds of departure_time.
+        # Departures are swept latest first over one label store, so labels
+        # found for a later departure keep pruning the earlier ones.
+        stats = self._new_stats(stats)
+        tt = self.timetable
+        if origin not in tt.stop_index or destination not in tt.stop_index:
+            print("\nNo path found!")
+            return []
+        origin = tt.stop_index[origin]
+        destination = tt.stop_index[destination]
+
+        sources = [(origin, 0)]
+        for neighbor, walking_time_seconds in self.footpaths.walks_from(origin, self.max_walking_distance):
+            sources.append((neighbor, int(walking_time_seconds)))
+        departures = {departure_time}
+        for stop, walking_time in sources:
+            for board_time in tt.departures_at(stop, departure_time + walking_time,
+                                               departure_time + window + walking_time):
+                departures.add(board_time - walking_time)
+        stats['departures'] = len(departures)
+
+        labels = LabelStore()
+        bounds = self._target_bounds(destination, max_rounds) if prune else None
+        candidates = []
+        for dep in sorted(departures, reverse=True):
+            first_label = len(labels)
+            marked_stops = self._add_origin(labels, origin, dep, destination, bounds, stats)
+            self._scan_rounds(labels, marked_stops, destination, max_rounds, bounds, stats,
+                              leave_by=departure_time + window)
+            for label_id in labels.bag(destination):
+                # walking straight there doesn't depend on departure; keep only
+                # the final sweep's walk so it is reported once
+                if label_id >= first_label and labels.legs[label_id] > 0:
+                    candidates.append(self._journey(label_id, labels, leave_by=True))
+        for label_id in labels.bag(destination):
+            if labels.legs[label_id] == 0:
+                candidates.append(self._journey(label_id, labels, leave_by=True))
+
+        # Journeys are reported by when they have to leave, which two sweeps
+        # can share, so keep the Pareto set over that departure too.
+        results = []
+        for journey in sorted(candidates, key=lambda x: (-x['departure_time'], x['arrival_time'], x['num_legs'])):
+            if not any(other['arrival_time'] <= journey['arrival_time'] and other['num_legs'] <= journey['num_legs']
+                       for other in results):
+                results.append(journey)
+
+        if not results:
+            print("\nNo path found!")
+            return []
+
+        results.sort(key=lambda x: (x['departure_time'], x['num_legs'], x['arrival_time']))
+        return results
     
-    def reconstruct_path(self, stop: str, label_idx: int, paths: dict) -> List[dict]:
+    def reconstruct_path(self, label_id: int, labels: LabelStore) -> List[dict]:
+        tt = self.timetable
         path = []
-        current_stop = stop
-        current_label_idx = label_idx
+        chain = labels.chain(label_id)
         
-        while current_stop in paths and current_label_idx in paths[current_stop]:
-            path_info = paths[current_stop][current_label_idx]
-            
-            if path_info is None:
-                break
-            
-            if len(path_info) == 6:
-                prev_stop, prev_label_idx, route_id, vehicle_id, time1, time2 = path_info
-            else:
-                prev_stop, prev_label_idx, route_id, vehicle_id = path_info
-                time1 = None
-                time2 = None
-            
-            if route_id == "WALK":
+        for prev_label, current_label in zip(chain, chain[1:]):
+            from_id = tt.stop_ids[labels.stop[prev_label]]
+            to_id = tt.stop_ids[labels.stop[current_label]]
+            route_idx = labels.route[current_label]
+            if route_idx == WALK:
                 path.append({
                     'type': 'walk',
-                    'from': prev_stop,
-                    'from_name': self.get_stop_name(prev_stop),
-                    'to': current_stop,
-                    'to_name': self.get_stop_name(current_stop),
-                    'distance': time1,
-                    'walk_time': time2
+                    'from': from_id,
+                    'from_name': self.get_stop_name(from_id),
+                    'to': to_id,
+                    'to_name': self.get_stop_name(to_id),
+                    'distance': labels.distance[current_label],
+                    'walk_time': labels.board_time[current_label]
                 })
             else:
-                segment = {
+                path.append({
                     'type': 'trip',
-                    'route': route_id,
-                    'vehicle': vehicle_id,
-                    'from': prev_stop,
-                    'from_name': self.get_stop_name(prev_stop),
-                    'to': current_stop,
-                    'to_name': self.get_stop_name(current_stop)
-                }
-                if time1 is not None and time2 is not None:
-                    segment['ride_time'] = int(time2 - time1)
-                path.append(segment)
-            
-            current_stop = prev_stop
-            current_label_idx = prev_label_idx
+                    'route': tt.route_names[route_idx],
+                    'vehicle': tt.trip_vehicles[labels.trip[current_label]],
+                    'from': from_id,
+                    'from_name': self.get_stop_name(from_id),
+                    'to': to_id,
+                    'to_name': self.get_stop_name(to_id),
+                    'ride_time': int(labels.time[current_label] - labels.board_time[current_label])
+                })
         
-        path.reverse()
         
         merged_path = []
         i = 0
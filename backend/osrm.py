@@ -0,0 +1,250 @@
+# Walking geometry from OSRM for walk legs.
+#
+# One OSRMClient per process holds a pooled requests session, shared by the
+# threads assembling responses, a thread pool for bulk fetches, and an LRU of
+# results keyed on the (from, to) stop pair that expires after CACHE_TTL
+# seconds. Before going to OSRM it looks in a WalkGeometryStore: polylines
+# for the footpath graph's stop pairs, fetched offline with
+#
+#   python osrm.py walking_distances.bin walking_geometry.bin [max seconds]
+#
+# so most walk legs never leave the process.
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from shared_snapshot import map_segment, write_segment
+
+OSRM_URL = os.environ.get("OSRM_URL", "http://osrm:5000")
+TIMEOUT = 2
+CACHE_SIZE = 4096
+CACHE_TTL = 3600
+FETCH_WORKERS = 8
+
+
+class WalkGeometryStore:
+    # OSRM walking polylines per stop pair: one (n, 2) array of [lon, lat]
+    # rows with per-pair offsets, durations and distances. Walks are looked up
+    # in either direction, as the footpath graph treats them as symmetric.
+    def __init__(self, arrays: Dict[str, np.ndarray], strings: Dict[str, List[str]]):
+        self.arrays = arrays
+        self.strings = strings
+        self.coords = arrays['coords']
+        self.offsets = arrays['offsets'].tolist()
+        self.durations = arrays['durations'].tolist()
+        self.distances = arrays['distances'].tolist()
+        self.pairs = {pair: row for row, pair in enumerate(zip(strings['origin_ids'], strings['dest_ids']))}
+
+    @classmethod
+    def build(cls, walks: Dict[Tuple[str, str], dict]) -> 'WalkGeometryStore':
+        # `walks` maps a stop pair to an OSRM route: GeoJSON [lon, lat]
+        # coordinates, duration and distance.
+        origin_ids, dest_ids, coords, offsets, durations, distances = [], [], [], [0], [], []
+        for (origin_id, dest_id), walk in walks.items():
+            line = np.array(walk['coordinates'], dtype=np.float64).reshape(-1, 2)
+            origin_ids.append(origin_id)
+            dest_ids.append(dest_id)
+            coords.append(line)
+            offsets.append(offsets[-1] + len(line))
+            durations.append(walk['duration'])
+            distances.append(walk['distance'])
+        arrays = {
+            'coords': np.concatenate(coords) if coords else np.zeros((0, 2)),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'durations': np.array(durations, dtype=np.float64),
+            'distances': np.array(distances, dtype=np.float64),
+        }
+        return cls(arrays, {'origin_ids': origin_ids, 'dest_ids': dest_ids})
+
+    def save(self, path: str):
+        write_segment(path, self.arrays, self.strings)
+
+    @classmethod
+    def load(cls, path: str) -> 'WalkGeometryStore':
+        arrays, strings, _ = map_segment(path)
+        return cls(arrays, strings)
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def get(self, origin_id: str, dest_id: str) -> Optional[dict]:
+        # The walk as the /api/route segment fields, coordinates in [lat, lon].
+        row = self.pairs.get((origin_id, dest_id))
+        reverse = row is None
+        if reverse:
+            row = self.pairs.get((dest_id, origin_id))
+            if row is None:
+                return None
+        line = self.coords[self.offsets[row]:self.offsets[row + 1], ::-1]
+        return {
+            'coordinates': (line[::-1] if reverse else line).tolist(),
+            'duration': int(self.durations[row]),
+            'distance': self.distances[row],
+        }
+
+
+def load_walk_geometry(path: str) -> Optional[WalkGeometryStore]:
+    if not os.path.exists(path):
+        return None
+    return WalkGeometryStore.load(path)
+
+
+class OSRMClient:
+    def __init__(self, base_url: str = OSRM_URL, profile: str = "walking", timeout: float = TIMEOUT,
+                 store: Optional[WalkGeometryStore] = None, cache_size: int = CACHE_SIZE,
+                 cache_ttl: float = CACHE_TTL, workers: int = FETCH_WORKERS):
+        self.base_url = base_url
+        self.profile = profile
+        self.timeout = timeout
+        self.store = store
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="osrm")
+        # (from, to) -> (expires at, walk)
+        self._cache: "OrderedDict[Tuple[str, str], Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fetch(self, origin_coord: Tuple[float, float], dest_coord: Tuple[float, float],
+              overview: str = "full") -> Optional[dict]:
+        # One OSRM route request; GeoJSON [lon, lat] coordinates, or None.
+        lon1, lat1 = origin_coord
+        lon2, lat2 = dest_coord
+        url = f"{self.base_url}/route/v1/{self.profile}/{lon1},{lat1};{lon2},{lat2}"
+        try:
+            response = self.session.get(url, params={'overview': overview, 'geometries': 'geojson'},
+                                        timeout=self.timeout)
+            if response.status_code == 200:
+                data = response.json()
+                if data.get('code') == 'Ok' and data.get('routes'):
+                    route = data['routes'][0]
+                    return {
+                        'coordinates': route['geometry']['coordinates'],
+                        'duration': route.get('duration', 0),
+                        'distance': route.get('distance', 0),
+                    }
+        except Exception as e:
+            print(f"OSRM walking route failed: {e}")
+        return None
+
+    def _cached(self, key: Tuple[str, str]) -> Optional[dict]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry[1]
+
+    def _remember(self, key: Tuple[str, str], walk: dict):
+        with self._lock:
+            self._cache[key] = (time.time() + self.cache_ttl, walk)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _known(self, key: Tuple[str, str]) -> Optional[dict]:
+        walk = self._cached(key)
+        if walk is None and self.store is not None:
+            walk = self.store.get(*key)
+            if walk is not None:
+                self._remember(key, walk)
+        return walk
+
+    def _learn(self, key: Tuple[str, str], route: Optional[dict]) -> Optional[dict]:
+        # An OSRM route as segment fields, remembered for the stop pair.
+        # Failures are not cached, so the next request tries again.
+        if route is None:
+            return None
+        walk = {
+            'coordinates': [[lat, lon] for lon, lat in route['coordinates']],
+            'duration': int(route['duration']),
+            'distance': route['distance'],
+        }
+        self._remember(key, walk)
+        return walk
+
+    def walk(self, origin_id: str, dest_id: str, origin_coord: Tuple[float, float],
+             dest_coord: Tuple[float, float]) -> Optional[dict]:
+        # Walk between two stops as segment fields (coordinates in [lat, lon],
+        # duration, distance), or None if OSRM has no answer.
+        key = (origin_id, dest_id)
+        walk = self._known(key) or self._learn(key, self.fetch(origin_coord, dest_coord))
+        return dict(walk) if walk is not None else None
+
+    async def fetch_async(self, session: aiohttp.ClientSession, origin_coord: Tuple[float, float],
+                          dest_coord: Tuple[float, float], overview: str = "full") -> Optional[dict]:
+        # fetch() on an aiohttp session, for the ASGI app
+        lon1, lat1 = origin_coord
+        lon2, lat2 = dest_coord
+        url = f"{self.base_url}/route/v1/{self.profile}/{lon1},{lat1};{lon2},{lat2}"
+        try:
+            async with session.get(url, params={'overview': overview, 'geometries': 'geojson'},
+                                   timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    if data.get('code') == 'Ok' and data.get('routes'):
+                        route = data['routes'][0]
+                        return {
+                            'coordinates': route['geometry']['coordinates'],
+                            'duration': route.get('duration', 0),
+                            'distance': route.get('distance', 0),
+                        }
+        except Exception as e:
+            print(f"OSRM walking route failed: {e!r}")
+        return None
+
+    async def walk_async(self, session: aiohttp.ClientSession, origin_id: str, dest_id: str,
+                         origin_coord: Tuple[float, float], dest_coord: Tuple[float, float]) -> Optional[dict]:
+        key = (origin_id, dest_id)
+        walk = self._known(key) or self._learn(key, await self.fetch_async(session, origin_coord, dest_coord))
+        return dict(walk) if walk is not None else None
+
+
+def fetch_walk_geometry(client: OSRMClient, pairs: List[Tuple[str, str]], stops) -> Dict[Tuple[str, str], dict]:
+    # OSRM polylines for stop pairs, fetched on the client's pool.
+    def fetch(pair):
+        origin, dest = stops.coords(pair[0]), stops.coords(pair[1])
+        if origin is None or dest is None:
+            return pair, None
+        return pair, client.fetch(origin, dest)
+
+    walks = {}
+    for done, (pair, route) in enumerate(client.pool.map(fetch, pairs), 1):
+        if route is not None:
+            walks[pair] = route
+        if done % 1000 == 0:
+            print(f"{done}/{len(pairs)} walks fetched")
+    return walks
+
+
+if __name__ == '__main__':
+    # python osrm.py walking_distances.bin walking_geometry.bin [max seconds]
+    from footpaths import FootpathGraph
+    from stops import load_stop_table
+
+    footpaths = FootpathGraph.load(sys.argv[1])
+    max_walk = float(sys.argv[3]) if len(sys.argv) > 3 else 600
+    pairs = set()
+    for stop, origin_id in enumerate(footpaths.stop_ids):
+        for neighbor, _ in footpaths.walks_from(stop, max_walk):
+            dest_id = footpaths.stop_ids[neighbor]
+            if (dest_id, origin_id) not in pairs:
+                pairs.add((origin_id, dest_id))
+
+    client = OSRMClient(os.environ.get("OSRM_URL", "http://localhost:5001"), timeout=10, workers=16)
+    store = WalkGeometryStore.build(fetch_walk_geometry(client, sorted(pairs), load_stop_table()))
+    store.save(sys.argv[2])
+    print(f"Wrote {len(store)} of {len(pairs)} walk geometries to {sys.argv[2]}")
@@ -0,0 +1,51 @@
+# Finished /api/route responses, per worker.
+#
+# Keys carry the snapshot version, so an entry can only ever be served from
+# the snapshot that computed it; clear() drops the rest when a reload swaps a
+# new snapshot in. Hits and misses are counted between reads of take_counts()
+# so each reload can export the interval's counts.
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+ROUTE_CACHE_SIZE = 2048
+
+
+class RouteCache:
+    def __init__(self, max_size: int = ROUTE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, object]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[object]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: object):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def take_counts(self) -> Tuple[int, int]:
+        # (hits, misses) since the last call
+        with self._lock:
+            counts = (self.hits, self.misses)
+            self.hits = self.misses = 0
+            return counts
@@ -0,0 +1,42 @@
+# Validation of the /api/route request body, shared by full_api.py and
+# asgi_api.py. Each parser raises ValueError for a value the router must not
+# be handed; the entry points turn that into a 400.
+import time
+
+# longest departure window (minutes) a profile query may sweep
+MAX_WINDOW = 120
+# how far (seconds) a requested departure may be from now
+MAX_DEPARTURE_OFFSET = 24 * 60 * 60
+
+
+def parse_window(value):
+    # The request's departure window in whole minutes, None for a single
+    # departure; ValueError unless it is a number up to MAX_WINDOW
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(value)
+    try:
+        window = int(float(value))
+    except OverflowError:
+        raise ValueError(value)
+    if window < 0 or window > MAX_WINDOW:
+        raise ValueError(value)
+    return window or None
+
+
+def parse_departure_time(value, now=None):
+    # The request's departure as a unix time, now when it is missing;
+    # ValueError unless it is a number within MAX_DEPARTURE_OFFSET of now
+    now = int(time.time()) if now is None else now
+    if value is None or value == '':
+        return now
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(value)
+    try:
+        departure_time = int(float(value))
+    except OverflowError:
+        raise ValueError(value)
+    if abs(departure_time - now) > MAX_DEPARTURE_OFFSET:
+        raise ValueError(value)
+    return departure_time
@@ -0,0 +1,82 @@
+# Prebuilt substring index over stop names for /api/search.
+#
+# Stops sharing a name collapse into one entry up front (a rail stop wins,
+# then the stop with the most lines), and entries are numbered in the order
+# the endpoint ranks them. Every name is indexed under its character bigrams
+# and trigrams; a query walks the shortest posting list for its own n-grams
+# in rank order, confirms the substring, and stops at the result limit.
+from collections import defaultdict
+from typing import List
+
+import numpy as np
+
+from lines import LineTable
+from stops import StopTable
+
+
+_NO_ENTRIES = np.zeros(0, dtype=np.int32)
+
+
+def _ngrams(text: str, n: int):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class StopSearch:
+    def __init__(self, stops: StopTable, lines: LineTable):
+        best = {}
+        first_seen = {}
+        for idx, stop_id in enumerate(stops.ids):
+            name = stops.names[idx]
+            first_seen.setdefault(name, idx)
+            is_rail = stops.mode(stop_id) == 'rail'
+            line_count = lines.line_count(stop_id)
+            current = best.get(name)
+            if current is not None:
+                current_is_rail = stops.mode(stops.ids[current]) == 'rail'
+                if current_is_rail and not is_rail:
+                    continue
+                if current_is_rail == is_rail and line_count <= lines.line_count(stops.ids[current]):
+                    continue
+            best[name] = idx
+
+        def rank(name):
+            idx = best[name]
+            mode = stops.mode(stops.ids[idx]).lower()
+            preferred = 'underground' in mode or 'tube' in mode or mode == 'rail'
+            return (0 if preferred else 1, -lines.line_count(stops.ids[idx]), first_seen[name])
+
+        self.names: List[str] = []
+        self.results: List[dict] = []
+        for name in sorted(best, key=rank):
+            idx = best[name]
+            stop_id = stops.ids[idx]
+            longitude, latitude = stops.coords(stop_id)
+            self.names.append(name.lower())
+            self.results.append({
+                'id': stop_id,
+                'name': name,
+                'lat': latitude,
+                'lng': longitude,
+                'mode': stops.mode(stop_id),
+                'lines': lines.badges(stop_id)[:10],
+            })
+
+        postings = defaultdict(list)
+        for entry, name in enumerate(self.names):
+            for gram in _ngrams(name, 2) | _ngrams(name, 3):
+                postings[gram].append(entry)
+        self.postings = {gram: np.array(entries, dtype=np.int32) for gram, entries in postings.items()}
+
+    def search(self, query: str, limit: int = 20) -> List[dict]:
+        query = query.strip().lower()
+        if len(query) < 2:
+            return []
+        grams = _ngrams(query, 3) if len(query) >= 3 else {query}
+        candidates = min((self.postings.get(gram, _NO_ENTRIES) for gram in grams), key=len)
+        results = []
+        for entry in memoryview(candidates):
+            if query in self.names[entry]:
+                results.append(self.results[entry])
+                if len(results) == limit:
+                    break
+        return results
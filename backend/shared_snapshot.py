@@ -0,0 +1,105 @@
+# Read-only snapshot segments shared between processes.
+#
+# A segment is one file on a tmpfs (/dev/shm by default, where
+# multiprocessing.shared_memory keeps its blocks too) holding named NumPy
+# arrays, string tables and a small JSON meta dict. Writers build the file
+# under a temporary name and os.replace() it into place, so a reader always
+# maps a complete segment. Readers mmap it read-only and get arrays backed by
+# the shared pages: every gunicorn worker and batch process attaching to the
+# same file shares one physical copy. A replaced segment stays valid for
+# anyone still mapping it and is freed by the kernel once the last map goes.
+import fcntl
+import json
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+SNAPSHOT_DIR = os.environ.get("RAPTOR_SNAPSHOT_DIR", "/dev/shm")
+LIVE_SEGMENT = "raptor-live"
+MAGIC = b"RAPTSNAP"
+ALIGN = 64
+
+_HEADER = struct.Struct("<8sQ")
+
+
+def segment_path(name: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, name)
+
+
+def _align(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_segment(path: str, arrays: Dict[str, np.ndarray], strings: Dict[str, List[str]], meta: Optional[dict] = None):
+    blobs = dict(arrays)
+    for name, values in strings.items():
+        # NUL never appears in stop, route or vehicle ids
+        blobs[f"{name}.str"] = np.frombuffer("\0".join(values).encode(), dtype=np.uint8)
+
+    manifest = {"arrays": {}, "strings": {name: len(values) for name, values in strings.items()}, "meta": meta or {}}
+    offset = 0
+    for name, arr in blobs.items():
+        arr = np.ascontiguousarray(arr)
+        blobs[name] = arr
+        manifest["arrays"][name] = [arr.dtype.str, list(arr.shape), offset]
+        offset = _align(offset + arr.nbytes)
+    header = json.dumps(manifest).encode()
+    data_start = _align(_HEADER.size + len(header))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        for name, arr in blobs.items():
+            f.seek(data_start + manifest["arrays"][name][2])
+            f.write(memoryview(arr).cast("B"))
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def map_segment(path: str) -> Tuple[Dict[str, np.ndarray], Dict[str, List[str]], dict]:
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_len = _HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a snapshot segment")
+    manifest = json.loads(mm[_HEADER.size:_HEADER.size + header_len])
+    data_start = _align(_HEADER.size + header_len)
+
+    # the arrays keep the mmap alive; it is unmapped when the last one goes
+    arrays = {}
+    for name, (dtype, shape, offset) in manifest["arrays"].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape)) if shape else 1
+        arrays[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+
+    strings = {}
+    for name, count in manifest["strings"].items():
+        blob = arrays.pop(f"{name}.str")
+        strings[name] = blob.tobytes().decode().split("\0") if count else []
+    return arrays, strings, manifest["meta"]
+
+
+def segment_version(path: str) -> Optional[Tuple[int, int]]:
+    # Changes whenever a new segment is renamed into place.
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def try_acquire_leader(lock_path: str):
+    # Non-blocking exclusive lock; the holder builds and publishes snapshots.
+    # Returns the open lock file (keep a reference for the process lifetime)
+    # or None if another process already leads.
+    f = open(lock_path, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
@@ -0,0 +1,90 @@
+# Versioned live-data snapshots.
+#
+# A Snapshot bundles everything a request needs from one reload: the routing
+# engine, platform assignments, the set of rail routes and line metadata.
+# Snapshots are never mutated after construction, apart from memoising the
+# stops of legs already answered. The reload thread builds
+# the next one completely and then publishes it with a single reference
+# assignment, so a request that called current() keeps a consistent view for
+# its whole lifetime even if a newer snapshot is published while it runs.
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from lines import LineTable
+from mcraptor import McRAPTOR
+from stops import StopTable
+
+
+class Snapshot:
+    __slots__ = ('version', 'created_at', 'engine', 'platforms', 'rail_routes', 'lines', '_leg_stops')
+
+    def __init__(self, version: int, created_at: float, engine: McRAPTOR, platforms: Dict[str, str],
+                 rail_routes: Set[str], lines: LineTable):
+        self.version = version
+        self.created_at = created_at
+        self.engine = engine
+        self.platforms = platforms
+        self.rail_routes = rail_routes
+        self.lines = lines
+        # (route, vehicle, from, to) -> leg stops or None
+        self._leg_stops: Dict[Tuple[str, str, str, str], Optional[List[dict]]] = {}
+
+    @classmethod
+    def from_engine(cls, engine: McRAPTOR) -> 'Snapshot':
+        # Engines attached with McRAPTOR.from_segment() carry the snapshot
+        # fields in their segment meta.
+        meta = engine.meta
+        lines = LineTable(*engine.section('lines.'), engine.stops)
+        return cls(meta['version'], meta['created_at'], engine, meta['platforms'], set(meta['rail_routes']), lines)
+
+    @property
+    def stops(self) -> StopTable:
+        return self.engine.stops
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+    def leg_stops(self, route_id: str, vehicle_id: str, from_id: str, to_id: str) -> Optional[List[dict]]:
+        # Stops a trip passes from boarding to alighting, in travel order, or
+        # None if the trip does not call at both. Popular legs repeat across
+        # requests, so each is sliced once per snapshot.
+        key = (route_id, vehicle_id, from_id, to_id)
+        if key in self._leg_stops:
+            return self._leg_stops[key]
+
+        trip_stops = self.engine.get_trip_stops(route_id, vehicle_id)
+        board_idx = alight_idx = None
+        for idx, (stop_id, _) in enumerate(trip_stops):
+            if stop_id == from_id:
+                board_idx = idx
+            if stop_id == to_id:
+                alight_idx = idx
+
+        stops = None
+        if board_idx is not None and alight_idx is not None:
+            if board_idx < alight_idx:
+                leg = trip_stops[board_idx:alight_idx + 1]
+            else:
+                leg = trip_stops[alight_idx:board_idx + 1][::-1]
+            stops = [{'id': stop_id, 'name': self.stops.name(stop_id), 'time': arrival_time}
+                     for stop_id, arrival_time in leg]
+        self._leg_stops[key] = stops
+        return stops
+
+    def info(self) -> dict:
+        return {'version': self.version, 'age': round(self.age, 1)}
+
+
+_current: Optional[Snapshot] = None
+
+
+def current() -> Optional[Snapshot]:
+    return _current
+
+
+def publish(snapshot: Snapshot):
+    # Rebinding one module global is atomic, so readers see either the old
+    # snapshot or the new one and never a mix of the two.
+    global _current
+    _current = snapshot
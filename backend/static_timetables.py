@@ -0,0 +1,380 @@
+# Scraped bus, tram and tube timetables, compiled once.
+#
+# bus_timetable.json, tram_timetable.json and tube_timetable2.json only
+# change when they are scraped again, so they are compiled into flat arrays
+# in the segment format:
+#
+#   python static_timetables.py
+#
+# writes bus_timetable.bin, tram_timetable.bin and tube_timetable.bin next to
+# them, and each process maps those once (building any missing one from its
+# JSON first). The feed reload then only processes live predictions.
+#
+# Every timetable is a list of routes. A route's interval list is its stops
+# with the minutes from the first departure; tube routes have several such
+# lists ("intervals") plus per-day schedules of (interval, start second),
+# stored sorted by start. Stops are interned into one string table.
+import json
+import os
+import sys
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+from shared_snapshot import map_segment, write_segment
+
+
+class _Interner:
+    def __init__(self):
+        self.values: List[str] = []
+        self.index: Dict[str, int] = {}
+
+    def __call__(self, value: str) -> int:
+        idx = self.index.get(value)
+        if idx is None:
+            idx = self.index[value] = len(self.values)
+            self.values.append(value)
+        return idx
+
+
+def _offsets(counts: List[int]) -> np.ndarray:
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _numbers(values: list) -> np.ndarray:
+    # ints stay ints so times computed from them match the JSON arithmetic
+    array = np.array(values)
+    return array if array.dtype.kind in 'if' else array.astype(np.float64)
+
+
+class RouteTimetable:
+    # bus_timetable.json: {line: {direction: {"start:end": {"intervals":
+    # [[stop, minutes], ...], "start_times": [seconds after midnight, ...]}}}}.
+    # tram_timetable.json has no direction level; its routes get direction "".
+    def __init__(self, arrays: Dict[str, np.ndarray], strings: Dict[str, List[str]]):
+        self.arrays = arrays
+        self.strings = strings
+        stop_ids = strings['stop_ids']
+        lines = strings['lines']
+        directions = strings['directions']
+        self.route_codes: List[str] = strings['route_codes']
+
+        # line -> direction -> route rows, in JSON order
+        self.routes: Dict[str, Dict[str, List[int]]] = {line: {} for line in lines}
+        for route, (line, direction) in enumerate(zip(arrays['route_lines'].tolist(),
+                                                      arrays['route_directions'].tolist())):
+            self.routes[lines[line]].setdefault(directions[direction], []).append(route)
+
+        self.has_intervals: List[bool] = arrays['has_intervals'].astype(bool).tolist()
+        self.has_start_times: List[bool] = arrays['has_start_times'].astype(bool).tolist()
+        stop_offsets = arrays['stop_offsets'].tolist()
+        stops = arrays['stops'].tolist()
+        minutes = arrays['minutes'].tolist()
+        # per route: [(stop, minutes), ...] and stop -> minutes (last wins)
+        self.intervals: List[List[Tuple[str, float]]] = []
+        self.stop_intervals: List[Dict[str, float]] = []
+        for route in range(len(self.route_codes)):
+            start, end = stop_offsets[route], stop_offsets[route + 1]
+            intervals = [(stop_ids[stops[i]], minutes[i]) for i in range(start, end)]
+            self.intervals.append(intervals)
+            self.stop_intervals.append(dict(intervals))
+        start_offsets = arrays['start_offsets'].tolist()
+        start_times = arrays['start_times'].tolist()
+        self.start_times: List[List[int]] = [start_times[start_offsets[route]:start_offsets[route + 1]]
+                                             for route in range(len(self.route_codes))]
+
+        # every route's stop_intervals flattened for batched lookups: stops in
+        # first-seen order with their (last) minutes, keyed by route and stop
+        self.stop_index: Dict[str, int] = {stop: i for i, stop in enumerate(stop_ids)}
+        unique_counts, unique_stops, unique_minutes = [], [], []
+        for stop_minutes in self.stop_intervals:
+            unique_counts.append(len(stop_minutes))
+            unique_stops.extend(self.stop_index[stop] for stop in stop_minutes)
+            unique_minutes.extend(stop_minutes.values())
+        self.unique_offsets = _offsets(unique_counts)
+        self.unique_stops = np.array(unique_stops, dtype=np.int64)
+        self.unique_minutes = np.array(unique_minutes, dtype=arrays['minutes'].dtype)
+        keys = np.repeat(np.arange(len(unique_counts), dtype=np.int64), unique_counts) * len(stop_ids) + self.unique_stops
+        self._unique_order = np.argsort(keys, kind='stable')
+        self._unique_keys = keys[self._unique_order]
+
+    def find_stops(self, routes: np.ndarray, stops: np.ndarray) -> np.ndarray:
+        # index into unique_* of each (route, stop index), -1 where the route
+        # doesn't call at the stop or the stop isn't in the timetable
+        found = np.full(len(stops), -1, dtype=np.int64)
+        if not len(self._unique_keys):
+            return found
+        keys = routes * len(self.strings['stop_ids']) + stops
+        slots = np.minimum(np.searchsorted(self._unique_keys, keys), len(self._unique_keys) - 1)
+        hit = (stops >= 0) & (self._unique_keys[slots] == keys)
+        found[hit] = self._unique_order[slots[hit]]
+        return found
+
+    def trips(self, route: int, day_start: int, after: int) -> Tuple[list, list]:
+        # start times after `after`, and for each the arrival time at every
+        # stop of the route's intervals
+        stop_offsets = self.arrays['stop_offsets']
+        start_offsets = self.arrays['start_offsets']
+        minutes = self.arrays['minutes'][stop_offsets[route]:stop_offsets[route + 1]]
+        starts = day_start + self.arrays['start_times'][start_offsets[route]:start_offsets[route + 1]]
+        starts = starts[starts > after]
+        return starts.tolist(), (starts[:, None] + (minutes * 60)[None, :]).tolist()
+
+    @classmethod
+    def build(cls, timetable: dict, directions: bool = True) -> 'RouteTimetable':
+        lines, direction_ids, stop_ids, codes = _Interner(), _Interner(), _Interner(), []
+        route_lines, route_directions, has_intervals, has_start_times = [], [], [], []
+        stop_counts, stops, minutes, start_counts, start_times = [], [], [], [], []
+        for line, line_routes in timetable.items():
+            lines(line)
+            by_direction = line_routes.items() if directions else [("", line_routes)]
+            for direction, routes in by_direction:
+                for code, route in routes.items():
+                    codes.append(code)
+                    route_lines.append(lines(line))
+                    route_directions.append(direction_ids(direction))
+                    has_intervals.append("intervals" in route)
+                    has_start_times.append("start_times" in route)
+                    intervals = route.get("intervals", [])
+                    stop_counts.append(len(intervals))
+                    stops.extend(stop_ids(stop) for stop, _ in intervals)
+                    minutes.extend(interval for _, interval in intervals)
+                    start_counts.append(len(route.get("start_times", [])))
+                    start_times.extend(route.get("start_times", []))
+
+        arrays = {
+            'route_lines': np.array(route_lines, dtype=np.int32),
+            'route_directions': np.array(route_directions, dtype=np.int32),
+            'has_intervals': np.array(has_intervals, dtype=np.uint8),
+            'has_start_times': np.array(has_start_times, dtype=np.uint8),
+            'stop_offsets': _offsets(stop_counts),
+            'stops': np.array(stops, dtype=np.int32),
+            'minutes': _numbers(minutes),
+            'start_offsets': _offsets(start_counts),
+            'start_times': _numbers(start_times),
+        }
+        strings = {
+            'lines': lines.values,
+            'directions': direction_ids.values,
+            'route_codes': codes,
+            'stop_ids': stop_ids.values,
+        }
+        return cls(arrays, strings)
+
+    def save(self, path: str):
+        write_segment(path, self.arrays, self.strings)
+
+    @classmethod
+    def load(cls, path: str) -> 'RouteTimetable':
+        arrays, strings, _ = map_segment(path)
+        return cls(arrays, strings)
+
+
+class TubeTimetable:
+    # tube_timetable2.json: {line: {"start:end": {"intervals": [[[stop,
+    # minutes], ...], ...], "schedules": {day: [[interval, start second],
+    # ...]}}}}
+    def __init__(self, arrays: Dict[str, np.ndarray], strings: Dict[str, List[str]]):
+        self.arrays = arrays
+        self.strings = strings
+        stop_ids = strings['stop_ids']
+        lines = strings['lines']
+        days = strings['days']
+        self.route_codes: List[str] = strings['route_codes']
+        route_lines = arrays['route_lines'].tolist()
+
+        # line -> route code -> route row, in JSON order
+        self.lines: Dict[str, Dict[str, int]] = {line: {} for line in lines}
+        for route, line in enumerate(route_lines):
+            self.lines[lines[line]][self.route_codes[route]] = route
+
+        interval_offsets = arrays['interval_offsets'].tolist()
+        stop_offsets = arrays['stop_offsets'].tolist()
+        stops = arrays['stops'].tolist()
+        minutes = arrays['minutes'].tolist()
+        # per route: its interval lists of (stop, minutes)
+        self.intervals: List[List[List[Tuple[str, float]]]] = [
+            [[(stop_ids[stops[i]], minutes[i]) for i in range(stop_offsets[interval], stop_offsets[interval + 1])]
+             for interval in range(interval_offsets[route], interval_offsets[route + 1])]
+            for route in range(len(self.route_codes))
+        ]
+
+        # stops of every route with a given code, and of every route of a line
+        self.route_code_stops: Dict[str, Set[str]] = {}
+        self.line_stops: Dict[str, Set[str]] = {line: set() for line in lines}
+        route_stop_offsets = arrays['route_stop_offsets'].tolist()
+        route_stops = arrays['route_stops'].tolist()
+        for route, line in enumerate(route_lines):
+            served = {stop_ids[stop] for stop in route_stops[route_stop_offsets[route]:route_stop_offsets[route + 1]]}
+            self.route_code_stops.setdefault(self.route_codes[route], set()).update(served)
+            self.line_stops[lines[line]].update(served)
+
+        # stop -> (route, interval) -> positions of the stop in that interval
+        self.stop_calls: Dict[str, Dict[Tuple[int, int], List[int]]] = {}
+        for route, route_intervals in enumerate(self.intervals):
+            for interval, calls in enumerate(route_intervals):
+                for position, (stop, _) in enumerate(calls):
+                    self.stop_calls.setdefault(stop, {}).setdefault((route, interval), []).append(position)
+
+        # (route, day) -> (interval ids, start seconds) sorted by start
+        self.days = {day: i for i, day in enumerate(days)}
+        self._schedule_offsets = arrays['schedule_offsets'].tolist()
+        self._schedule_intervals = arrays['schedule_intervals']
+        self._schedule_starts = arrays['schedule_starts']
+
+    def schedule(self, route: int, day: str) -> Tuple[np.ndarray, np.ndarray]:
+        day_idx = self.days.get(day)
+        if day_idx is None:
+            return self._schedule_intervals[:0], self._schedule_starts[:0]
+        slot = route * len(self.days) + day_idx
+        start, end = self._schedule_offsets[slot], self._schedule_offsets[slot + 1]
+        return self._schedule_intervals[start:end], self._schedule_starts[start:end]
+
+    def routes_through(self, stops: List[str]) -> Set[int]:
+        # routes with an interval calling at `stops` in that order, each stop
+        # after the one before (a subsequence), found from the calls at the
+        # observed stops instead of scanning every interval
+        if not stops:
+            return {route for route, intervals in enumerate(self.intervals) if intervals}
+        candidates = None
+        for stop in set(stops):
+            calls = self.stop_calls.get(stop, {})
+            candidates = set(calls) if candidates is None else candidates & calls.keys()
+            if not candidates:
+                return set()
+        routes = set()
+        for key in candidates:
+            if key[0] in routes:
+                continue
+            position = -1
+            for stop in stops:
+                positions = self.stop_calls[stop][key]
+                later = bisect_right(positions, position)
+                if later == len(positions):
+                    break
+                position = positions[later]
+            else:
+                routes.add(key[0])
+        return routes
+
+    def starting_between(self, route: int, day: str, after: float, before: float) -> np.ndarray:
+        # interval ids of the route's departures on `day` strictly between
+        # the two start seconds
+        intervals, starts = self.schedule(route, day)
+        return intervals[np.searchsorted(starts, after, side='right'):np.searchsorted(starts, before, side='left')]
+
+    @classmethod
+    def build(cls, timetable: dict) -> 'TubeTimetable':
+        lines, stop_ids, codes = _Interner(), _Interner(), []
+        days = sorted({day for line_routes in timetable.values() for route in line_routes.values()
+                       for day in route.get("schedules", {})})
+        route_lines, interval_counts, stop_counts, stops, minutes = [], [], [], [], []
+        route_stop_counts, route_stops = [], []
+        schedule_counts, schedule_intervals, schedule_starts = [], [], []
+        for line, line_routes in timetable.items():
+            lines(line)
+            for code, route in line_routes.items():
+                codes.append(code)
+                route_lines.append(lines(line))
+                intervals = route.get("intervals", [])
+                interval_counts.append(len(intervals))
+                served = []
+                for interval in intervals:
+                    stop_counts.append(len(interval))
+                    for stop, interval_minutes in interval:
+                        stops.append(stop_ids(stop))
+                        minutes.append(interval_minutes)
+                        served.append(stop_ids(stop))
+                served = sorted(set(served))
+                route_stop_counts.append(len(served))
+                route_stops.extend(served)
+                schedules = route.get("schedules", {})
+                for day in days:
+                    entries = sorted(schedules.get(day, []), key=lambda entry: entry[1])
+                    schedule_counts.append(len(entries))
+                    schedule_intervals.extend(interval for interval, _ in entries)
+                    schedule_starts.extend(start for _, start in entries)
+
+        arrays = {
+            'route_lines': np.array(route_lines, dtype=np.int32),
+            'interval_offsets': _offsets(interval_counts),
+            'stop_offsets': _offsets(stop_counts),
+            'stops': np.array(stops, dtype=np.int32),
+            'minutes': _numbers(minutes),
+            'route_stop_offsets': _offsets(route_stop_counts),
+            'route_stops': np.array(route_stops, dtype=np.int32),
+            'schedule_offsets': _offsets(schedule_counts),
+            'schedule_intervals': np.array(schedule_intervals, dtype=np.int32),
+            'schedule_starts': _numbers(schedule_starts),
+        }
+        strings = {
+            'lines': lines.values,
+            'route_codes': codes,
+            'stop_ids': stop_ids.values,
+            'days': days,
+        }
+        return cls(arrays, strings)
+
+    def save(self, path: str):
+        write_segment(path, self.arrays, self.strings)
+
+    @classmethod
+    def load(cls, path: str) -> 'TubeTimetable':
+        arrays, strings, _ = map_segment(path)
+        return cls(arrays, strings)
+
+
+# compiled file -> (source JSON, compiled class, build options)
+SOURCES = {
+    "bus_timetable.bin": ("bus_timetable.json", RouteTimetable, {}),
+    "tram_timetable.bin": ("tram_timetable.json", RouteTimetable, {'directions': False}),
+    "tube_timetable.bin": ("tube_timetable2.json", TubeTimetable, {}),
+}
+
+
+def compile_timetable(path: str, save: bool = True):
+    json_path, compiled_cls, options = SOURCES[os.path.basename(path)]
+    with open(os.path.join(os.path.dirname(path), json_path), 'r') as f:
+        compiled = compiled_cls.build(json.load(f), **options)
+    if save:
+        compiled.save(path)
+    return compiled
+
+
+def _load(path: str):
+    # A missing .bin is compiled in memory, and saved if the directory allows.
+    if not os.path.exists(path):
+        print(f"{path} not found, building it from {SOURCES[path][0]}")
+        compiled = compile_timetable(path, save=False)
+        try:
+            compiled.save(path)
+        except OSError as e:
+            print(f"Could not write {path} ({e}); using the compiled copy in memory")
+        return compiled
+    return SOURCES[path][1].load(path)
+
+
+@lru_cache(maxsize=None)
+def load_bus_timetable() -> RouteTimetable:
+    return _load("bus_timetable.bin")
+
+
+@lru_cache(maxsize=None)
+def load_tram_timetable() -> RouteTimetable:
+    return _load("tram_timetable.bin")
+
+
+@lru_cache(maxsize=None)
+def load_tube_timetable() -> TubeTimetable:
+    return _load("tube_timetable.bin")
+
+
+if __name__ == '__main__':
+    # python static_timetables.py [compiled file ...]
+    for path in sys.argv[1:] or SOURCES:
+        compiled = compile_timetable(path)
+        print(f"Wrote {len(compiled.route_codes)} routes from {SOURCES[os.path.basename(path)][0]} to {path}")
@@ -0,0 +1,82 @@
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from data import Point, connect_db
+
+
+class StopTable:
+    # Immutable, array-backed copy of the Point table: stop id -> row index,
+    # with coordinates in NumPy arrays and modes as small integer codes. It
+    # is read from SQLite once, published with every snapshot, and serves
+    # every stop lookup the engine and the API make.
+
+    def __init__(self, ids: List[str], names: List[str], latitudes: np.ndarray, longitudes: np.ndarray,
+                 mode_codes: np.ndarray, mode_names: List[str]):
+        self.ids = ids
+        self.names = names
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.mode_codes = mode_codes
+        self.mode_names = mode_names
+        self.index: Dict[str, int] = {stop_id: idx for idx, stop_id in enumerate(ids)}
+        self._latitudes = memoryview(latitudes)
+        self._longitudes = memoryview(longitudes)
+        self._mode_codes = memoryview(mode_codes)
+
+    @classmethod
+    def from_points(cls, points) -> 'StopTable':
+        ids, names, latitudes, longitudes, modes = [], [], [], [], []
+        mode_index = {}
+        for point in points:
+            ids.append(point.point_id)
+            names.append(point.name)
+            latitudes.append(point.latitude)
+            longitudes.append(point.longitude)
+            modes.append(mode_index.setdefault(point.mode, len(mode_index)))
+        return cls(ids, names, np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64),
+                   np.array(modes, dtype=np.int8), list(mode_index))
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, List[str]]]:
+        arrays = {'latitudes': self.latitudes, 'longitudes': self.longitudes, 'mode_codes': self.mode_codes}
+        strings = {'ids': self.ids, 'names': self.names, 'mode_names': self.mode_names}
+        return arrays, strings
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], strings: Dict[str, List[str]]) -> 'StopTable':
+        return cls(strings['ids'], strings['names'], arrays['latitudes'], arrays['longitudes'],
+                   arrays['mode_codes'], strings['mode_names'])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, stop_id: str) -> bool:
+        return stop_id in self.index
+
+    def name(self, stop_id: str) -> str:
+        # Unknown stops are shown by their id, as the Point lookups did.
+        idx = self.index.get(stop_id)
+        return self.names[idx] if idx is not None else stop_id
+
+    def mode(self, stop_id: str) -> Optional[str]:
+        idx = self.index.get(stop_id)
+        return self.mode_names[self._mode_codes[idx]] if idx is not None else None
+
+    def coords(self, stop_id: str) -> Optional[Tuple[float, float]]:
+        # (longitude, latitude), the order the geometry code uses
+        idx = self.index.get(stop_id)
+        if idx is None:
+            return None
+        return (self._longitudes[idx], self._latitudes[idx])
+
+
+@lru_cache(maxsize=1)
+def load_stop_table() -> StopTable:
+    # The Point table only changes when the offline stages rerun, so it is
+    # read once per process.
+    try:
+        db = connect_db()
+    except:
+        from data import db
+    return StopTable.from_points(Point.select())
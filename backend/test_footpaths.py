@@ -0,0 +1,70 @@
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from footpaths import FootpathGraph
+
+
+def random_walking(seed, n_stops=50, p=0.2):
+    # walking_distances.json's layout; some stops only ever appear as targets
+    rnd = random.Random(seed)
+    stops = [f"490{i:05d}" for i in range(n_stops)]
+    walking = {}
+    for stop in stops[:n_stops - 5]:
+        neighbors = {other: float(rnd.randint(30, 1800)) for other in stops if other != stop and rnd.random() < p}
+        if neighbors or rnd.random() < 0.5:
+            walking[stop] = neighbors
+    return walking
+
+
+class FootpathGraphTest(unittest.TestCase):
+    def assertSameWalks(self, graph, walking, max_duration=float('inf')):
+        for stop, stop_id in enumerate(graph.stop_ids):
+            walks = graph.walks_from(stop, max_duration)
+            durations = [duration for _, duration in walks]
+            self.assertEqual(durations, sorted(durations))
+            expected = {neighbor: duration for neighbor, duration in walking.get(stop_id, {}).items()
+                        if duration <= max_duration}
+            self.assertEqual({graph.stop_ids[neighbor]: duration for neighbor, duration in walks}, expected)
+
+    def test_from_dict_keeps_every_walk(self):
+        for seed in range(3):
+            walking = random_walking(seed)
+            graph = FootpathGraph.from_dict(walking)
+            with self.subTest(seed=seed):
+                self.assertEqual(len(graph.neighbors), sum(len(neighbors) for neighbors in walking.values()))
+                self.assertSameWalks(graph, walking)
+                # the limit is a bisect over each stop's sorted walk times
+                self.assertSameWalks(graph, walking, 600)
+                self.assertEqual(graph.walks_from(len(graph.stop_ids), 600), [])
+
+    def test_save_load_round_trip(self):
+        walking = random_walking(4)
+        graph = FootpathGraph.from_dict(walking)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "walking_distances.bin")
+            graph.save(path)
+            loaded = FootpathGraph.load(path)
+            self.assertEqual(loaded.stop_ids, graph.stop_ids)
+            for name, arr in graph.to_arrays().items():
+                np.testing.assert_array_equal(loaded.to_arrays()[name], arr)
+                self.assertEqual(loaded.to_arrays()[name].dtype, arr.dtype)
+            self.assertSameWalks(loaded, walking, 900)
+
+    def test_resized_adds_stops_without_walks(self):
+        graph = FootpathGraph.from_dict(random_walking(5))
+        num_stops = len(graph.stop_ids)
+        self.assertIs(graph.resized(num_stops), graph)
+        grown = graph.resized(num_stops + 3)
+        self.assertEqual(len(grown.offsets), num_stops + 4)
+        for stop in range(num_stops):
+            self.assertEqual(grown.walks_from(stop, 1800), graph.walks_from(stop, 1800))
+        for stop in range(num_stops, num_stops + 3):
+            self.assertEqual(grown.walks_from(stop, 1800), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
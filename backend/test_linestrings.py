@@ -0,0 +1,154 @@
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import linestrings
+from geometry import distance
+from linestrings import LinestringStore, load_linestrings
+
+# linestrings.json's layout: each route's polyline as a JSON string, with
+# empty and one-point routes among them
+LINESTRINGS = {
+    "1": json.dumps([[[-0.100, 51.5], [-0.099, 51.5], [-0.098, 51.5], [-0.097, 51.5], [-0.096, 51.5]]]),
+    "2": "",
+    "3": json.dumps([[[-0.1, 51.5]]]),
+    "4": json.dumps([[[-0.1, 51.5], [-0.1, 51.501], [-0.1, 51.502]]]),
+}
+# s0 sits on a vertex of route 1, s1 beside its third segment
+ROUTE_STOPS = {
+    "1": {"s0": (-0.099, 51.5), "s1": (-0.0975, 51.5001)},
+    "4": {"s2": (-0.1001, 51.5005)},
+}
+
+
+def scan_extract(linestring, origin_coord, dest_coord):
+    # full_api's extract_partial_linestring before the store, without its
+    # prints; its BFS along the polyline is the run of vertices between the
+    # two cut points
+    coords = json.loads(linestring)[0]
+
+    def closest(target):
+        best = (float('inf'), 0, None)
+        for i in range(len(coords) - 1):
+            (x1, y1), (x2, y2) = coords[i], coords[i + 1]
+            seg_len_sq = (x2 - x1) ** 2 + (y2 - y1) ** 2
+            if seg_len_sq == 0:
+                projection = coords[i]
+            else:
+                t = max(0, min(1, ((target[0] - x1) * (x2 - x1) + (target[1] - y1) * (y2 - y1)) / seg_len_sq))
+                projection = (x1 + t * (x2 - x1), y1 + t * (y2 - y1))
+            dist = distance(target, projection)
+            if dist < best[0]:
+                best = (dist, i, projection)
+        return best[1], best[2]
+
+    origin_seg_idx, origin_projection = closest(origin_coord)
+    dest_seg_idx, dest_projection = closest(dest_coord)
+    origin_idx = dest_idx = None
+    for i, coord in enumerate(coords):
+        if distance(coord, origin_projection) < 0.001:
+            origin_idx = i
+        if distance(coord, dest_projection) < 0.001:
+            dest_idx = i
+    if origin_idx is None or dest_idx is None:
+        origin_idx = origin_seg_idx + 1 if origin_seg_idx + 1 < len(coords) else origin_seg_idx
+        dest_idx = dest_seg_idx + 1 if dest_seg_idx + 1 < len(coords) else dest_seg_idx
+    step = 1 if dest_idx >= origin_idx else -1
+    partial = [coords[i] for i in range(origin_idx, dest_idx + step, step)]
+    partial[0] = origin_projection
+    partial[-1] = dest_projection
+    return [[coord[1], coord[0]] for coord in partial]
+
+
+class LinestringStoreTest(unittest.TestCase):
+    def test_extract(self):
+        store = LinestringStore.build(LINESTRINGS, ROUTE_STOPS)
+        self.assertEqual(set(store.routes), {"1", "4"})
+        self.assertNotIn("2", store)
+        self.assertEqual(store.projections[("1", "s0")][1], 1)
+        self.assertEqual(store.projections[("1", "s1")][:2], (2, -1))
+
+        forward = store.extract("1", "s0", "s1", ROUTE_STOPS["1"]["s0"], ROUTE_STOPS["1"]["s1"])
+        np.testing.assert_allclose(forward, [[51.5, -0.099], [51.5, -0.098], [51.5, -0.0975]])
+        backward = store.extract("1", "s1", "s0", ROUTE_STOPS["1"]["s1"], ROUTE_STOPS["1"]["s0"])
+        np.testing.assert_allclose(backward, forward[::-1])
+
+    def test_stop_without_projection_is_memoised(self):
+        store = LinestringStore.build(LINESTRINGS, ROUTE_STOPS)
+        got = store.extract("4", "s2", "s9", ROUTE_STOPS["4"]["s2"], (-0.0999, 51.5018))
+        # off every vertex both ends cut at their segment's far vertex, so the
+        # origin's projection replaces the middle vertex
+        np.testing.assert_allclose(got, [[51.5005, -0.1], [51.5018, -0.1]])
+        self.assertIn(("4", "s9"), store.projections)
+
+    def test_save_load_round_trip(self):
+        store = LinestringStore.build(LINESTRINGS, ROUTE_STOPS)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "linestrings.bin")
+            store.save(path)
+            loaded = LinestringStore.load(path)
+            for name, arr in store.arrays.items():
+                np.testing.assert_array_equal(loaded.arrays[name], arr)
+            self.assertEqual(loaded.routes, store.routes)
+            self.assertEqual(loaded.projections, store.projections)
+            self.assertEqual(loaded.extract("1", "s1", "s0", ROUTE_STOPS["1"]["s1"], ROUTE_STOPS["1"]["s0"]),
+                             store.extract("1", "s1", "s0", ROUTE_STOPS["1"]["s1"], ROUTE_STOPS["1"]["s0"]))
+
+    def test_matches_cutting_each_leg_on_request(self):
+        # real routes, with stops on vertices and scattered near the line
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "linestrings.json")) as f:
+            routes = json.load(f)
+        rnd = random.Random(0)
+        sample = {route_id: routes[route_id] for route_id in rnd.sample(sorted(routes), 40)}
+        route_stops = {}
+        for route_id, linestring in sample.items():
+            if not linestring:
+                continue
+            coords = json.loads(linestring)[0]
+            stops = {}
+            for i in range(8):
+                lon, lat = rnd.choice(coords)
+                if i % 2:
+                    lon, lat = lon + rnd.uniform(-0.0005, 0.0005), lat + rnd.uniform(-0.0005, 0.0005)
+                stops[f"{route_id}-{i}"] = (lon, lat)
+            route_stops[route_id] = stops
+        store = LinestringStore.build(sample, route_stops)
+        for route_id, stops in route_stops.items():
+            for origin_id, dest_id in zip(list(stops), list(stops)[1:] + list(stops)[:1]):
+                with self.subTest(route_id=route_id, origin_id=origin_id, dest_id=dest_id):
+                    got = store.extract(route_id, origin_id, dest_id, stops[origin_id], stops[dest_id])
+                    expected = scan_extract(sample[route_id], stops[origin_id], stops[dest_id])
+                    np.testing.assert_allclose(got, expected, rtol=0, atol=1e-9)
+
+
+class LoadLinestringsTest(unittest.TestCase):
+    def test_builds_a_missing_bin_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "linestrings.bin")
+            with open(os.path.join(tmp, "linestrings.json"), "w") as f:
+                json.dump(LINESTRINGS, f)
+            with mock.patch("stops.load_stop_table"), \
+                    mock.patch.object(linestrings, "route_stops_from_connections", return_value=ROUTE_STOPS) as route_stops, \
+                    contextlib.redirect_stdout(io.StringIO()):
+                built = load_linestrings(path)
+                self.assertTrue(os.path.exists(path))
+                loaded = load_linestrings(path)
+            self.assertEqual(route_stops.call_count, 1)
+            self.assertEqual(loaded.projections, built.projections)
+
+    def test_nothing_to_build_from(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = load_linestrings(os.path.join(tmp, "linestrings.bin"))
+            self.assertEqual(store.routes, {})
+            self.assertFalse(os.listdir(tmp))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+import contextlib
+import heapq
+import io
+import random
+import unittest
+
+import numpy as np
+
+from footpaths import FootpathGraph
+from mcraptor import McRAPTOR
+from stops import StopTable
+from timetable import CompiledTimetable
+
+
+def synthetic_network(seed, n_stops=120, n_lines=25, trips_per_line=12, walk_p=0.02, walk_limit=600):
+    # Random lines over random stops, plus walks closed transitively up to
+    # walk_limit the way transfers.py closes walking_distances.json.
+    rnd = random.Random(seed)
+    stops = [f"s{i}" for i in range(n_stops)]
+    arrivaltimes = {}
+    for line in range(n_lines):
+        sequence = rnd.sample(stops, rnd.randint(3, 12))
+        vehicles = {}
+        for trip in range(trips_per_line):
+            t = 1000 + rnd.randint(0, 3600)
+            vehicles[f"v{trip}"] = []
+            for stop in sequence:
+                vehicles[f"v{trip}"].append((stop, t))
+                t += rnd.randint(30, 400)
+        arrivaltimes[f"L{line}"] = vehicles
+
+    walks = {}
+    for a in stops:
+        for b in stops:
+            if a < b and rnd.random() < walk_p:
+                walks.setdefault(a, {})[b] = walks.setdefault(b, {})[a] = float(rnd.randint(30, 500))
+    closed = {}
+    for source in walks:
+        best = {source: 0.0}
+        queue = [(0.0, source)]
+        while queue:
+            d, stop = heapq.heappop(queue)
+            if d > best[stop]:
+                continue
+            for neighbor, w in walks[stop].items():
+                if d + w <= walk_limit and d + w < best.get(neighbor, float('inf')):
+                    best[neighbor] = d + w
+                    heapq.heappush(queue, (d + w, neighbor))
+        closed[source] = {stop: d for stop, d in best.items() if stop != source}
+    return stops, arrivaltimes, closed
+
+
+def engine_for(arrivaltimes, walking, max_walking_distance=600, previous=None):
+    # McRAPTOR over in-memory data, without the stop database
+    footpaths = FootpathGraph.from_dict(walking)
+    engine = McRAPTOR.__new__(McRAPTOR)
+    engine.max_walking_distance = max_walking_distance
+    engine.meta = {}
+    engine.stops = StopTable([], [], np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int8), [])
+    engine.timetable = CompiledTimetable(arrivaltimes, extra_stops=footpaths.stop_ids,
+                                         previous=previous.timetable if previous is not None else None)
+    engine.footpaths = footpaths.resized(engine.timetable.num_stops)
+    engine._bounds = {}
+    engine._reverse = None
+    return engine
+
+
+def leave_by(journey, arrivaltimes):
+    # first boarding less the walk to it, from a route() journey's path
+    walked = 0
+    for segment in journey['path']:
+        if segment['type'] == 'walk':
+            walked += segment['walk_time']
+            continue
+        stops = dict(arrivaltimes[segment['route']][segment['vehicle']])
+        return stops[segment['from']] - walked
+    return journey['departure_time']
+
+
+def pareto(journeys):
+    kept = set()
+    for journey in sorted(journeys, key=lambda j: (-j[0], j[1], j[2])):
+        if not any(arr <= journey[1] and legs <= journey[2] for _, arr, legs in kept):
+            kept.add(journey)
+    return kept
+
+
+class RouteRangeTest(unittest.TestCase):
+    def test_matches_route_per_departure(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self._check_against_route()
+
+    def _check_against_route(self):
+        for seed in range(3):
+            stops, arrivaltimes, walking = synthetic_network(seed)
+            engine = engine_for(arrivaltimes, walking)
+            tt = engine.timetable
+            rnd = random.Random(seed)
+            for _ in range(12):
+                origin, destination = rnd.sample(stops, 2)
+                if origin not in tt.stop_index or destination not in tt.stop_index:
+                    continue
+                start, window = 1000 + rnd.randint(0, 2000), 1800
+
+                # every departure the profile considers, routed on its own
+                sources = [(tt.stop_index[origin], 0)]
+                sources += [(tt.stop_index[stop], int(w)) for stop, w in engine.get_walking_neighbors(origin)]
+                departures = {start}
+                for stop, w in sources:
+                    departures.update(t - w for t in tt.departures_at(stop, start + w, start + window + w))
+                expected = set()
+                for dep in departures:
+                    for journey in engine.route(origin, destination, dep, leave_by=start + window):
+                        if journey['num_legs'] == 0 and dep != start:
+                            continue
+                        expected.add((leave_by(journey, arrivaltimes), journey['arrival_time'], journey['num_legs']))
+
+                got = [(j['departure_time'], j['arrival_time'], j['num_legs'])
+                       for j in engine.route_range(origin, destination, start, window)]
+                with self.subTest(seed=seed, origin=origin, destination=destination, start=start):
+                    self.assertEqual(len(got), len(set(got)))
+                    self.assertEqual(set(got), pareto(expected))
+
+
+class PruningTest(unittest.TestCase):
+    def test_matches_unpruned(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self._check_against_unpruned()
+
+    def _check_against_unpruned(self):
+        networks = [(seed, dict(n_stops=200, n_lines=40)) for seed in range(3)]
+        # big enough that stops reach the target only through chains of walks
+        networks += [(seed, dict(n_stops=600, n_lines=120, trips_per_line=30, walk_p=0.01)) for seed in (2, 3)]
+        created = unpruned_created = 0
+        for seed, shape in networks:
+            stops, arrivaltimes, walking = synthetic_network(seed, **shape)
+            engine = engine_for(arrivaltimes, walking)
+            rnd = random.Random(seed)
+            queries = [(rnd.sample(stops, 2), 1000 + rnd.randint(0, 2000)) for _ in range(20)]
+            if shape['n_stops'] == 600 and seed == 2:
+                queries.append((['s173', 's315'], 1500))
+            for (origin, destination), departure_time in queries:
+                stats, unpruned_stats = {}, {}
+                got = engine.route(origin, destination, departure_time, stats=stats)
+                expected = engine.route(origin, destination, departure_time, prune=False, stats=unpruned_stats)
+                with self.subTest(seed=seed, origin=origin, destination=destination):
+                    self.assertEqual([(j['arrival_time'], j['num_legs']) for j in got],
+                                     [(j['arrival_time'], j['num_legs']) for j in expected])
+                    self.assertLessEqual(stats['labels_created'], unpruned_stats['labels_created'])
+                created += stats['labels_created']
+                unpruned_created += unpruned_stats['labels_created']
+        # pruning creates about 3.5x fewer labels on these networks
+        self.assertGreaterEqual(unpruned_created, 3 * created)
+
+def next_feed(arrivaltimes, rnd, structural=True):
+    # One reload's worth of churn: most predictions drift a few seconds,
+    # and with `structural` some trips finish a stop, vanish or appear
+    feed = {}
+    for line, vehicles in arrivaltimes.items():
+        feed[line] = {}
+        for vehicle, stops in vehicles.items():
+            stops = [(stop, t + rnd.randint(-20, 20)) for stop, t in stops]
+            if structural and rnd.random() < 0.05:
+                stops = stops[1:]
+            if structural and rnd.random() < 0.03:
+                continue
+            feed[line][vehicle] = stops
+        if structural and rnd.random() < 0.2 and vehicles:
+            template = next(iter(vehicles.values()))
+            shift = rnd.randint(-600, 600)
+            feed[line][f"new{rnd.randint(0, 10 ** 9)}"] = [(stop, t + shift) for stop, t in template]
+    return feed
+
+
+class TimetableUpdateTest(unittest.TestCase):
+    def assertSameTimetable(self, patched, scratch, arrivaltimes):
+        for line, vehicles in arrivaltimes.items():
+            for vehicle in vehicles:
+                self.assertEqual(patched.get_trip_stops(line, vehicle), scratch.get_trip_stops(line, vehicle))
+        for route_idx in range(patched.num_routes):
+            n_trips = patched.route_trip_count(route_idx)
+            times = patched.stop_times[patched.route_time_offsets[route_idx]:patched.route_time_offsets[route_idx + 1]]
+            self.assertTrue((np.diff(times.reshape(-1, n_trips), axis=1) >= 0).all() if n_trips else True)
+        def sequences_at(tt, stop_id):
+            return {(tt.route_names[r], tuple(tt.stop_ids[s] for s in tt.route_stop_list(r)))
+                    for r, _ in tt.routes_at(tt.stop_index[stop_id])}
+
+        for stop_id in patched.stop_ids:
+            routes = patched.routes_at(patched.stop_index[stop_id])
+            for route_idx, pos in routes:
+                self.assertGreater(patched.route_trip_count(route_idx), 0)
+                self.assertEqual(patched.stop_ids[patched.route_stop_list(route_idx)[pos]], stop_id)
+            # trips may be split into FIFO routes differently, but over the same sequences
+            expected = sequences_at(scratch, stop_id) if stop_id in scratch.stop_index else set()
+            self.assertEqual(sequences_at(patched, stop_id), expected)
+
+    def test_patched_matches_scratch(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self._check_patched_matches_scratch()
+
+    def _check_patched_matches_scratch(self):
+        for seed in range(3):
+            stops, arrivaltimes, walking = synthetic_network(seed)
+            rnd = random.Random(seed)
+            previous = engine_for(arrivaltimes, walking)
+            # enough cycles for emptied routes to force a full build
+            for cycle in range(10):
+                arrivaltimes = next_feed(arrivaltimes, rnd)
+                patched = engine_for(arrivaltimes, walking, previous=previous)
+                scratch = engine_for(arrivaltimes, walking)
+                with self.subTest(seed=seed, cycle=cycle):
+                    self.assertSameTimetable(patched.timetable, scratch.timetable, arrivaltimes)
+                    for _ in range(5):
+                        origin, destination = rnd.sample(stops, 2)
+                        departure_time = 1000 + rnd.randint(0, 2000)
+                        self.assertEqual(
+                            [(j['arrival_time'], j['num_legs']) for j in patched.route(origin, destination, departure_time)],
+                            [(j['arrival_time'], j['num_legs']) for j in scratch.route(origin, destination, departure_time)])
+                previous = patched
+
+    def test_drift_patches_in_place(self):
+        stops, arrivaltimes, walking = synthetic_network(0)
+        previous = engine_for(arrivaltimes, walking)
+        stop_times = previous.timetable.stop_times
+        # a uniform shift keeps every route FIFO, so no group is rebuilt
+        arrivaltimes = {line: {vehicle: [(stop, t + 7) for stop, t in trip] for vehicle, trip in vehicles.items()}
+                        for line, vehicles in arrivaltimes.items()}
+        patched = engine_for(arrivaltimes, walking, previous=previous).timetable
+        self.assertIs(patched.stop_times, stop_times)
+        self.assertEqual(patched.update_stats['groups_rebuilt'], 0)
+        self.assertEqual(patched.update_stats['trips_changed'], patched.update_stats['trips_patched'])
+        self.assertSameTimetable(patched, engine_for(arrivaltimes, walking).timetable, arrivaltimes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import json
+import unittest
+
+from route_params import MAX_DEPARTURE_OFFSET, MAX_WINDOW, parse_departure_time, parse_window
+
+NOW = 1_760_000_000
+
+
+class ParseDepartureTimeTest(unittest.TestCase):
+    def test_missing_is_now(self):
+        self.assertEqual(parse_departure_time(None, now=NOW), NOW)
+        self.assertEqual(parse_departure_time('', now=NOW), NOW)
+
+    def test_accepts_times_near_now(self):
+        self.assertEqual(parse_departure_time(NOW + 600, now=NOW), NOW + 600)
+        self.assertEqual(parse_departure_time(float(NOW) + 0.5, now=NOW), NOW)
+        self.assertEqual(parse_departure_time(str(NOW), now=NOW), NOW)
+        self.assertEqual(parse_departure_time(NOW - MAX_DEPARTURE_OFFSET, now=NOW), NOW - MAX_DEPARTURE_OFFSET)
+
+    def test_rejects(self):
+        for value in [True, False, 'abc', '1.5', [NOW], {'t': NOW}, json.loads('1e400'), float('nan'),
+                      NOW + MAX_DEPARTURE_OFFSET + 1, NOW - MAX_DEPARTURE_OFFSET - 1, 10 ** 30, 0]:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse_departure_time(value, now=NOW)
+
+
+class ParseWindowTest(unittest.TestCase):
+    def test_window(self):
+        self.assertIsNone(parse_window(None))
+        self.assertIsNone(parse_window(0))
+        self.assertEqual(parse_window('30'), 30)
+        for value in [True, 'abc', [30], -1, MAX_WINDOW + 1, json.loads('1e400')]:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse_window(value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import random
+import unittest
+from types import SimpleNamespace
+
+from search import StopSearch
+from stops import StopTable
+
+
+class FakeLines:
+    # the parts of LineTable the index reads
+    def __init__(self, line_counts):
+        self.line_counts = line_counts
+
+    def line_count(self, stop_id):
+        return self.line_counts.get(stop_id, 0)
+
+    def badges(self, stop_id):
+        return [{'id': f"L{i}", 'name': f"L{i}", 'color': '#ef4444', 'type': 'bus'} for i in range(self.line_count(stop_id))]
+
+
+def random_stops(seed, n_stops=400):
+    # names drawn from a few words so that names repeat across modes
+    rnd = random.Random(seed)
+    words = ["King's", "Cross", "Stratford", "Road", "Park", "Mile", "End", "Bow", "Church", "Green", "Ab", "Ba"]
+    points, line_counts = [], {}
+    for i in range(n_stops):
+        name = " ".join(rnd.sample(words, rnd.randint(1, 3)))
+        mode = rnd.choice(["bus", "bus", "bus", "tube", "rail", "dlr"])
+        points.append(SimpleNamespace(point_id=f"p{i}", name=name, mode=mode,
+                                      latitude=51.5 + rnd.random() / 10, longitude=-0.1 + rnd.random() / 10))
+        line_counts[f"p{i}"] = rnd.randint(0, 14)
+    return StopTable.from_points(points), FakeLines(line_counts)
+
+
+def scan_search(stops, lines, query, limit=20):
+    # /api/search before the index: filter every stop, keep one per name
+    # (rail first, then most lines), rank tube and rail first, then by lines
+    query = query.strip().lower()
+    if len(query) < 2:
+        return []
+    best = {}
+    for idx, stop_id in enumerate(stops.ids):
+        name = stops.names[idx]
+        if query not in name.lower():
+            continue
+        is_rail = stops.mode(stop_id) == 'rail'
+        if name in best:
+            existing_is_rail = stops.mode(best[name]) == 'rail'
+            if existing_is_rail and not is_rail:
+                continue
+            if is_rail == existing_is_rail and lines.line_count(stop_id) <= lines.line_count(best[name]):
+                continue
+        best[name] = stop_id
+
+    def rank(stop_id):
+        mode = stops.mode(stop_id).lower()
+        preferred = 'underground' in mode or 'tube' in mode or mode == 'rail'
+        return (0 if preferred else 1, -lines.line_count(stop_id))
+
+    return sorted(best.values(), key=rank)[:limit]
+
+
+class StopSearchTest(unittest.TestCase):
+    def test_matches_a_scan_of_every_stop(self):
+        for seed in range(3):
+            stops, lines = random_stops(seed)
+            index = StopSearch(stops, lines)
+            for query in ["cross", "KING", "king's c", "s c", "ab", "ba", "oa", "d p", "  park  ", "green end", "zz", "x"]:
+                for limit in (1, 20, 1000):
+                    with self.subTest(seed=seed, query=query, limit=limit):
+                        got = [result['id'] for result in index.search(query, limit)]
+                        self.assertEqual(got, scan_search(stops, lines, query, limit))
+
+    def test_result_fields(self):
+        stops, lines = random_stops(3)
+        result = StopSearch(stops, lines).search("stratford", 1)[0]
+        stop_id = result['id']
+        longitude, latitude = stops.coords(stop_id)
+        self.assertEqual(result, {
+            'id': stop_id,
+            'name': stops.names[stops.index[stop_id]],
+            'lat': latitude,
+            'lng': longitude,
+            'mode': stops.mode(stop_id),
+            'lines': lines.badges(stop_id)[:10],
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
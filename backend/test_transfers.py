@@ -0,0 +1,69 @@
+import unittest
+
+from data import Point
+from transfers import build_footpaths, close_footpaths, interchange_times
+
+
+def point(point_id, name, mode, north=0.0):
+    # a stop `north` metres up from a fixed spot near Stratford
+    return Point(point_id=point_id, name=name, mode=mode, longitude=-0.0035, latitude=51.5416 + north / 111195)
+
+
+STRATFORD = [
+    point("SRA", "Stratford (London)", "rail"),
+    point("940GZZLUSTD", "Stratford Underground Station", "tube", 80),
+    point("490G00001", "Stratford Station", "bus", 150),
+    point("490G00002", "Stratford Bus Station", "bus", 200),
+    # same name, another part of town
+    point("490G00003", "Stratford Station", "bus", 2000),
+]
+
+
+class InterchangeTimesTest(unittest.TestCase):
+    def test_station_complex(self):
+        transfers = interchange_times(STRATFORD)
+        expected = {
+            "SRA": {"940GZZLUSTD": 300, "490G00001": 240, "490G00002": 240},
+            "940GZZLUSTD": {"SRA": 300, "490G00001": 240, "490G00002": 240},
+            "490G00001": {"SRA": 240, "940GZZLUSTD": 240},
+            "490G00002": {"SRA": 240, "940GZZLUSTD": 240},
+        }
+        self.assertEqual({stop: dict(neighbors) for stop, neighbors in transfers.items()}, expected)
+
+    def test_bus_only_names_are_not_complexes(self):
+        points = [point("490A", "Mile End Station", "bus"), point("490B", "Mile End Station", "bus", 50)]
+        self.assertEqual(dict(interchange_times(points)), {})
+
+    def test_names_match_across_suffixes(self):
+        points = [point("KGX", "King's Cross", "rail"), point("940GZZLUKSX", "Kings Cross Underground Station", "tube", 100)]
+        self.assertEqual(interchange_times(points)["KGX"], {"940GZZLUKSX": 300})
+
+
+class BuildFootpathsTest(unittest.TestCase):
+    def test_interchanges_replace_street_walks_and_chain(self):
+        walking = {
+            "SRA": {"940GZZLUSTD": 500},
+            "940GZZLUSTD": {"490G00009": 400},
+            "490G00009": {"490G00010": 1500},
+        }
+        footpaths = build_footpaths(walking, STRATFORD)
+        self.assertEqual(footpaths["SRA"]["940GZZLUSTD"], 300)
+        # rail -> tube -> a stop the tube walks to, within MAX_WALK
+        self.assertEqual(footpaths["SRA"]["490G00009"], 700)
+        # 1900 seconds on from the tube, past MAX_WALK
+        self.assertNotIn("490G00010", footpaths["SRA"])
+        self.assertNotIn("490G00010", footpaths["940GZZLUSTD"])
+        self.assertEqual(footpaths["490G00009"], {"490G00010": 1500})
+
+    def test_closure_is_shortest_and_bounded(self):
+        walking = {"a": {"b": 100, "c": 500}, "b": {"c": 100}, "c": {"d": 300}}
+        self.assertEqual(close_footpaths(walking, max_walk=450), {
+            "a": {"b": 100, "c": 200},
+            "b": {"c": 100, "d": 400},
+            "c": {"d": 300},
+        })
+        self.assertEqual(walking["a"], {"b": 100, "c": 500})
+
+
+if __name__ == '__main__':
+    unittest.main()
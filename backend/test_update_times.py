@@ -0,0 +1,355 @@
+import contextlib
+import io
+import itertools
+import json
+import random
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import update_times
+from static_timetables import RouteTimetable, TubeTimetable
+from update_times import addBusTimes, addTubeTimes, iterJsonArray
+
+
+class FakeResponse:
+    # A requests response whose body arrives in the given chunks
+    def __init__(self, body, chunks=None):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size=1):
+        chunks = self.chunks or [self.body[i:i + chunk_size] for i in range(0, len(self.body), chunk_size)]
+        yield from chunks
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def synthetic_bus_timetable(seed, fractional=False):
+    # bus_timetable.json's shape: some directions with one route, some with
+    # two (which are never predicted), some routes without intervals or
+    # start times
+    rnd = random.Random(seed)
+    stops = [f"490{i:05d}" for i in range(60)]
+    timetable = {}
+    for line in range(8):
+        timetable[str(line)] = {}
+        for direction in ("inbound", "outbound"):
+            routes = {}
+            for _ in range(rnd.choice([1, 1, 1, 2])):
+                sequence = rnd.sample(stops, rnd.randint(4, 12))
+                route = {}
+                if rnd.random() < 0.9:
+                    minutes, intervals = 0, []
+                    for stop in sequence:
+                        intervals.append([stop, minutes])
+                        minutes += rnd.randint(1, 4) + (rnd.choice([0, 0.5, 0.25]) if fractional else 0)
+                    # a stop visited twice keeps its last minutes
+                    if rnd.random() < 0.2:
+                        intervals.append([sequence[1], minutes])
+                    route["intervals"] = intervals
+                    if rnd.random() < 0.8:
+                        route["start_times"] = sorted(rnd.sample(range(0, 86400, 60), 20))
+                routes[f"{sequence[0]}:{sequence[-1]}"] = route
+            timetable[str(line)][direction] = routes
+    return timetable, stops
+
+
+def synthetic_bus_feed(seed, timetable, stops, n_vehicles=40):
+    # Arrivals entries for vehicles running somewhat late along a route, plus
+    # stops the timetable doesn't know
+    rnd = random.Random(seed)
+    now = int(time.time())
+    feed = []
+    for vehicle in range(n_vehicles):
+        line = rnd.choice(list(timetable))
+        direction = rnd.choice(["inbound", "outbound"])
+        route = rnd.choice(list(timetable[line][direction].values()))
+        intervals = route.get("intervals") or [[stop, i] for i, stop in enumerate(rnd.sample(stops, 5))]
+        t = now + rnd.randint(0, 1200)
+        first = rnd.randint(0, len(intervals) - 2)
+        observed = intervals[first:first + rnd.randint(1, 5)]
+        if rnd.random() < 0.2:
+            observed = observed + [[rnd.choice(stops), 0]]
+        for stop, minutes in observed:
+            arrival = t + minutes * 60 + rnd.randint(-60, 240)
+            feed.append({
+                "lineId": line,
+                "vehicleId": f"V{vehicle}",
+                "direction": direction,
+                "naptanId": stop,
+                "expectedArrival": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.localtime(arrival)),
+                "currentLocation": "",
+            })
+    rnd.shuffle(feed)
+    return feed
+
+
+def run_add_bus_times(timetable, body, chunk_size=None):
+    # addBusTimes on a canned feed, streamed in chunk_size pieces, or without
+    # chunk_size parsed whole with response.json() as before streaming
+    if chunk_size:
+        parse = lambda response: iterJsonArray(response, chunk_size)
+    else:
+        parse = lambda response: iter(response.json())
+    arrivaltimes, points, vehicles = {}, [], set()
+    with mock.patch.object(update_times, "load_bus_timetable", return_value=RouteTimetable.build(timetable)), \
+            mock.patch.object(update_times.requests, "get", side_effect=lambda *args, **kwargs: FakeResponse(body)), \
+            mock.patch.object(update_times, "iterJsonArray", side_effect=parse), \
+            contextlib.redirect_stdout(io.StringIO()):
+        addBusTimes(arrivaltimes, points, vehicles)
+    return arrivaltimes, [point.to_line_protocol() for point in points], vehicles
+
+
+def baseline_add_bus_times(bustimetable, times):
+    # addBusTimes before predictions and future trips were batched: one loop
+    # per vehicle over bus_timetable.json itself
+    arrivaltimes = {}
+    latestinfo = {}
+    vehicle_info = {}
+    vehicle_directions = {}
+    for i in times:
+        line = i["lineId"]
+        vehicleId = i["vehicleId"]
+        direction = i["direction"]
+        arrivaltimes.setdefault(line, {}).setdefault(vehicleId, [])
+        vehicle_directions.setdefault(vehicleId, direction)
+        timeUnix = int(time.mktime(time.strptime(i["expectedArrival"], "%Y-%m-%dT%H:%M:%SZ")))
+        arrivaltimes[line][vehicleId].append((i["naptanId"], timeUnix))
+        latestinfo[line] = max(latestinfo.get(line, timeUnix), timeUnix)
+        vehicle_info.setdefault(vehicleId, {'line': line, 'direction': direction})
+
+    for vehicle in list(vehicle_info.keys()):
+        line = vehicle_info[vehicle]['line']
+        sorted_by_time = sorted(arrivaltimes[line][vehicle], key=lambda x: x[1])
+        if line not in bustimetable:
+            continue
+        routes = bustimetable[line][vehicle_directions[vehicle]]
+        if len(routes) != 1:
+            continue
+        try:
+            timetable = routes[list(routes.keys())[0]]
+            if "intervals" not in timetable:
+                continue
+            stop_intervals = {}
+            for stop in timetable['intervals']:
+                stop_intervals[stop[0]] = stop[1]
+            earliest_stop = None
+            earliest_interval_time = None
+            for stop in sorted_by_time:
+                if stop[0] in stop_intervals:
+                    earliest_stop = stop
+                    earliest_interval_time = stop_intervals[stop[0]]
+                    break
+            differences = []
+            already_included = []
+            last_actual = earliest_stop[1]
+            last_interval = earliest_interval_time
+            for stop in sorted_by_time:
+                if stop[0] in stop_intervals:
+                    already_included.append(stop[0])
+                    expected_time = last_actual + ((stop_intervals[stop[0]] - last_interval) * 60)
+                    differences.append(stop[1] - expected_time)
+                    last_actual = stop[1]
+                    last_interval = stop_intervals[stop[0]]
+            delay_per_stop = max(int(np.median(differences)), 0)
+            last_actual = earliest_stop[1]
+            last_interval = earliest_interval_time
+            for stop, interval in stop_intervals.items():
+                if stop not in already_included and interval > earliest_interval_time:
+                    predicted_time = last_actual + ((interval - last_interval) * 60) + delay_per_stop
+                    arrivaltimes[line][vehicle].append((stop, predicted_time))
+                    last_actual = predicted_time
+                    last_interval = interval
+        except Exception:
+            pass
+
+    for line in bustimetable:
+        if line not in latestinfo:
+            continue
+        for direction in bustimetable[line]:
+            for routeCode, route in bustimetable[line][direction].items():
+                start = routeCode.split(":")[0]
+                if "start_times" not in route:
+                    continue
+                for start_time in route["start_times"]:
+                    unixstart = update_times.start_of_day_epoch + start_time
+                    if unixstart > latestinfo[line] + 300:
+                        arrivaltimes[line][f"T{unixstart}"] = [(start, unixstart)]
+                        for interval in route["intervals"]:
+                            arrivaltimes[line][f"T{unixstart}"].append((interval[0], unixstart + (interval[1] * 60)))
+    return arrivaltimes
+
+
+TUBE_STOP_NAMES = {
+    "940GZZLUAAA": "Alpha",
+    "940GZZLUBBB": "Bravo",
+    "940GZZLUCCC": "Charlie Cross",
+    "940GZZLUDDD": "Delta",
+    "940GZZLUEEE": "Echo Park",
+}
+
+
+def synthetic_tube_timetable(order):
+    # One line, A-B-C-D-E, with routes the whole way in both directions and
+    # short runs to C from either end. Only the full-length routes run today,
+    # one train each that left half an hour ago
+    a, b, c, d, e = sorted(TUBE_STOP_NAMES)
+    started = int(time.time() - update_times.start_of_day_epoch) - 1800
+    today = {time.strftime("%A"): [[0, started]]}
+    routes = {
+        f"{a}:{e}": {"intervals": [[[a, 0], [b, 2], [c, 4], [d, 6], [e, 8]]], "schedules": today},
+        f"{e}:{a}": {"intervals": [[[e, 0], [d, 2], [c, 4], [b, 6], [a, 8]]], "schedules": today},
+        f"{a}:{c}": {"intervals": [[[a, 0], [b, 2], [c, 4]]]},
+        f"{e}:{c}": {"intervals": [[[e, 0], [d, 2], [c, 4]]]},
+    }
+    return {"victoria": {code: routes[code] for code in order(list(routes))}}
+
+
+def tube_arrivals(vehicle, towards, stops):
+    # Arrivals entries for one train at (stop, unix time) pairs
+    return [{
+        "lineId": "victoria",
+        "vehicleId": vehicle,
+        "towards": towards,
+        "naptanId": stop,
+        "destinationNaptanId": "",
+        "expectedArrival": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.localtime(at)),
+    } for stop, at in stops]
+
+
+def run_add_tube_times(timetable, feed):
+    arrivaltimes, points = {}, []
+    update_times.getTubeRoutesTowards.cache_clear()
+    try:
+        with mock.patch.object(update_times, "load_tube_timetable", return_value=TubeTimetable.build(timetable)), \
+                mock.patch.object(update_times, "getStopName", side_effect=TUBE_STOP_NAMES.get), \
+                mock.patch.object(update_times.requests, "get", side_effect=lambda *args, **kwargs: FakeResponse(json.dumps(feed))), \
+                contextlib.redirect_stdout(io.StringIO()):
+            addTubeTimes(arrivaltimes, points)
+    finally:
+        # the memo holds route codes of the synthetic line
+        update_times.getTubeRoutesTowards.cache_clear()
+    return arrivaltimes.get("victoria", {})
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def elements(self, body, chunk_size=None, chunks=None):
+        return list(iterJsonArray(FakeResponse(body, chunks), chunk_size=chunk_size))
+
+    def test_elements_split_across_chunks(self):
+        values = [{"a": 1, "b": [1, 2, {"c": "x, y ]"}]}, "s", 3.5, None, [], {}]
+        body = " [ " + " , ".join(json.dumps(value) for value in values) + " ]\n"
+        for chunk_size in range(1, len(body) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.elements(body, chunk_size), values)
+
+    def test_multibyte_character_split_across_chunks(self):
+        values = [{"name": "Café — Łódź 🚌"}, "ü"]
+        body = json.dumps(values, ensure_ascii=False).encode()
+        for split in range(1, len(body)):
+            with self.subTest(split=split):
+                self.assertEqual(self.elements(body, chunks=[body[:split], body[split:]]), values)
+
+    def test_empty_array(self):
+        self.assertEqual(self.elements("[]", 1), [])
+        self.assertEqual(self.elements(" [ \n ] ", 2), [])
+
+    def test_truncated_body(self):
+        for body in ['[{"a": 1}, {"b"', '[1, 2', '[', '']:
+            with self.subTest(body=body):
+                with self.assertRaisesRegex(ValueError, "JSON array ended early"):
+                    self.elements(body, 3)
+
+    def test_not_an_array(self):
+        for body in ['{"a": [1]}', '"x"', '12']:
+            with self.subTest(body=body):
+                with self.assertRaisesRegex(ValueError, "Expected a JSON array"):
+                    self.elements(body, 4)
+
+
+class AddBusTimesTest(unittest.TestCase):
+    def test_streaming_matches_loading_whole_body(self):
+        for seed in range(3):
+            timetable, stops = synthetic_bus_timetable(seed)
+            body = json.dumps(synthetic_bus_feed(seed, timetable, stops), ensure_ascii=False)
+            expected = run_add_bus_times(timetable, body)
+            for chunk_size in (7, 1 << 10, 1 << 16):
+                with self.subTest(seed=seed, chunk_size=chunk_size):
+                    self.assertEqual(run_add_bus_times(timetable, body, chunk_size), expected)
+
+
+class PredictBusTimesTest(unittest.TestCase):
+    def test_matches_per_vehicle_loop(self):
+        for seed in range(6):
+            timetable, stops = synthetic_bus_timetable(seed, fractional=seed % 2 == 1)
+            feed = synthetic_bus_feed(seed, timetable, stops, n_vehicles=120)
+            # a line the timetable doesn't have
+            feed.append(dict(feed[0], lineId="N999", vehicleId="X1"))
+            with self.subTest(seed=seed):
+                got = run_add_bus_times(timetable, json.dumps(feed))[0]
+                expected = baseline_add_bus_times(timetable, feed)
+                # with fractional minutes anywhere in the timetable, whole
+                # times come back as floats; the compiled timetable casts them
+                self.assertEqual(got, expected)
+
+
+class AddTubeTimesTest(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b, self.c, self.d, self.e = sorted(TUBE_STOP_NAMES)
+        self.now = int(time.time())
+
+    def times_for(self, vehicle, towards, stops):
+        # the train's arrivals under every order of the line's routes, since
+        # route choice must not depend on it
+        results = []
+        for order in itertools.permutations(range(4)):
+            timetable = synthetic_tube_timetable(lambda codes: [codes[i] for i in order])
+            results.append(run_add_tube_times(timetable, tube_arrivals(vehicle, towards, stops)))
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
+        return results[0][f"{vehicle}/victoria"]
+
+    def test_towards_match_wins_a_tie_with_an_interval_match(self):
+        # B then C fits both A:E and the short A:C, but only A:E runs towards
+        # Echo Park; its timetable predicts D and E, A:C would predict nothing
+        t = self.now
+        got = self.times_for("001", "Echo Park", [(self.b, t), (self.c, t + 180)])
+        # a minute behind at C: half a minute's median delay carried on
+        self.assertEqual(got, [(self.b, t), (self.c, t + 180), (self.d, t + 270), (self.e, t + 390)])
+
+    def test_no_towards_match_falls_back_to_intervals(self):
+        # only E:A calls at C then B, and the train is on time
+        t = self.now
+        got = self.times_for("002", "Check Front of Train", [(self.c, t), (self.b, t + 120)])
+        self.assertEqual(got, [(self.c, t), (self.b, t + 120), (self.a, t + 240)])
+
+    def test_no_route_keeps_the_observed_stops(self):
+        # no route calls at B, D then C; the stop off the line is dropped
+        t = self.now
+        stops = [(self.b, t), (self.d, t + 120), ("940GZZLUZZZ", t + 180), (self.c, t + 240)]
+        got = self.times_for("003", "Check Front of Train", stops)
+        self.assertEqual(got, [(self.b, t), (self.d, t + 120), (self.c, t + 240)])
+
+    def test_station_served_by_several_routes(self):
+        # every route but E:C calls at B, and two routes end at Charlie Cross,
+        # so neither train is pinned to a route
+        t = self.now
+        self.assertEqual(self.times_for("004", "Check Front of Train", [(self.b, t)]), [(self.b, t)])
+        self.assertEqual(self.times_for("005", "Charlie Cross", [(self.b, t)]), [(self.b, t)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,406 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# share of routes left empty by updates at which the next build starts afresh
+MAX_DEAD_ROUTES = 0.25
+
+
+class CompiledTimetable:
+    # Route-grouped, array-backed view of the live `arrivaltimes` dict.
+    #
+    # Stops are interned to integer ids. Trips sharing a line and an ordered
+    # stop sequence are grouped into one RAPTOR route, split further where
+    # trips overtake each other so every route stays FIFO. Times for route r
+    # live in `stop_times[route_time_offsets[r]:route_time_offsets[r + 1]]`
+    # stored position-major: the column for stop position p is the n_trips
+    # consecutive departures from that stop, sorted ascending, so the earliest
+    # catchable trip is a binary search.
+
+    def __init__(self, arrivaltimes: dict, extra_stops: Iterable[str] = (),
+                 previous: Optional['CompiledTimetable'] = None):
+        # With `previous`, the timetable compiled on the last reload, this is
+        # a diff against it: a route group (one line and stop sequence) that
+        # still holds the same trips has its changed time rows patched in
+        # place, and its trips re-sorted only if the patch broke the order.
+        # Groups that gained, lost or reordered trips are re-partitioned onto
+        # their old route indices, routes left over are emptied, and new
+        # routes are appended, so only affected routes are touched in the
+        # flat arrays and the stop -> route index. Route and stop indices stay
+        # stable until emptied routes pass MAX_DEAD_ROUTES, which forces a
+        # full build. `previous` is consumed: its arrays are patched and taken
+        # over, so it must not be used afterwards.
+        if previous is not None and (previous._slots is None
+                                     or previous._dead > MAX_DEAD_ROUTES * previous.num_routes):
+            previous = None
+        if previous is not None:
+            self.stop_ids: List[str] = previous.stop_ids
+            self.stop_index: Dict[str, int] = previous.stop_index
+            for name in self._ARRAYS:
+                setattr(self, name, getattr(previous, name))
+            self.route_names: List[str] = previous.route_names
+            self.trip_vehicles: List[str] = previous.trip_vehicles
+            self._slots = previous._slots
+            self._groups = previous._groups
+            self._dead = previous._dead
+        else:
+            self.stop_ids = []
+            self.stop_index = {}
+            self.route_stops = np.zeros(0, dtype=np.int32)
+            self.stop_times = np.zeros(0, dtype=np.int64)
+            self.stop_routes = np.zeros(0, dtype=np.int32)
+            self.stop_route_positions = np.zeros(0, dtype=np.int32)
+            self.route_stop_offsets = self.route_trip_offsets = self.route_time_offsets = np.zeros(1, dtype=np.int64)
+            self.stop_route_offsets = np.zeros(1, dtype=np.int64)
+            self.route_names = []
+            self.trip_vehicles = []
+            self._slots = {}   # (route_id, vehicle_id) -> (route index, trip position)
+            self._groups = {}  # (route_id, stop ids) -> route indices
+            self._dead = 0
+        self._trip_lookup = None
+        self.update_stats = {}
+        for stop_id in extra_stops:
+            self.intern(stop_id)
+
+        # One pass over the feed, which is rebuilt whole each reload. Groups
+        # are keyed by stop id strings, so only new routes' stops are interned.
+        groups = defaultdict(dict)  # (route_id, stop ids) -> {vehicle_id: times}
+        stop_of, time_of = itemgetter(0), itemgetter(1)
+        for route_id, vehicles in arrivaltimes.items():
+            for vehicle_id, stops in vehicles.items():
+                if len(stops) < 2:
+                    continue
+                ordered = sorted(stops, key=time_of)
+                groups[(route_id, tuple(map(stop_of, ordered)))][vehicle_id] = list(map(time_of, ordered))
+
+        dirty = self._patch_times(groups)
+        dirty.extend(key for key in self._groups if key not in groups)
+        self.update_stats['groups_rebuilt'] = len(dirty)
+        self._rebuild(dirty, groups)
+        self._bind_views()
+
+    def _patch_times(self, groups: dict) -> List[tuple]:
+        # Write the new times of every trip in a group whose routes hold the
+        # same vehicles as before over its row, then restore the column order
+        # of the routes that moved. Returns the groups that need
+        # re-partitioning: new ones, ones that gained or lost trips, and ones
+        # where a trip now overtakes another.
+        dirty = []
+        route_idx, trip_pos, lengths, times, owners = [], [], [], [], []
+        trip_offsets = self.route_trip_offsets
+        for key, trips in groups.items():
+            routes = self._groups.get(key)
+            if routes is None or sum(trip_offsets[r + 1] - trip_offsets[r] for r in routes) != len(trips):
+                dirty.append(key)
+                continue
+            route_id = key[0]
+            slots = [self._slots.get((route_id, vehicle_id)) for vehicle_id in trips]
+            if not all(slot is not None and slot[0] in routes for slot in slots):
+                dirty.append(key)
+                continue
+            for slot, trip_times in zip(slots, trips.values()):
+                route_idx.append(slot[0])
+                trip_pos.append(slot[1])
+                times.extend(trip_times)
+            lengths.extend([len(key[1])] * len(trips))
+            owners.extend([key] * len(trips))
+        self.update_stats.update(trips_changed=0, trips_patched=len(route_idx))
+        if not route_idx:
+            return dirty
+        route_idx = np.array(route_idx, dtype=np.int64)
+        lengths = np.array(lengths, dtype=np.int64)
+        times = np.array(times, dtype=np.int64)
+        n_trips = np.diff(self.route_trip_offsets)[route_idx]
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(len(times)) - np.repeat(starts, lengths)
+        index = (np.repeat(self.route_time_offsets[route_idx] + np.array(trip_pos, dtype=np.int64), lengths)
+                 + positions * np.repeat(n_trips, lengths))
+        changed = np.bincount(np.repeat(np.arange(len(lengths)), lengths)[self.stop_times[index] != times],
+                              minlength=len(lengths)) > 0
+        self.stop_times[index] = times
+        self.update_stats['trips_changed'] = int(changed.sum())
+
+        moved = np.unique(route_idx[changed]).tolist()
+        route_owners = dict(zip(route_idx.tolist(), owners)) if moved else {}
+        broken = {route_owners[route] for route in moved if not self._restore_order(route)}
+        return dirty + list(broken)
+
+    def _restore_order(self, route_idx: int) -> bool:
+        # Re-sort a patched route's trips so every stop's column ascends;
+        # False if no order of its trips does (some trip now overtakes).
+        first = self.route_trip_offsets[route_idx]
+        n_trips = self.route_trip_offsets[route_idx + 1] - first
+        start, end = self.route_time_offsets[route_idx], self.route_time_offsets[route_idx + 1]
+        block = self.stop_times[start:end].reshape(-1, n_trips)
+        if (np.diff(block, axis=1) >= 0).all():
+            return True
+        order = np.lexsort(block[::-1])
+        block = block[:, order]
+        if not (np.diff(block, axis=1) >= 0).all():
+            return False
+        self.stop_times[start:end] = block.ravel()
+        vehicles = self.trip_vehicles[first:first + n_trips]
+        self.trip_vehicles[first:first + n_trips] = [vehicles[i] for i in order.tolist()]
+        route_id = self.route_names[route_idx]
+        for pos, vehicle_id in enumerate(self.trip_vehicles[first:first + n_trips]):
+            self._slots[(route_id, vehicle_id)] = (route_idx, pos)
+        return True
+
+    def _rebuild(self, dirty: List[tuple], groups: dict):
+        # Re-partition the dirty groups: partitions take over the group's old
+        # route indices first, new routes are appended and leftovers emptied.
+        # The flat arrays are then re-laid around the replaced routes only.
+        blocks = {}      # route index -> (vehicle ids, position-major times)
+        new_routes = []  # (route_id, stop ids) of appended routes
+        emptied = []
+        # every dirty group's slots go before any are reassigned, as trips
+        # can move between them
+        group_routes = {key: self._groups.pop(key, []) for key in dirty}
+        for key, old_routes in group_routes.items():
+            for route_idx in old_routes:
+                first, end = self.route_trip_offsets[route_idx], self.route_trip_offsets[route_idx + 1]
+                for vehicle_id in self.trip_vehicles[first:end]:
+                    self._slots.pop((key[0], vehicle_id), None)
+        for key, old_routes in group_routes.items():
+            trips = groups.get(key)
+            if not trips:
+                emptied.extend(old_routes)
+                continue
+            routes = []
+            for i, partition in enumerate(self._fifo_partitions(list(trips.items()))):
+                if i < len(old_routes):
+                    route_idx = old_routes[i]
+                else:
+                    route_idx = self.num_routes + len(new_routes)
+                    new_routes.append(key)
+                routes.append(route_idx)
+                vehicle_ids = [vehicle_id for vehicle_id, _ in partition]
+                blocks[route_idx] = (vehicle_ids, np.array([times for _, times in partition], dtype=np.int64).T.ravel())
+                for pos, vehicle_id in enumerate(vehicle_ids):
+                    self._slots[(key[0], vehicle_id)] = (route_idx, pos)
+            emptied.extend(old_routes[len(routes):])
+            self._groups[key] = routes
+        for route_idx in emptied:
+            blocks[route_idx] = ([], np.zeros(0, dtype=np.int64))
+        self._dead += len(emptied)
+        if not blocks and len(self.stop_route_offsets) == self.num_stops + 1:
+            return
+
+        old_routes = self.num_routes
+        old_trip_offsets, old_time_offsets = self.route_trip_offsets, self.route_time_offsets
+        sequences = [np.array([self.intern(stop_id) for stop_id in stop_ids], dtype=np.int32)
+                     for _, stop_ids in new_routes]
+        self.route_names = self.route_names + [route_id for route_id, _ in new_routes]
+        stop_counts = np.concatenate([np.diff(self.route_stop_offsets), [len(seq) for seq in sequences]]).astype(np.int64)
+        trip_counts = np.concatenate([np.diff(old_trip_offsets), np.zeros(len(new_routes), dtype=np.int64)])
+        for route_idx, (vehicle_ids, _) in blocks.items():
+            trip_counts[route_idx] = len(vehicle_ids)
+        self.route_stops = np.concatenate([self.route_stops] + sequences)
+        self.route_stop_offsets = self._offsets(stop_counts)
+        self.route_trip_offsets = self._offsets(trip_counts)
+        self.route_time_offsets = self._offsets(stop_counts * trip_counts)
+
+        # untouched stretches of routes keep their layout and are block-copied
+        stop_times = np.empty(self.route_time_offsets[-1], dtype=np.int64)
+        trip_vehicles = []
+        done = 0
+        for route_idx in sorted(blocks) + [self.num_routes]:
+            stretch = min(route_idx, old_routes)
+            if done < stretch:
+                stop_times[self.route_time_offsets[done]:self.route_time_offsets[stretch]] = \
+                    self.stop_times[old_time_offsets[done]:old_time_offsets[stretch]]
+                trip_vehicles.extend(self.trip_vehicles[old_trip_offsets[done]:old_trip_offsets[stretch]])
+            if route_idx < self.num_routes:
+                vehicle_ids, times = blocks[route_idx]
+                stop_times[self.route_time_offsets[route_idx]:self.route_time_offsets[route_idx + 1]] = times
+                trip_vehicles.extend(vehicle_ids)
+            done = route_idx + 1
+        self.stop_times = stop_times
+        self.trip_vehicles = trip_vehicles
+
+        # stop -> (route, position) index: emptied routes' entries are cut
+        # out and appended routes' entries go last in each stop's run, which
+        # keeps runs in route order
+        offsets = np.concatenate([self.stop_route_offsets, np.repeat(self.stop_route_offsets[-1:],
+                                                                     self.num_stops + 1 - len(self.stop_route_offsets))])
+        if emptied:
+            removed = np.flatnonzero(np.isin(self.stop_routes, emptied))
+            removed_stops = np.searchsorted(offsets, removed, side='right') - 1
+            offsets = offsets - self._offsets(np.bincount(removed_stops, minlength=self.num_stops))
+            self.stop_routes = np.delete(self.stop_routes, removed)
+            self.stop_route_positions = np.delete(self.stop_route_positions, removed)
+        if new_routes:
+            first = self.route_stop_offsets[old_routes]
+            entry_stops = self.route_stops[first:]
+            entry_routes = np.repeat(np.arange(old_routes, self.num_routes, dtype=np.int32), stop_counts[old_routes:])
+            entry_positions = (np.arange(len(entry_stops), dtype=np.int64) + first
+                               - np.repeat(self.route_stop_offsets[old_routes:-1], stop_counts[old_routes:])).astype(np.int32)
+            order = np.argsort(entry_stops, kind='stable')
+            at = offsets[entry_stops[order] + 1]
+            self.stop_routes = np.insert(self.stop_routes, at, entry_routes[order])
+            self.stop_route_positions = np.insert(self.stop_route_positions, at, entry_positions[order])
+            offsets = offsets + self._offsets(np.bincount(entry_stops, minlength=self.num_stops))
+        self.stop_route_offsets = offsets
+
+    @property
+    def trip_lookup(self) -> Dict[Tuple[str, str], int]:
+        # (route_id, vehicle_id) -> trip id, built on first use
+        if self._trip_lookup is None:
+            trip_routes = np.repeat(np.arange(self.num_routes), np.diff(self.route_trip_offsets))
+            self._trip_lookup = {
+                (self.route_names[route_idx], vehicle_id): trip_idx
+                for trip_idx, (route_idx, vehicle_id) in enumerate(zip(trip_routes.tolist(), self.trip_vehicles))
+            }
+        return self._trip_lookup
+
+    @staticmethod
+    def _offsets(counts) -> np.ndarray:
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets
+
+    _ARRAYS = ('route_stops', 'route_stop_offsets', 'route_trip_offsets', 'route_time_offsets', 'stop_times',
+               'stop_route_offsets', 'stop_routes', 'stop_route_positions')
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, List[str]]]:
+        arrays = {name: getattr(self, name) for name in self._ARRAYS}
+        strings = {'stop_ids': self.stop_ids, 'route_names': self.route_names, 'trip_vehicles': self.trip_vehicles}
+        return arrays, strings
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], strings: Dict[str, List[str]]) -> 'CompiledTimetable':
+        # Rebuild around existing buffers (e.g. a mapped shared segment)
+        # without recompiling; only the lookup dicts are built locally.
+        self = cls.__new__(cls)
+        for name in cls._ARRAYS:
+            setattr(self, name, arrays[name])
+        self.stop_ids = strings['stop_ids']
+        self.stop_index = {stop_id: idx for idx, stop_id in enumerate(self.stop_ids)}
+        self.route_names = strings['route_names']
+        self.trip_vehicles = strings['trip_vehicles']
+        # only an in-process build can seed the next reload's diff
+        self._slots = None
+        self._groups = {}
+        self._dead = 0
+        self._trip_lookup = None
+        self._bind_views()
+        return self
+
+    def _bind_views(self):
+        # memoryviews give the round loop plain-int indexing and C-level bisect
+        # without numpy scalar overhead
+        self._route_stops = memoryview(self.route_stops)
+        self._route_stop_offsets = memoryview(self.route_stop_offsets)
+        self._route_trip_offsets = memoryview(self.route_trip_offsets)
+        self._route_time_offsets = memoryview(self.route_time_offsets)
+        self._stop_times = memoryview(self.stop_times)
+        self._stop_route_offsets = memoryview(self.stop_route_offsets)
+        self._stop_routes = memoryview(self.stop_routes)
+        self._stop_route_positions = memoryview(self.stop_route_positions)
+
+    @staticmethod
+    def _fifo_partitions(trips: List[Tuple[str, List[int]]]) -> List[List[Tuple[str, List[int]]]]:
+        partitions = []
+        for trip in sorted(trips, key=lambda t: t[1]):
+            times = trip[1]
+            for partition in partitions:
+                last = partition[-1][1]
+                if all(a <= b for a, b in zip(last, times)):
+                    partition.append(trip)
+                    break
+            else:
+                partitions.append([trip])
+        return partitions
+
+    def intern(self, stop_id: str) -> int:
+        idx = self.stop_index.get(stop_id)
+        if idx is None:
+            idx = len(self.stop_ids)
+            self.stop_index[stop_id] = idx
+            self.stop_ids.append(stop_id)
+        return idx
+
+    @property
+    def num_stops(self) -> int:
+        return len(self.stop_ids)
+
+    @property
+    def num_routes(self) -> int:
+        return len(self.route_names)
+
+    def routes_at(self, stop: int) -> List[Tuple[int, int]]:
+        if stop >= len(self._stop_route_offsets) - 1:
+            return []
+        start = self._stop_route_offsets[stop]
+        end = self._stop_route_offsets[stop + 1]
+        return list(zip(self._stop_routes[start:end].tolist(), self._stop_route_positions[start:end].tolist()))
+
+    def route_stop_list(self, route_idx: int) -> List[int]:
+        return self._route_stops[self._route_stop_offsets[route_idx]:self._route_stop_offsets[route_idx + 1]].tolist()
+
+    def route_trip_count(self, route_idx: int) -> int:
+        return self._route_trip_offsets[route_idx + 1] - self._route_trip_offsets[route_idx]
+
+    def earliest_trip(self, route_idx: int, pos: int, time: int, limit: int = -1) -> int:
+        # Index of the first trip departing `pos` at or after `time`, searching
+        # only trips before `limit` when given; -1 if none can be caught.
+        n_trips = self.route_trip_count(route_idx)
+        col = self._route_time_offsets[route_idx] + pos * n_trips
+        hi = col + (n_trips if limit < 0 else limit)
+        idx = bisect_left(self._stop_times, time, col, hi)
+        return idx - col if idx < hi else -1
+
+    def departures_at(self, stop: int, start: int, end: int) -> List[int]:
+        # Every departure from the stop in [start, end], across all routes.
+        times = []
+        for route_idx, pos in self.routes_at(stop):
+            n_trips = self.route_trip_count(route_idx)
+            col = self._route_time_offsets[route_idx] + pos * n_trips
+            lo = bisect_left(self._stop_times, start, col, col + n_trips)
+            hi = bisect_right(self._stop_times, end, lo, col + n_trips)
+            times.extend(self._stop_times[lo:hi].tolist())
+        return times
+
+    def trip_time(self, route_idx: int, pos: int, trip: int) -> int:
+        n_trips = self.route_trip_count(route_idx)
+        return self._stop_times[self._route_time_offsets[route_idx] + pos * n_trips + trip]
+
+    def trip_id(self, route_idx: int, trip: int) -> int:
+        return self._route_trip_offsets[route_idx] + trip
+
+    def trip_vehicle(self, route_idx: int, trip: int) -> str:
+        return self.trip_vehicles[self.trip_id(route_idx, trip)]
+
+    def trip_route(self, trip_idx: int) -> int:
+        return int(np.searchsorted(self.route_trip_offsets, trip_idx, side='right')) - 1
+
+    def ride_hops(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (from stop, to stop, seconds) for each pair of consecutive stops on
+        # every route, timed by the quickest of its trips between them.
+        sources, targets, durations = [], [], []
+        for route_idx in range(self.num_routes):
+            start, end = self.route_stop_offsets[route_idx], self.route_stop_offsets[route_idx + 1]
+            n_trips = self.route_trip_count(route_idx)
+            if not n_trips:
+                continue
+            times = self.stop_times[self.route_time_offsets[route_idx]:self.route_time_offsets[route_idx + 1]]
+            sources.append(self.route_stops[start:end - 1])
+            targets.append(self.route_stops[start + 1:end])
+            durations.append(np.diff(times.reshape(end - start, n_trips), axis=0).min(axis=1))
+        if not sources:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        return np.concatenate(sources), np.concatenate(targets), np.maximum(np.concatenate(durations), 0)
+
+    def get_trip_stops(self, route_id: str, vehicle_id: str) -> List[Tuple[str, int]]:
+        trip_idx = self.trip_lookup.get((route_id, vehicle_id))
+        if trip_idx is None:
+            return []
+        route_idx = self.trip_route(trip_idx)
+        trip = trip_idx - self._route_trip_offsets[route_idx]
+        return [
+            (self.stop_ids[stop], self.trip_time(route_idx, pos, trip))
+            for pos, stop in enumerate(self.route_stop_list(route_idx))
+        ]
@@ -0,0 +1,111 @@
+# Offline footpath preparation: station-complex interchanges plus the
+# transitive closure of the walking graph.
+#
+# walkingdist.py only measures stop pairs within about a kilometre, and the
+# router relaxes footpaths once per round without chaining walk labels, so a
+# two-hop walk would otherwise need an extra round. Closing the graph here
+# makes every walk the router can take a single edge. Stops of one station
+# complex (a rail CRS code, the tube NaPTAN and the bus stops outside, all
+# separate Point rows) also get explicit interchange times, because OSRM
+# routes between their coordinates along the street.
+import heapq
+import json
+import math
+import re
+import sys
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from data import Point, connect_db
+from footpaths import FootpathGraph
+from geometry import haversine
+
+# closure limit in seconds; matches the router's max_walking_distance
+MAX_WALK = 1800
+# stops of one complex are at most this far apart (metres)
+COMPLEX_RADIUS = 400
+# interchange time in seconds between two stops of one complex, by mode
+INTERCHANGE_TIME = 300
+INTERCHANGE_TIMES = {
+    frozenset(['bus']): 120,
+    frozenset(['bus', 'tube']): 240,
+    frozenset(['bus', 'rail']): 240,
+    frozenset(['tube']): 180,
+}
+
+_STATION_SUFFIX = re.compile(r"\b(underground|rail|dlr|overground|bus)?\s*station\b|\(.*?\)|[^a-z0-9 ]")
+
+
+def _station_name(name: str) -> str:
+    # "Stratford (London)", "Stratford Underground Station" and
+    # "Stratford Station" all become "stratford"; "King's" becomes "kings"
+    return " ".join(_STATION_SUFFIX.sub(" ", name.lower().replace("'", "").replace(".", "")).split())
+
+
+def interchange_times(points: Iterable[Point]) -> Dict[str, Dict[str, float]]:
+    # Transfer edges between the stops of each station complex: same station
+    # name, within COMPLEX_RADIUS, at least one of them not a bus stop.
+    by_name = defaultdict(list)
+    for point in points:
+        name = _station_name(point.name)
+        if name:
+            by_name[name].append(point)
+
+    transfers = defaultdict(dict)
+    for complex_points in by_name.values():
+        if all(point.mode == 'bus' for point in complex_points):
+            continue
+        lons = np.array([point.longitude for point in complex_points], dtype=np.float64)
+        lats = np.array([point.latitude for point in complex_points], dtype=np.float64)
+        within = haversine(lons[:, None], lats[:, None], lons[None, :], lats[None, :]) <= COMPLEX_RADIUS
+        for i, j in zip(*np.nonzero(within)):
+            a, b = complex_points[i], complex_points[j]
+            if a.point_id == b.point_id or (a.mode == 'bus' and b.mode == 'bus'):
+                continue
+            transfers[a.point_id][b.point_id] = INTERCHANGE_TIMES.get(frozenset([a.mode, b.mode]), INTERCHANGE_TIME)
+    return transfers
+
+
+def close_footpaths(walking: Dict[str, Dict[str, float]], max_walk: float = MAX_WALK) -> Dict[str, Dict[str, float]]:
+    # Shortest walk between every pair of stops connected within max_walk,
+    # via any number of footpaths; one bounded Dijkstra per stop.
+    closed = {}
+    for source in walking:
+        best = {source: 0.0}
+        heap = [(0.0, source)]
+        while heap:
+            duration, stop = heapq.heappop(heap)
+            if duration > best[stop]:
+                continue
+            for neighbor, walk_seconds in walking.get(stop, {}).items():
+                total = duration + walk_seconds
+                if total <= max_walk and total < best.get(neighbor, math.inf):
+                    best[neighbor] = total
+                    heapq.heappush(heap, (total, neighbor))
+        del best[source]
+        if best:
+            closed[source] = best
+    return closed
+
+
+def build_footpaths(walking: Dict[str, Dict[str, float]], points: List[Point],
+                    max_walk: float = MAX_WALK) -> Dict[str, Dict[str, float]]:
+    # Interchange times replace the OSRM times between stops of one complex.
+    merged = {stop_id: dict(neighbors) for stop_id, neighbors in walking.items()}
+    for stop_id, neighbors in interchange_times(points).items():
+        merged.setdefault(stop_id, {}).update(neighbors)
+    return close_footpaths(merged, max_walk)
+
+
+if __name__ == '__main__':
+    # python transfers.py walking_distances.json walking_distances.bin [max_walk_seconds]
+    connect_db()
+    with open(sys.argv[1], 'r') as f:
+        walking = json.load(f)
+    max_walk = float(sys.argv[3]) if len(sys.argv) > 3 else MAX_WALK
+    footpaths = build_footpaths(walking, list(Point.select()), max_walk)
+    graph = FootpathGraph.from_dict(footpaths)
+    graph.save(sys.argv[2])
+    print(f"Wrote {len(graph.neighbors)} footpaths between {len(graph.stop_ids)} stops to {sys.argv[2]}")
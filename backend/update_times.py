@@ -5,14 +5,18 @@ from peewee import *
 load_dotenv()
 import time
 import json
+import codecs
 import random
 from data import *
+from stops import load_stop_table
+from static_timetables import load_bus_timetable, load_tram_timetable, load_tube_timetable
 import numpy as np
 import statistics
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 from threading import Lock
 from collections import defaultdict
 import traceback
+from functools import lru_cache
 api_key = os.getenv("TFL_API_KEY")
 import influxdb_client, os, time
 from influxdb_client import InfluxDBClient, WritePrecision
@@ -22,9 +26,9 @@ token = os.environ.get("INFLUXDB_TOKEN")
 org = "local-org"
 url = "http://influxdb:8086"
 write_client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+# every vehicle seen by the last reload's feeds
 vehicles = set()
 arrivaltimes = {}
-stop_names = {}
 services = {}
 status_codes = defaultdict(int)
 
@@ -38,169 +42,245 @@ services_lock = Lock()
 
 status_lock = Lock()
 def getStopName(stop_id):
-    if stop_id in stop_names:
-        return stop_names[stop_id]
-    else:
-        try:
-            name = Point.get(Point.point_id == stop_id).name
-            stop_names[stop_id] = name
-            return name
-        except Point.DoesNotExist:
-            return stop_id
-            print(f"No point for stop {stop_id}; skipping")
-            return stop_id
+    return load_stop_table().name(stop_id)
+
+@lru_cache(maxsize=None)
+def getTubeRoutesTowards(line, towards):
+    # route codes of the line whose destination's name contains the first
+    # word of a train's "towards"; trains share a handful of these
+    word = towards.split(" ")[0].strip().lower()
+    return frozenset(routeCode for routeCode in load_tube_timetable().lines[line]
+                     if word in getStopName(routeCode.split(":")[1]).strip().lower())
 
 def getInMins(time_unix):
     return int((time_unix-time.time())/60)
 
-platforms = {}
-
-points = []
-def addBusTimes():
-    global arrivaltimes
+# seconds each feed's requests may take
+FEED_TIMEOUTS = {"tube": 30, "bus": 60, "tram": 30, "rail": 120}
+# seconds between reloads, and so the longest a reload waits on its feeds
+RELOAD_INTERVAL = 30
+feed_pool = ThreadPoolExecutor(max_workers=len(FEED_TIMEOUTS), thread_name_prefix="feed")
+# feed -> its run in progress, or a finished one no reload has collected yet
+feed_runs = {}
+# feed -> (start time, duration, arrivaltimes, platforms, points, vehicles) of
+# its last successful run
+feed_results = {}
+# seconds a feed's last result stands in for runs that fail or time out
+FEED_MAX_AGE = 300
+
+def iterJsonArray(response, chunk_size=1 << 16):
+    # Elements of a top-level JSON array, decoded as the body downloads
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    started = False
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        buffer = buffer[pos:] + utf8.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the element continues in the next chunk
+                break
+            if end == len(buffer) or buffer[end] not in " \t\r\n,]":
+                # a number cut off by the chunk (3. of 3.5) still decodes, so
+                # an element only counts once what follows it has arrived
+                break
+            pos = end
+            yield element
+    raise ValueError("JSON array ended early")
+
+def predictBusTimes(bustimetable, arrivaltimes, vehicle_info):
+    # Extends every bus on a single known route with its stops still to come,
+    # for the whole feed at once. A bus's delay per stop is the median of how
+    # far each gap between its observed stops overran the timetabled gap
+    # (never negative); its unobserved stops after the first observed one are
+    # chained from there, adding the timetabled gap plus that delay per stop.
+    groupVehicles = []
+    groupRoutes = []
+    obsCounts = []
+    obsStops = []
+    obsTimes = []
+    stopIndex = bustimetable.stop_index
+    for vehicle, info in vehicle_info.items():
+        line = info['line']
+        if line not in bustimetable.routes:
+            continue
+        routes = bustimetable.routes[line].get(info['direction'], [])
+        if len(routes) != 1 or not bustimetable.has_intervals[routes[0]]:
+            continue
+        observed = arrivaltimes[line][vehicle]
+        groupVehicles.append(vehicle)
+        groupRoutes.append(routes[0])
+        obsCounts.append(len(observed))
+        obsStops.extend([stopIndex.get(stop, -1) for stop, _ in observed])
+        obsTimes.extend([timeUnix for _, timeUnix in observed])
+
+    groupRoutes = np.array(groupRoutes, dtype=np.int64)
+    obsGroups = np.repeat(np.arange(len(groupVehicles)), obsCounts)
+    obsTimes = np.array(obsTimes, dtype=np.int64)
+    obsPositions = bustimetable.find_stops(groupRoutes[obsGroups], np.array(obsStops, dtype=np.int64))
+
+    # observed stops on the route, by vehicle then time (stable, as sorted() was)
+    matched = np.flatnonzero(obsPositions >= 0)
+    if len(matched):
+        matchedTimes = obsTimes[matched] - obsTimes[matched].min()
+        matched = matched[np.argsort(obsGroups[matched] * (matchedTimes.max() + 1) + matchedTimes, kind='stable')]
+    groups = obsGroups[matched]
+    positions = obsPositions[matched]
+    times = obsTimes[matched]
+    minutes = bustimetable.unique_minutes[positions]
+    isFirst = np.ones(len(groups), dtype=bool)
+    isFirst[1:] = groups[1:] != groups[:-1]
+    firsts = np.flatnonzero(isFirst)
+    # index into firsts of each observation's vehicle
+    owners = np.cumsum(isFirst) - 1
+
+    unmatched = np.ones(len(groupVehicles), dtype=bool)
+    unmatched[groups[firsts]] = False
+    for group in np.flatnonzero(unmatched).tolist():
+        print(f"Error predicting {vehicle_info[groupVehicles[group]]['line']}/{groupVehicles[group]}")
+    if not len(firsts):
+        return 0
+
+    # delay at each observed stop against the timetabled gap from the previous
+    # one (0 at the first), and the per-vehicle median as np.median takes it
+    previous = np.arange(len(groups)) - 1
+    previous[firsts] = firsts
+    delays = times - (times[previous] + (minutes - minutes[previous]) * 60)
+    sortedDelays = delays[np.lexsort((delays, groups))].astype(np.float64)
+    counts = np.diff(np.append(firsts, len(groups)))
+    medians = (sortedDelays[firsts + (counts - 1) // 2] + sortedDelays[firsts + counts // 2]) / 2
+    delayPerStop = np.maximum(np.trunc(medians), 0).astype(np.int64)
+
+    # each route's stops in timetable order, kept if after the first observed
+    # stop and not observed themselves
+    routeOffsets = bustimetable.unique_offsets
+    starts = routeOffsets[groupRoutes[groups[firsts]]]
+    lengths = routeOffsets[groupRoutes[groups[firsts]] + 1] - starts
+    # candidate index = route position + shift of the owning vehicle
+    shifts = np.cumsum(lengths) - lengths - starts
+    candOwners = np.repeat(np.arange(len(firsts)), lengths)
+    candPositions = np.arange(lengths.sum()) - np.repeat(shifts, lengths)
+    candMinutes = bustimetable.unique_minutes[candPositions]
+    observed = np.zeros(len(candPositions), dtype=bool)
+    observed[shifts[owners] + positions] = True
+    keep = (candMinutes > minutes[firsts][candOwners]) & ~observed
+    candOwners = candOwners[keep]
+    candPositions = candPositions[keep]
+    candMinutes = candMinutes[keep]
+
+    # each prediction is the previous one (the first observed time to begin
+    # with) plus the timetabled gap plus the delay. Laying a vehicle's terms
+    # out along a row and accumulating it adds them in that same order.
+    candFirst = np.ones(len(candOwners), dtype=bool)
+    candFirst[1:] = candOwners[1:] != candOwners[:-1]
+    candFirsts = np.flatnonzero(candFirst)
+    previousMinutes = np.empty_like(candMinutes)
+    previousMinutes[1:] = candMinutes[:-1]
+    previousMinutes[candFirsts] = minutes[firsts][candOwners[candFirsts]]
+    steps = (candMinutes - previousMinutes) * 60
+    ranks = np.arange(len(candOwners)) - np.repeat(candFirsts, np.diff(np.append(candFirsts, len(candOwners))))
+    terms = np.zeros((len(firsts), 2 * (ranks.max(initial=-1) + 1) + 1),
+                     dtype=np.result_type(times, steps, delayPerStop))
+    terms[:, 0] = times[firsts]
+    terms[candOwners, 2 * ranks + 1] = steps
+    terms[candOwners, 2 * ranks + 2] = delayPerStop[candOwners]
+    predicted = np.add.accumulate(terms, axis=1)[candOwners, 2 * ranks + 2]
+
+    stopIds = bustimetable.strings['stop_ids']
+    predictedStops = [stopIds[stop] for stop in bustimetable.unique_stops[candPositions].tolist()]
+    predicted = predicted.tolist()
+    bounds = np.append(candFirsts, len(candOwners)).tolist()
+    for owner, start, end in zip(candOwners[candFirsts].tolist(), bounds, bounds[1:]):
+        vehicle = groupVehicles[groups[firsts[owner]]]
+        arrivaltimes[vehicle_info[vehicle]['line']][vehicle].extend(zip(predictedStops[start:end], predicted[start:end]))
+    return len(candOwners)
+
+def addBusTimes(arrivaltimes, points, vehicles):
     url = "https://api.tfl.gov.uk/Mode/bus/Arrivals?count=-1"
-    response = requests.get(url, headers={"Authorization": f"Bearer {api_key}"})
-    times = response.json()
     latestinfo = {}
-    bustimetable = open("bus_timetable.json", "r").read()
-    bustimetable = json.loads(bustimetable)
-
-    print(f"Loaded {len(times)} times")
+    bustimetable = load_bus_timetable()
 
     vehicle_info = {}
 
     vehicle_directions = {}
 
-    for i in times:
-        line = i["lineId"]
-        vehicleId = i["vehicleId"]
-        direction = i["direction"]
-        if(i["currentLocation"]!=""):
-            print(f"{json.dumps(i, indent=4)}")
-        if vehicleId not in vehicles:
-            vehicles.add(vehicleId)
-        if line not in arrivaltimes:
-            arrivaltimes[line] = {}
-        if vehicleId not in arrivaltimes[line]:
-            arrivaltimes[line][vehicleId] = []
-        if not vehicleId in vehicle_directions: 
-            vehicle_directions[vehicleId] = direction
-        timeUnix = int(time.mktime(time.strptime(i["expectedArrival"], "%Y-%m-%dT%H:%M:%SZ")))
-        arrivaltimes[line][vehicleId].append((i["naptanId"], timeUnix))
-        if line not in latestinfo:
-            latestinfo[line] = timeUnix
-        else:
-            latestinfo[line] = max(latestinfo[line], timeUnix)
-        
-        # Track vehicle info for route extension
-        if vehicleId not in vehicle_info:
-            vehicle_info[vehicleId] = {
-                'line': line,
-                'direction': direction,
-                'stops': []
-            }
-        vehicle_info[vehicleId]['stops'].append((i["naptanId"], timeUnix))
-
-    predictions = 0
-
-    for vehicle in list(vehicle_info.keys()):
-        line = vehicle_info[vehicle]['line']
+    # expectedArrival strings repeat across thousands of predictions
+    arrival_times = {}
 
-        sorted_by_time = sorted(arrivaltimes[line][vehicle], key=lambda x: x[1])
-
-        earliest_interval_time = None
-        if line not in bustimetable:
-            continue
-
-        routes = bustimetable[line][vehicle_directions[vehicle]]
-        if(len(routes) == 1):
-            try:
-                timetable = routes[list(routes.keys())[0]]
-
-                if "intervals" not in timetable:
-                    continue
+    # tens of MB of predictions; fold each one in as it arrives instead of
+    # holding the body and the parsed list
+    times = 0
+    with requests.get(url, headers={"Authorization": f"Bearer {api_key}"}, timeout=FEED_TIMEOUTS["bus"], stream=True) as response:
+        response.raise_for_status()
+        for i in iterJsonArray(response):
+            times += 1
+            line = i["lineId"]
+            vehicleId = i["vehicleId"]
+            direction = i["direction"]
+            if vehicleId not in vehicles:
+                vehicles.add(vehicleId)
+            if line not in arrivaltimes:
+                arrivaltimes[line] = {}
+            if vehicleId not in arrivaltimes[line]:
+                arrivaltimes[line][vehicleId] = []
+            if not vehicleId in vehicle_directions: 
+                vehicle_directions[vehicleId] = direction
+            timeUnix = arrival_times.get(i["expectedArrival"])
+            if timeUnix is None:
+                timeUnix = arrival_times[i["expectedArrival"]] = int(time.mktime(time.strptime(i["expectedArrival"], "%Y-%m-%dT%H:%M:%SZ")))
+            arrivaltimes[line][vehicleId].append((i["naptanId"], timeUnix))
+            if line not in latestinfo:
+                latestinfo[line] = timeUnix
+            else:
+                latestinfo[line] = max(latestinfo[line], timeUnix)
+            
+            # Track vehicle info for route extension
+            if vehicleId not in vehicle_info:
+                vehicle_info[vehicleId] = {
+                    'line': line,
+                    'direction': direction,
+                }
 
-                stop_intervals = {}
-                for stop in timetable['intervals']:
-                    stop_intervals[stop[0]] = stop[1]
+    print(f"Loaded {times} times")
 
-                earliest_stop = None
-                earliest_interval_time = None
-                for stop in sorted_by_time:
-                    if stop[0] in stop_intervals:
-                        earliest_stop = stop
-                        earliest_interval_time = stop_intervals[stop[0]]
-                        break
+    predictions = predictBusTimes(bustimetable, arrivaltimes, vehicle_info)
 
-                differences = []
-                already_included = []
-                # lprint(f"Vehicle {vehicle} on line {line}")
-                
-                # Track cumulative delay
-                cumulative_delay = 0
-                last_actual = earliest_stop[1]
-                last_interval = earliest_interval_time
-                
-                for stop in sorted_by_time:
-                    if stop[0] in stop_intervals:
-                        already_included.append(stop[0])
-                        interval_diff = (stop_intervals[stop[0]] - last_interval) # In minutes
-                        expected_time = last_actual + (interval_diff * 60) # Convert to seconds
-                        delay = stop[1] - expected_time
-                        differences.append(delay)
-                        last_actual = stop[1]
-                        last_interval = stop_intervals[stop[0]]
-                        # lprint(f"A| {getStopName(stop[0])} {getInMins(stop[1])}mins")
-
-                # Use numpy median for more robust delay estimation
-                if differences:
-                    delay_per_stop = int(np.median(differences))
-                    if delay_per_stop < 0:
-                        delay_per_stop = 0
-                else:
-                    delay_per_stop = 60 # Default 1 minute delay if no data
-
-                # lprint(f"Using median delay of {delay_per_stop} seconds per stop")
-
-                # Reset to earliest known stop for predictions
-                last_actual = earliest_stop[1]
-                last_interval = earliest_interval_time
-
-                for stop, interval in stop_intervals.items():
-                    if stop not in already_included and interval > earliest_interval_time:
-                        interval_diff = (interval - last_interval) # In minutes
-                        predicted_time = last_actual + (interval_diff * 60) + delay_per_stop
-                        # lprint(f"P| {getStopName(stop)}: {getInMins(predicted_time)}mins")
-                        arrivaltimes[line][vehicle].append((stop, predicted_time))
-                        last_actual = predicted_time
-                        last_interval = interval
-                        predictions += 1
-            except:
-                print(f"Error predicting {line}/{vehicle}")
-    
     future_added = 0
-    for line in bustimetable:
+    for line in bustimetable.routes:
         if not line in latestinfo:
             print(f"No latest info for line {line}; skipping")
             continue
-        for direction in list(bustimetable[line].keys()):
-            for routeCode,route in bustimetable[line][direction].items():
+        for direction, routes in bustimetable.routes[line].items():
+            for route in routes:
+                routeCode = bustimetable.route_codes[route]
                 start = routeCode.split(":")[0]
                 end = routeCode.split(":")[1]
-                if "start_times" not in bustimetable[line][direction][routeCode]:
+                if not bustimetable.has_start_times[route]:
                     print(f"No start times for line {line} direction {direction} route {routeCode}")
                     continue
-                for start_time in bustimetable[line][direction][routeCode]["start_times"]:
-                    unixstart = start_of_day_epoch + start_time
-                    if unixstart > latestinfo[line]+300:
-                        future_added+=1
-                        arrivaltimes[line][f"T{unixstart}"] = [(start, unixstart)]
-
-                        for interval in bustimetable[line][direction][routeCode]["intervals"]:
-                            arrivaltimes[line][f"T{unixstart}"].append((interval[0], unixstart+(interval[1]*60)))
+                stops = [interval[0] for interval in bustimetable.intervals[route]]
+                for unixstart, arrivals in zip(*bustimetable.trips(route, start_of_day_epoch, latestinfo[line]+300)):
+                    future_added+=1
+                    arrivaltimes[line][f"T{unixstart}"] = [(start, unixstart), *zip(stops, arrivals)]
     
     points.append(InfluxPoint("bus_data").field("vehicles", len(vehicle_info)))
-    points.append(InfluxPoint("bus_data").field("times", len(times)))
+    points.append(InfluxPoint("bus_data").field("times", times))
     points.append(InfluxPoint("bus_data").field("future", future_added))
     points.append(InfluxPoint("bus_data").field("predictions", predictions))
 
@@ -210,15 +290,12 @@ def addBusTimes():
     # print(f"{len(vehicles)} vehicles for all lines")
     # print(f"{len(arrivaltimes)} lines for all directions")
 
-def addTramTimes():
-    global arrivaltimes
-    vehicles.clear()
-    tramtimetable = open("tram_timetable.json", "r").read()
-    tramtimetable = json.loads(tramtimetable)
+def addTramTimes(arrivaltimes, points, vehicles):
+    tramtimetable = load_tram_timetable()
 
-    print(f"Loaded {len(tramtimetable)} tram times")
+    print(f"Loaded {len(tramtimetable.routes)} tram times")
 
-    response = requests.get(f"https://api.tfl.gov.uk/Mode/tram/Arrivals?count=-1", headers={"Authorization": f"Bearer {api_key}"})
+    response = requests.get(f"https://api.tfl.gov.uk/Mode/tram/Arrivals?count=-1", headers={"Authorization": f"Bearer {api_key}"}, timeout=FEED_TIMEOUTS["tram"])
     times = response.json()
 
     # open("tram_arrivaltimes.json", "w").write(json.dumps(times, indent=4))
@@ -243,28 +320,25 @@ def addTramTimes():
         else:
             latestinfo[line] = max(latestinfo[line], timeUnix)
 
-    for line in tramtimetable:
+    for line in tramtimetable.routes:
         if not line in latestinfo:
             print(f"No latest info for line {line}; skipping")
             continue
-        for name in tramtimetable[line]:
-            if "start_times" not in tramtimetable[line][name]:
+        for route in tramtimetable.routes[line].get("", []):
+            name = tramtimetable.route_codes[route]
+            if not tramtimetable.has_start_times[route]:
                 print(f"No start times for line {line} name {name}")
                 continue
-            for start_time in tramtimetable[line][name]["start_times"]:
-                unixstart = start_of_day_epoch + start_time
-                if unixstart > latestinfo[line]:
-                    arrivaltimes[line][f"T{unixstart}"] = []
-                    for interval in tramtimetable[line][name]["intervals"]:
-                        arrivaltimes[line][f"T{unixstart}"].append((interval[0], unixstart+(interval[1]*60)))
+            stops = [interval[0] for interval in tramtimetable.intervals[route]]
+            for unixstart, arrivals in zip(*tramtimetable.trips(route, start_of_day_epoch, latestinfo[line])):
+                arrivaltimes[line][f"T{unixstart}"] = list(zip(stops, arrivals))
 
 
     print(f"{len(vehicles)} vehicles for all lines")
     print(f"{len(arrivaltimes)} lines for all directions")
 
-def addTubeTimes():
-    global points
-    response = requests.get(f"https://api.tfl.gov.uk/Mode/tube/Arrivals?count=-1", headers={"Authorization": f"Bearer {api_key}"})
+def addTubeTimes(arrivaltimes, points):
+    response = requests.get(f"https://api.tfl.gov.uk/Mode/tube/Arrivals?count=-1", headers={"Authorization": f"Bearer {api_key}"}, timeout=FEED_TIMEOUTS["tube"])
     times = response.json()
 
     # open("tube_times.json", "w+").write(json.dumps(times, indent=4))
@@ -279,8 +353,7 @@ def addTubeTimes():
         "940GZZLUNDN": ["metropolitan"]
     }
 
-    tube_timetable = open("tube_timetable2.json", "r").read()
-    tube_timetable = json.loads(tube_timetable)
+    tube_timetable = load_tube_timetable()
 
     current_day = time.strftime("%A")
     for arrival in times:
@@ -306,30 +379,11 @@ def addTubeTimes():
 
     vehiclesWithOnePossible = 0
 
-    # { line: [naptanId, naptanId, naptanId, ...]}
-    possibleStops = {}
-
-    for line in tube_timetable:
-        if not line in possibleStops:
-            possibleStops[line] = []
-        linePossibleStops = set()
-        for routeCode,route in tube_timetable[line].items():
-            for interval in route["intervals"]:
-                for stop in interval:
-                    if not stop[0] in linePossibleStops:
-                        linePossibleStops.add(stop[0])
-        possibleStops[line] = list(linePossibleStops)
-
-    # { routeCode: [naptanId, naptanId, naptanId, ...]}
-    routePossibleStops = {}
-    for line in tube_timetable:
-        for routeCode,route in tube_timetable[line].items():
-            if not routeCode in routePossibleStops:
-                routePossibleStops[routeCode] = set()
-            for interval in route["intervals"]:
-                for stop in interval:
-                    if not stop[0] in routePossibleStops[routeCode]:
-                        routePossibleStops[routeCode].add(stop[0])
+    # { line: {naptanId, naptanId, naptanId, ...}}
+    possibleStops = tube_timetable.line_stops
+
+    # { routeCode: {naptanId, naptanId, naptanId, ...}}
+    routePossibleStops = tube_timetable.route_code_stops
 
 
     knownVehicleRoutes = {}
@@ -355,71 +409,29 @@ def addTubeTimes():
         possibleRouteCodes = set()
         if not vehicleId in potentialVehicleRoutes:
             potentialVehicleRoutes[vehicleId] = set()
-        for routeCode,route in tube_timetable[vehicle["line"]].items():
-            routeDestNaptan = routeCode.split(":")[1]
-            routeStartNaptan = routeCode.split(":")[0]
-            routePossible = False
-            if(vehicle["towards"].split(" ")[0].strip().lower() in getStopName(routeDestNaptan).strip().lower()):
-                routePossible = True
+        towardsRouteCodes = getTubeRoutesTowards(vehicle["line"], vehicle["towards"])
+        # routes with an interval the observed stops fit in, in order
+        consistentRoutes = tube_timetable.routes_through([s[0] for s in vehicle["stops"]])
+        for routeCode,route in tube_timetable.lines[vehicle["line"]].items():
+            if routeCode in towardsRouteCodes:
                 possibleRoutesFromTowards+=1
                 possibleRouteCodes.add(routeCode)
                 potentialVehicleRoutes[vehicleId].add(routeCode)
                 continue
-            else:
-                routePossible = True
-            # observed stop sequence
-            observed_ids = [s[0] for s in vehicle["stops"]]
-
-            for interval in tube_timetable[vehicle["line"]][routeCode]["intervals"]:
-                interval_ids = [s[0] for s in interval]
-
-                # check if observed sequence is a subsequence of interval stops
-                it = iter(interval_ids)
-                if all(obs in it for obs in observed_ids):
-                    # this interval is consistent with the observed sequence
-                    routePossible = True
-                    potentialVehicleRoutes[vehicleId].add(routeCode)
-                    break
-                else:
-                    routePossible = False
-
-                # # [naptanId, time]
-                # earliestPossibleStop = None
-                # latestPossibleStop = None
-
-
-
-                # for stop in vehicle["stops"]:
-                #     if stop[0] in possibleStops[vehicle["line"]]:
-                #         if not stop[0] in routePossibleStops[routeCode]:
-                #             routePossible = False
-                #             break
-                #         else:
-                #             if earliestPossibleStop is None or stop[1] < earliestPossibleStop[1]:
-                #                 earliestPossibleStop = stop
-                #             if latestPossibleStop is None or stop[1] > latestPossibleStop[1]:
-                #                 latestPossibleStop = stop
-                
-                # # Check if order coincides with the route
-                # for interval in tube_timetable[vehicle["line"]][routeCode]["intervals"]:
-                #     ordered_interval_stops = []
-                #     for stop in interval:
-                #         ordered_interval_stops.append(stop[0])
-                #     if earliestPossibleStop is not None and latestPossibleStop is not None:
-                #         if earliestPossibleStop[0] in ordered_interval_stops and latestPossibleStop[0] in ordered_interval_stops:
-                #             if ordered_interval_stops.index(earliestPossibleStop[0]) > ordered_interval_stops.index(latestPossibleStop[0]):
-                #                 routePossible = False
-                #                 break
-                
-            if routePossible:
-                possibleRouteCodes.add(routeCode)
-                possibleRoutesFromIntervals+=1
+            if route in consistentRoutes:
+                potentialVehicleRoutes[vehicleId].add(routeCode)
+            elif tube_timetable.intervals[route]:
+                continue
+            # consistent, or without intervals to rule it out
+            possibleRouteCodes.add(routeCode)
+            possibleRoutesFromIntervals+=1
         if possibleRoutesFromTowards>0:
             possibleCount = possibleRoutesFromTowards
         else:
             possibleCount = possibleRoutesFromIntervals
         if possibleCount == 1:
-            knownVehicleRoutes[vehicleId] = list(possibleRouteCodes)[0]
+            # the single towards match wins over routes matched by intervals
+            knownVehicleRoutes[vehicleId] = list(possibleRouteCodes & towardsRouteCodes or possibleRouteCodes)[0]
             vehiclesWithOnePossible+=1
         # print(f"{vehicleId:<20} has {len(possibleRouteCodes)} possible routes: {possibleRouteCodes}")
 
@@ -427,6 +439,7 @@ def addTubeTimes():
 
     singleIntervalVehicles = 0
     multiIntervalVehicles = 0
+    normal_time_added_count = 0
 
     predicted_tube_count = 0
 
@@ -442,23 +455,14 @@ def addTubeTimes():
             continue
         
         # We need to find out what interval to use for the vehicle
-        route = tube_timetable[vehicle["line"]][knownVehicleRoutes[vehicleId]]
-
-        possibleIntervalIds = set()
+        route = tube_timetable.lines[vehicle["line"]][knownVehicleRoutes[vehicleId]]
+        routeIntervals = tube_timetable.intervals[route]
 
         unix_now = time.time() - start_of_day_epoch
         unix_lower = unix_now - 7200  # Extended from 1 hour to 2 hours
         unix_upper = unix_now
 
-        if current_day not in route["schedules"]:
-            continue
-
-        for intervalStart in route["schedules"][current_day]:
-            intervalId = intervalStart[0]
-            intervalUnix = intervalStart[1]
-            if(intervalUnix>unix_lower and intervalUnix<unix_upper):
-                possibleIntervalIds.add(intervalId)
-        normal_time_added_count = 0
+        possibleIntervalIds = set(tube_timetable.starting_between(route, current_day, unix_lower, unix_upper).tolist())
         if(len(possibleIntervalIds) == 1):
 
             interval = list(possibleIntervalIds)[0]
@@ -473,7 +477,7 @@ def addTubeTimes():
                 continue
 
             timetableIntervals = {}
-            for intv in route["intervals"][interval]:
+            for intv in routeIntervals[interval]:
                 timetableIntervals[intv[0]] = intv[1]
 
             first_interval_time = timetableIntervals[ordered_stops[0][0]]
@@ -489,7 +493,7 @@ def addTubeTimes():
                 actualTimes[stop[0]] = stop[1]
 
             differences = []
-            for stop in route["intervals"][interval]:
+            for stop in routeIntervals[interval]:
                 if stop[0] in actualIntervals:
                     diff = actualIntervals[stop[0]] - stop[1]
                     differences.append(diff)
@@ -507,7 +511,7 @@ def addTubeTimes():
 
 
             vehicle_arrivaltimes = []
-            for stop in route["intervals"][interval]:
+            for stop in routeIntervals[interval]:
                 if stop[0] in actualIntervals:
                     actual_time = actualTimes[stop[0]]
                     vehicle_arrivaltimes.append((stop[0], actual_time))
@@ -545,7 +549,7 @@ def addTubeTimes():
             
             for interval_id in possibleIntervalIds:
                 timetableIntervals = {}
-                for intv in route["intervals"][interval_id]:
+                for intv in routeIntervals[interval_id]:
                     timetableIntervals[intv[0]] = intv[1]
                 
                 if ordered_stops[0][0] not in timetableIntervals:
@@ -564,7 +568,7 @@ def addTubeTimes():
                     actualTimes[stop[0]] = stop[1]
 
                 differences = []
-                for stop in route["intervals"][interval_id]:
+                for stop in routeIntervals[interval_id]:
                     if stop[0] in actualIntervals:
                         diff = actualIntervals[stop[0]] - stop[1]
                         differences.append(diff)
@@ -573,7 +577,7 @@ def addTubeTimes():
                 median_diff = int(median_diff_min*60)
 
                 # Predict stops for this interval
-                for stop in route["intervals"][interval_id]:
+                for stop in routeIntervals[interval_id]:
                     if stop[0] not in all_predictions:
                         all_predictions[stop[0]] = []
                     
@@ -742,7 +746,10 @@ def process_stop(stop):
         traceback.print_exc()
         return None, stopName, "error", None, None
 
-def addRailTimes():
+def addRailTimes(arrivaltimes, platforms, points):
+    global services, status_codes
+    services = {}
+    status_codes = defaultdict(int)
 
     # Get all train stops
     trainstops = Point.select().where(Point.mode == "rail")
@@ -835,42 +842,88 @@ def addRailTimes():
     points.append(InfluxPoint("rail_data").field("train_count", uniqueTrainCount))
     # print(f"{list(arrivaltimes.keys())}")
 
-def getArrivalsAndPlatforms():
-    global arrivaltimes, platforms, points
-    global vehicles, arrivaltimes, stop_names, services, status_codes
+def runFeed(name, add):
+    # One feed into its own dicts, points and vehicle set, so the feeds never
+    # touch each other's lines and a run that outlives its reload never
+    # writes to a published result or another reload's metrics
+    feed_arrivaltimes = {}
+    feed_platforms = {}
+    feed_points = []
+    feed_vehicles = set()
+    time_start = time.time()
+    print(f"RELOADING {name.upper()} TIME GRAPH")
+    if name == "rail":
+        add(feed_arrivaltimes, feed_platforms, feed_points)
+    elif name == "tube":
+        add(feed_arrivaltimes, feed_points)
+    else:
+        add(feed_arrivaltimes, feed_points, feed_vehicles)
+    return time_start, time.time() - time_start, feed_arrivaltimes, feed_platforms, feed_points, feed_vehicles
 
-    vehicles = set()
-    arrivaltimes = {}
-    stop_names = {}
-    services = {}
-    status_codes = defaultdict(int)
+def getArrivalsAndPlatforms():
+    # The feeds are fetched concurrently and the reload takes what has
+    # finished within RELOAD_INTERVAL, so a slow feed never holds back the
+    # others. A feed that fails or is still running contributes its last good
+    # result instead, for up to FEED_MAX_AGE seconds; a run still going at
+    # the next reload is waited on again rather than started afresh, and its
+    # result counts once it finishes.
+    global arrivaltimes, vehicles
+
+    reload_arrivaltimes = {}
+    platforms = {}
+    reload_vehicles = set()
     points = []
 
     write_api = write_client.write_api(write_options=SYNCHRONOUS)
 
-    time_start = time.time()
-    print(f"RELOADING TUBE TIME GRAPH")
-    addTubeTimes()
-    time_end = time.time()
-    points.append(InfluxPoint("tube_reload").field("duration", time_end - time_start))
-
-    time_start = time.time()
-    print(f"RELOADING BUS TIME GRAPH")
-    addBusTimes()
-    time_end = time.time()
-    points.append(InfluxPoint("bus_reload").field("duration", time_end - time_start))
-
+    feeds = {"tube": addTubeTimes, "bus": addBusTimes, "rail": addRailTimes}
     # print(f"RELOADING TRAM TIME GRAPH")
-    # addTramTimes()
-
+    # feeds["tram"] = addTramTimes
+    def collect(name, result):
+        # each run's points are written by the reload that collects it
+        feed_results[name] = result
+        points.append(InfluxPoint(f"{name}_reload").field("duration", result[1]))
+        points.extend(result[4])
+
+    for name, add in feeds.items():
+        run = feed_runs.get(name)
+        if run is not None and not run.done():
+            continue
+        # a run that finished after its reload gave up on it still counts
+        if run is not None and run.exception() is None:
+            collect(name, run.result())
+        feed_runs[name] = feed_pool.submit(runFeed, name, add)
 
-    time_start = time.time()
-    print(f"RELOADING RAIL TIME GRAPH")
-    addRailTimes()
-    time_end = time.time()
-    points.append(InfluxPoint("rail_reload").field("duration", time_end - time_start))
+    running = {feed_runs[name]: name for name in feeds}
+    try:
+        for run in as_completed(running, timeout=RELOAD_INTERVAL):
+            name = running[run]
+            del feed_runs[name]
+            try:
+                collect(name, run.result())
+            except Exception:
+                print(f"{name} feed failed; using its previous data")
+                traceback.print_exc()
+    except TimeoutError:
+        for run, name in running.items():
+            if not run.done():
+                print(f"{name} feed is still running after {RELOAD_INTERVAL}s; using its previous data")
+                points.append(InfluxPoint(f"{name}_reload").field("timed_out", 1))
+
+    for name in feeds:
+        if name not in feed_results:
+            continue
+        feed_start, _, feed_arrivaltimes, feed_platforms, _, feed_vehicles = feed_results[name]
+        if time.time() - feed_start > FEED_MAX_AGE:
+            print(f"{name} feed's last result is over {FEED_MAX_AGE}s old; dropping it")
+            del feed_results[name]
+            continue
+        reload_arrivaltimes.update(feed_arrivaltimes)
+        platforms.update(feed_platforms)
+        reload_vehicles.update(feed_vehicles)
+    arrivaltimes, vehicles = reload_arrivaltimes, reload_vehicles
 
     for point in points:
         write_api.write(bucket="metrics", org="local-org", record=point)
 
-    return {"arrivaltimes": arrivaltimes, "platforms": platforms}
\ No newline at end of file
+    return {"arrivaltimes": reload_arrivaltimes, "platforms": platforms}
@@ -1,9 +1,13 @@
 from data import *
 import json
 import os
+import numpy as np
 import requests
 from requests.adapters import HTTPAdapter
 from collections import defaultdict
+from footpaths import FootpathGraph
+from geometry import BoxIndex
+from transfers import build_footpaths
 
 db = connect_db()
 
@@ -31,41 +35,14 @@ walking_distances = defaultdict(dict, walking_distances)
 points_list = list(Point.select())
 print(f"Loaded {len(points_list)} points")
 
-# Create spatial lookup dict for faster nearby point queries
-LAT_BUCKET_SIZE = 0.001 
-LON_BUCKET_SIZE = 0.001  # ~70m at UK latitude
-spatial_index = defaultdict(list)
-
-for p in points_list:
-    lat_bucket = int(p.latitude / LAT_BUCKET_SIZE)
-    lon_bucket = int(p.longitude / LON_BUCKET_SIZE)
-    spatial_index[(lat_bucket, lon_bucket)].append(p)
-
-print(f"Built spatial index with {len(spatial_index)} buckets")
+spatial_index = BoxIndex(np.array([p.longitude for p in points_list], dtype=np.float64),
+                         np.array([p.latitude for p in points_list], dtype=np.float64))
 
 def get_nearby_points(point, radius=0.009):
-    """Fast spatial lookup for nearby points"""
-    lat_range = int(radius / LAT_BUCKET_SIZE) + 1
-    lon_range = int(radius / LON_BUCKET_SIZE) + 1
-    center_lat = int(point.latitude / LAT_BUCKET_SIZE)
-    center_lon = int(point.longitude / LON_BUCKET_SIZE)
-    
-    nearby = []
-    for lat_offset in range(-lat_range, lat_range + 1):
-        for lon_offset in range(-lon_range, lon_range + 1):
-            bucket = (center_lat + lat_offset, center_lon + lon_offset)
-            nearby.extend(spatial_index[bucket])
-    
-    # Filter to exact radius
-    top_left_lat = point.latitude - radius
-    bottom_right_lat = point.latitude + radius
-    top_left_lon = point.longitude - radius
-    bottom_right_lon = point.longitude + radius
-    
-    return [p for p in nearby if 
-            top_left_lat < p.latitude < bottom_right_lat and
-            top_left_lon < p.longitude < bottom_right_lon and
-            p.point_id != point.point_id]
+    """Points strictly inside the box of +-radius degrees around point"""
+    candidates = spatial_index.query(point.longitude - radius, point.latitude - radius,
+                                     point.longitude + radius, point.latitude + radius)
+    return [points_list[i] for i in candidates.tolist() if points_list[i].point_id != point.point_id]
 
 done = 0
 changes_since_save = 0
@@ -173,4 +150,7 @@ if changes_since_save > 0:
         json.dump(save_data, f, indent=4)
     os.replace(tmp_path, "walking_distances.json")
 
+# Closed footpaths with station interchanges, in the binary form the router loads
+FootpathGraph.from_dict(build_footpaths({k: dict(v) for k, v in walking_distances.items()}, points_list)).save("walking_distances.bin")
+
 print(f"Completed processing {done} points")
\ No newline at end of file